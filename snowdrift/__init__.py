@@ -1,4 +1,18 @@
 from .collect_data import collectData, summary
-from .snowdrift import snowdrift, calculateDeps
-from .plot import plot
-from .save_grib import save_grib
\ No newline at end of file
+from .snowdrift import snowdrift, calculateDeps, THRESHOLDS
+from .plot import plot, plot_all
+from .save_grib import save_grib
+from .save_zarr import save_zarr, read_zarr, ZarrWriter
+from .stream import DriftStream, follow
+from .pipeline import pipeline, run_pipeline
+from .state import save_state, load_state, grid_hash
+from .cache import FieldCache
+from .tiles import parse_memory
+from .profiling import Profiler, enable_profiling, disable_profiling, profile
+from .stats import set_quiet
+from .ensemble import ensemble_stats, save_ensemble_stats, EnsembleSteps
+from .sweep import sweep, param_grid
+from .timeaxis import resample, run_resampled, step_times, substep_times
+from .activity import active_cells, run_active
+from .delta import save_delta, read_delta
+from .region import Region, read_points, read_roads, save_points, crop_template
@@ -0,0 +1,91 @@
+import logging
+import numpy as np
+from .fused import DRIFT_WIND_LIMIT, INIT_PARAMS, OUTPUT_PARAMS, new_outputs
+from .profiling import profile
+
+# Active cell runs.
+#
+# Cells that are never snow covered over the run (sea, snow
+# free lowlands) have fixed outputs: snowage -1, mobility 0
+# and drift -1 from step 1 on (drift -1 at step 0 too), and
+# drift accumulation that drops by 1 (the previous drift) per
+# step after a windy step, reset to 0 by new snowfall. The
+# model runs on the compacted active cells only, as 1-D fields,
+# and the results are scattered into full grid outputs filled
+# with the fixed values, in the field dtype. Results are identical
+# to full grid runs.
+
+# Flat indices of the cells that are snow covered at any step
+def active_cells(snowground, snowCoverLimit):
+    active = np.zeros(np.size(snowground[0]), dtype=bool)
+    isc = np.empty_like(active)
+    for v in snowground:
+        np.greater(np.reshape(v, -1), snowCoverLimit, out=isc)
+        np.logical_or(active, isc, out=active)
+    return np.flatnonzero(active)
+
+# (time, cells) array of values at the cells of index
+def gather(values, index):
+    out = np.empty((len(values), len(index)), dtype=np.asarray(values[0]).dtype)
+    for i, v in enumerate(values):
+        np.take(np.reshape(v, -1), index, out=out[i])
+    return out
+
+# Full grid outputs of never snow covered cells, as
+# the fused engine computes them
+def inactive_outputs(temp, snowfall, wind, snowFallLimit, init=None, windLimit=DRIFT_WIND_LIMIT):
+    n = len(temp)
+    temp0 = temp[0]
+    out = new_outputs(n, np.shape(temp0), temp0.dtype)
+    age, dacc, mi, drift = [out[p] for p, _ in OUTPUT_PARAMS]
+    drift[...] = -1.0
+    age[1:] = -1.0
+    mi[1:] = 0.0
+    if init is None:
+        np.multiply(temp0, 0.0, out=age[0])
+        np.subtract(age[0], 1.0, out=age[0])
+        np.multiply(temp0, 0.0, out=dacc[0])
+        np.multiply(temp0, 0.0, out=mi[0])
+    else:
+        age[0] = -1.0
+        np.multiply(temp0, 0.0, out=dacc[0])
+        np.add(dacc[0], init['driftacc'], out=dacc[0])
+        mi[0] = 0.0
+
+    m = np.empty(np.shape(temp0), dtype=bool)
+    for i in range(1, n):
+        np.copyto(dacc[i], dacc[i-1])
+        np.greater(wind[i-1], windLimit, out=m)
+        np.subtract(dacc[i-1], 1.0, out=dacc[i], where=m)
+        np.greater(snowfall[i], snowFallLimit, out=m)
+        np.copyto(dacc[i], 0.0, where=m)
+    return out
+
+# Run the drift model on the active cells of data (after
+# calculateDeps), run(sub, init) runs an (untiled) engine
+# on the compacted data sub. Sets the full grid outputs.
+def run_active(data, run, snowCoverLimit, snowFallLimit, init=None, windLimit=DRIFT_WIND_LIMIT):
+    times = data['temp']['times']
+    n = len(times)
+    with profile('active cells'):
+        index = active_cells(data['snowground']['values'], snowCoverLimit)
+    cells = np.size(data['temp']['values'][0])
+    logging.info("snow drift on %d of %d active (snow covered) cells"%(len(index), cells))
+
+    inputs = ('temp', 'snowground', 'snowfall', 'wind')
+    sub = {p: dict(data[p], values=gather(data[p]['values'], index)) for p in inputs}
+    subInit = None
+    if init is not None:
+        subInit = dict(init)
+        subInit.update({p: np.reshape(init[p], -1)[index] for p in INIT_PARAMS})
+    if len(index):
+        run(sub, subInit)
+
+    out = inactive_outputs(data['temp']['values'], data['snowfall']['values'],
+                           data['wind']['values'], snowFallLimit, init, windLimit)
+    for p, unit in OUTPUT_PARAMS:
+        if len(index):
+            values = out[p].reshape(n, cells)
+            for i in range(n):
+                values[i, index] = sub[p]['values'][i]
+        data[p] = {'times': list(times), 'values': out[p], 'unit': unit}
@@ -0,0 +1,205 @@
+import io
+import os
+import gc
+import json
+import time
+import copy
+import shutil
+import logging
+import platform
+import tempfile
+import contextlib
+import numpy as np
+from datetime import datetime, timedelta
+from . import collect_data
+from .snowdrift import (calculateDeps, calculate_snow_cover_age, calculate_drift_accumulation,
+                        calculate_mobility_index, calculate_drift, nsteps)
+from .snowdrift import snowdrift as run_snowdrift
+from .save_grib import save_grib
+from .plot import plot, plot_all
+from .profiling import peak_rss, reset_peak_rss
+
+# Benchmarks of the pipeline stages on synthetic inputs.
+#
+# Inputs are generated in the {'times', 'values', 'unit'} form
+# collectData returns, so no forecast files are needed. With
+# the eccodes python module installed, synthetic GRIB files are
+# also written (from eccodes samples) to time loading and GRIB
+# output. Results are timings, throughput (cells*steps/s) and
+# peak RSS per stage, written as JSON.
+
+# synthetic input parameters, GRIB1 ids as in collect_data.config
+GRIB_PARAMS = (
+    ('snowac', 0, 184),
+    ('snowground', 0, 65),
+    ('temp', 0, 11),
+    ('wind-u', 10, 33),
+    ('wind-v', 10, 34),
+)
+
+# Synthetic input data of ny x nx cells and n hourly steps,
+# as returned by collectData (temp in °C)
+def synthetic_data(ny=500, nx=500, n=24, seed=0):
+    rng = np.random.default_rng(seed)
+    t0 = datetime(2021, 3, 23, 6)
+    times = [t0 + timedelta(hours=i) for i in range(n)]
+
+    def entry(unit):
+        return {'times': list(times), 'values': [], 'unit': unit}
+
+    data = {
+        'snowac': entry('kg m**-2'),
+        'snowground': entry('kg m**-2'),
+        'temp': entry(u'°C'),
+        'wind-u': entry('m s**-1'),
+        'wind-v': entry('m s**-1'),
+    }
+    ground = rng.random((ny, nx), dtype=np.float32)*4.0
+    snowac = np.zeros((ny, nx), dtype=np.float32)
+    for i in range(n):
+        snowac = snowac + (rng.random((ny, nx), dtype=np.float32) > 0.8)*rng.random((ny, nx), dtype=np.float32)
+        data['snowac']['values'].append(snowac)
+        data['snowground']['values'].append(ground + rng.normal(0, 0.3, (ny, nx)).astype(np.float32))
+        data['temp']['values'].append(rng.normal(-2, 3, (ny, nx)).astype(np.float32))
+        data['wind-u']['values'].append(rng.normal(0, 8, (ny, nx)).astype(np.float32))
+        data['wind-v']['values'].append(rng.normal(0, 8, (ny, nx)).astype(np.float32))
+    return data
+
+# Write data as GRIB1 files, one per step, from the eccodes
+# regular_ll_sfc_grib1 sample. Returns the file names.
+def synthetic_grib(data, directory):
+    import eccodes
+
+    times = data['temp']['times']
+    ny, nx = data['temp']['values'][0].shape
+    files = []
+    for i, t in enumerate(times):
+        filename = os.path.join(directory, "synthetic_%s.%02d"%(times[0].strftime('%Y%m%d%H'), i))
+        with open(filename, 'wb') as out:
+            for par, level, ioPar in GRIB_PARAMS:
+                h = eccodes.codes_grib_new_from_samples('regular_ll_sfc_grib1')
+                try:
+                    for key, value in (
+                            ('table2Version', 1), ('Ni', nx), ('Nj', ny),
+                            ('latitudeOfFirstGridPointInDegrees', 70.0),
+                            ('longitudeOfFirstGridPointInDegrees', -25.0),
+                            ('latitudeOfLastGridPointInDegrees', 70.0 - 0.025*(ny - 1)),
+                            ('longitudeOfLastGridPointInDegrees', -25.0 + 0.025*(nx - 1)),
+                            ('iDirectionIncrementInDegrees', 0.025),
+                            ('jDirectionIncrementInDegrees', 0.025),
+                            ('stepUnits', 1), ('indicatorOfTypeOfLevel', 105),
+                            ('level', level), ('indicatorOfParameter', ioPar),
+                            ('P1', 0), ('timeRangeIndicator', 0), ('bitsPerValue', 16)):
+                        eccodes.codes_set(h, key, value)
+                    # step valid time as analysis time, zero step
+                    eccodes.codes_set(h, 'dataDate', int(t.strftime('%Y%m%d')))
+                    eccodes.codes_set(h, 'dataTime', t.hour*100)
+                    vals = np.asarray(data[par]['values'][i], dtype=np.float64)
+                    if par == 'temp':
+                        vals = vals + 273.15
+                    eccodes.codes_set_values(h, vals.ravel())
+                    out.write(eccodes.codes_get_message(h))
+                finally:
+                    eccodes.codes_release(h)
+        files.append(filename)
+    return files
+
+# time a stage, returns (result dict, return value of fn)
+def measure(fn, cells):
+    gc.collect()
+    reset_peak_rss()
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        value = fn()
+        c1 = time.process_time()
+        t1 = time.perf_counter()
+    seconds = t1 - t0
+    res = {
+        'seconds': seconds,
+        'cpu_seconds': c1 - c0,
+        'throughput': cells/seconds if seconds > 0 else None,
+        'peak_rss': peak_rss(),
+    }
+    return res, value
+
+# time the per-step functions over all steps, separately
+def measure_step_functions(data, cells):
+    funcs = (
+        ('calculate_snow_cover_age', calculate_snow_cover_age),
+        ('calculate_drift_accumulation', calculate_drift_accumulation),
+        ('calculate_mobility_index', calculate_mobility_index),
+        ('calculate_drift', calculate_drift),
+    )
+    seconds = {name: 0.0 for name, _ in funcs}
+    for i in range(nsteps(data)):
+        for name, fn in funcs:
+            t0 = time.perf_counter()
+            fn(data, i)
+            seconds[name] += time.perf_counter() - t0
+    return {name: {'seconds': s, 'throughput': cells/s if s > 0 else None}
+            for name, s in seconds.items()}
+
+# Benchmark all stages on a ny x nx grid with n steps,
+# engines are the snowdrift() engines (or run options) to time.
+def run_case(ny, nx, n, grib=False, png=True, engines=('steps', 'fused'), workdir=None):
+    cells = ny*nx*n
+    case = {'ny': ny, 'nx': nx, 'steps': n, 'stages': {}}
+    stages = case['stages']
+    logging.info("benchmark %dx%d, %d steps"%(ny, nx, n))
+
+    data = synthetic_data(ny, nx, n)
+    templateMsg = None
+    tmp = tempfile.mkdtemp(prefix='snowdrift-bench-', dir=workdir)
+    try:
+        if grib:
+            files = synthetic_grib(data, tmp)
+            stages['collectData'], (data, templateMsg) = measure(
+                lambda: collect_data.collectData(files), cells)
+
+        deps = copy.deepcopy(data)
+        stages['calculateDeps'], _ = measure(lambda: calculateDeps(deps), cells)
+        stages.update(measure_step_functions(copy.deepcopy(deps), cells))
+
+        for engine in engines:
+            kwargs = engine if isinstance(engine, dict) else {'engine': engine}
+            name = 'snowdrift(%s)'%(', '.join("%s=%r"%kv for kv in sorted(kwargs.items())))
+            stages[name], result = measure(
+                lambda: run_snowdrift(copy.deepcopy(data), **kwargs), cells)
+
+        if templateMsg is not None:
+            filename = os.path.join(tmp, 'snowdrift.grb')
+            stages['save_grib'], _ = measure(
+                lambda: save_grib(result, filename, templateMsg), cells)
+            stages['save_grib']['bytes'] = os.path.getsize(filename)
+
+        if png:
+            save = os.path.join(tmp, 'png', 'bench')
+            os.makedirs(os.path.dirname(save))
+            params = ('snowage', 'driftacc', 'mobility', 'drift')
+            stages['plot'], _ = measure(
+                lambda: [plot(result, i, p, save=save) for i in range(n) for p in params], cells)
+            stages['plot_all'], _ = measure(
+                lambda: plot_all(result, list(params), save=save), cells)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return case
+
+# Run benchmark cases, sizes is a list of (ny, nx)
+def run(sizes, n, grib=False, png=True, engines=('steps', 'fused'), workdir=None):
+    report = {
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'cases': [],
+    }
+    for ny, nx in sizes:
+        report['cases'].append(run_case(ny, nx, n, grib, png, engines, workdir))
+    return report
+
+# write report as JSON
+def save_report(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import logging
+import pygrib
+import numpy as np
+from datetime import datetime
+
+# On-disk cache of decoded input fields.
+#
+# Each decoded field is stored as a raw .npy file, keyed by
+# the GRIB file path, mtime, size and message id, so a cache hit
+# returns memory-mapped arrays without decoding or copying.
+# A JSON manifest per file lists the cached fields, and the
+# template message is kept as encoded GRIB bytes. Old entries
+# are evicted, least recently used first, to keep the total
+# cache size below max_size bytes.
+
+class FieldCache:
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    # cache key of a file and message id
+    def key(self, f, msgid=''):
+        st = os.stat(f)
+        s = "%s:%d:%d:%s"%(os.path.abspath(f), st.st_mtime_ns, st.st_size, msgid)
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # config (and region) ids of a cache entry
+    def ids(self, config, region=None):
+        ids = sorted(v['id'] for v in config.values())
+        return ids if region is None else ids + [region.key()]
+
+    # returns (records, templateMsg) as read_file does, with
+    # memory-mapped values, or None if not cached
+    def get(self, f, config, region=None):
+        key = self.key(f, self.ids(config, region))
+        manifest = self.path(key + '.json')
+        try:
+            with open(manifest) as fp:
+                entry = json.load(fp)
+            records = []
+            for par, unit, t, member, name in entry['records']:
+                vals = np.load(self.path(name), mmap_mode='r')
+                records.append((par, unit, datetime.fromisoformat(t), member, vals))
+            templateMsg = None
+            if entry['template']:
+                with open(self.path(entry['template']), 'rb') as fp:
+                    templateMsg = pygrib.fromstring(fp.read())
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # mark as recently used
+        for name in entry['files']:
+            try:
+                os.utime(self.path(name))
+            except OSError:
+                pass
+        logging.info("collecting from %r (cached)"%f)
+        return records, templateMsg
+
+    # store read_file results of a file
+    def put(self, f, config, records, templateMsg, region=None):
+        key = self.key(f, self.ids(config, region))
+        entry = {'records': [], 'template': None, 'files': []}
+        count = {}
+        for par, unit, t, member, vals in records:
+            # message id, config id and occurrence in file
+            k = count[par] = count.get(par, -1) + 1
+            name = self.key(f, "%s:%d:%s"%(config[par]['id'], k, key)) + '.npy'
+            self.write(name, lambda fp: np.save(fp, np.ascontiguousarray(vals)))
+            entry['records'].append((par, unit, t.isoformat(), member, name))
+            entry['files'].append(name)
+        if templateMsg is not None:
+            name = key + '.grib'
+            self.write(name, lambda fp: fp.write(templateMsg.tostring()))
+            entry['template'] = name
+            entry['files'].append(name)
+        # manifest last, entry is only valid once complete
+        entry['files'].append(key + '.json')
+        self.write(key + '.json', lambda fp: fp.write(json.dumps(entry).encode()))
+        self.evict()
+
+    # write a cache file atomically
+    def write(self, name, writer):
+        tmp = self.path(name + '.tmp%d'%os.getpid())
+        with open(tmp, 'wb') as fp:
+            writer(fp)
+        os.replace(tmp, self.path(name))
+
+    # remove least recently used entries over max_size
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(self.path(name)) as fp:
+                    files = json.load(fp)['files']
+                stats = [os.stat(self.path(n)) for n in files if os.path.exists(self.path(n))]
+                size = sum(st.st_size for st in stats)
+                used = max(st.st_mtime for st in stats)
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((used, size, files))
+            total += size
+
+        entries.sort()
+        while entries and total > self.max_size:
+            used, size, files = entries.pop(0)
+            logging.info("evicting %d bytes from field cache"%size)
+            # manifest first, so a partly removed entry is never used
+            for name in reversed(files):
+                try:
+                    os.remove(self.path(name))
+                except OSError:
+                    pass
+            total -= size
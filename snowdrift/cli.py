@@ -0,0 +1,227 @@
+import sys
+import argparse
+import logging
+import snowdrift
+
+# Command line program, bin/snowdrift runs main(). Kept in
+# the package so runs can also be started in-process, e.g.
+# as jobs of the resident service (serve.py).
+
+# Regions by key, grid indices are computed once per process
+regions = {}
+
+# Setup program arguments
+def make_parser():
+    parser = argparse.ArgumentParser(prog='snowdrift')
+    parser.add_argument('forecast_files', nargs='*')
+    parser.add_argument('--out', metavar='FILENAME', help="save result to file(s)", default=None)
+    parser.add_argument('--format', help="output format ['GRIB' (default) | 'PNG' | 'Zarr' (chunked array store directory, needs zarr) | 'delta' (keyframe + delta archive, .npz)]", default="GRIB")
+    parser.add_argument('--show', metavar='STEP', help="show snow drift result at STEP [-1 (default / last step)]", default=None)
+    parser.add_argument('--engine', help="drift model engine ['steps' (default, 'fused' when tiled) | 'fused' | 'compact' | 'delta' | 'compiled' (needs numba)]", default=None)
+    parser.add_argument('--step', metavar='HOURS', type=float, help="resample inputs to steps of HOURS, output at these steps [input steps (default)]", default=None)
+    parser.add_argument('--max-dt', metavar='HOURS', type=float, help="sub-step the drift model to at most HOURS per step, e.g. 1 for 3 or 6 hourly inputs", default=None)
+    parser.add_argument('--active-only', action='store_true', help="run the drift model on snow covered cells only, faster on low snow days")
+    parser.add_argument('--max-memory', metavar='SIZE', help="run drift model in spatial tiles within memory budget, e.g. '2G'", default=None)
+    parser.add_argument('--workers', metavar='N', type=int, help="decode input files and run drift model tiles over N processes [1 (default)]", default=1)
+    parser.add_argument('--scratch', metavar='DIR', help="directory for temporary output files when tiling [system temp dir (default)]", default=None)
+    parser.add_argument('--grib-packing', metavar='TYPE', help="GRIB packingType of output, e.g. 'grid_simple' [template packing (default)]", default=None)
+    parser.add_argument('--grib-bits', metavar='N', type=int, help="GRIB bitsPerValue of output [template precision (default)]", default=None)
+    parser.add_argument('--cache', metavar='DIR', help="cache decoded input fields in DIR, for fast reprocessing", default=None)
+    parser.add_argument('--cache-size', metavar='SIZE', help="max total size of the --cache DIR, e.g. '20G', least recently used evicted first", default=None)
+    parser.add_argument('--load-state', metavar='FILENAME', help="warm start from model state saved by a previous forecast cycle", default=None)
+    parser.add_argument('--save-state', metavar='FILENAME', help="save model state for warm starting the next forecast cycle", default=None)
+    parser.add_argument('--state-hours', metavar='N', type=float, help="save model state valid at first step + N hours [6 (default)]", default=6.0)
+    parser.add_argument('--follow', metavar='DIR', help="watch DIR and run drift model step by step as forecast files arrive (GRIB output)", default=None)
+    parser.add_argument('--pattern', help="forecast file name pattern in --follow DIR ['*' (default)]", default="*")
+    parser.add_argument('--steps', metavar='N', type=int, help="stop --follow after N steps", default=None)
+    parser.add_argument('--follow-timeout', metavar='SECONDS', type=float, help="stop --follow when no new file arrives for SECONDS [600 (default)]", default=600.0)
+    parser.add_argument('--pipeline', action='store_true', help="overlap decoding, drift model and output of steps (one step per forecast file, GRIB or PNG output)")
+    parser.add_argument('--ensemble', action='store_true', help="run all ensemble members (perturbationNumber) at once, GRIB output per member")
+    parser.add_argument('--ensemble-stats', metavar='FILENAME', help="save ensemble drift mean and exceedance probabilities to GRIB file", default=None)
+    parser.add_argument('--bbox', metavar='LAT0,LAT1,LON0,LON1', help="only load and run the grid cells within a lat/lon box", default=None)
+    parser.add_argument('--points', metavar='FILENAME', help="only load and run the grid cells nearest to points, CSV of name,lat,lon", default=None)
+    parser.add_argument('--roads', metavar='FILENAME', help="only load and run the grid cells along roads, CSV of name,lat,lon polyline points", default=None)
+    parser.add_argument('--points-out', metavar='FILENAME', help="save --bbox/--points/--roads results as point time series, CSV or Parquet (.parquet)", default=None)
+    parser.add_argument('--quiet', action='store_true', help="don't print data summaries")
+    parser.add_argument('--profile', metavar='FILENAME', help="write per-stage timing and memory report as JSON", default=None)
+    return parser
+
+# Parse arguments and run, returns the exit status,
+# argument errors raise SystemExit (as argparse does).
+# `snowdrift serve ...` starts the resident service.
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv[:1] == ['serve']:
+        from . import serve
+        return serve.main(argv[1:])
+
+    parser = make_parser()
+    args = parser.parse_args(argv)
+
+    if args.quiet:
+        snowdrift.set_quiet()
+
+    # Stage timings and memory, report written when done
+    if args.profile:
+        profiler = snowdrift.enable_profiling()
+    try:
+        return run(args, parser)
+    finally:
+        if args.profile:
+            snowdrift.disable_profiling()
+            profiler.save(args.profile)
+
+def run(args, parser):
+    if args.format.lower() == 'zarr':
+        try:
+            import zarr
+        except ImportError:
+            parser.error("Zarr output needs zarr")
+
+    # Streaming mode, compute and write each step as its file arrives
+    if args.follow:
+        if not args.out or args.format.lower() != 'grib':
+            logging.error("--follow requires --out and GRIB output format")
+            return 1
+        logging.info("writing snowdrift parameters to GRIB %r"%args.out)
+        state = None
+        if args.load_state:
+            # valid time and grid are checked against the first step
+            state = snowdrift.load_state(args.load_state)
+        with open(args.out, 'wb') as out:
+            stream = snowdrift.DriftStream(out, init=state, packing=args.grib_packing,
+                                           bitsPerValue=args.grib_bits)
+            snowdrift.follow(args.follow, stream, pattern=args.pattern,
+                             timeout=args.follow_timeout, nsteps=args.steps)
+        return 0
+
+    # Target forecast dataset...
+    files = args.forecast_files
+    if not files:
+        parser.error("no forecast files given")
+
+    # Pipelined mode, read, compute and write steps concurrently
+    if args.pipeline:
+        if not args.out:
+            parser.error("--pipeline requires --out")
+        state = None
+        if args.load_state:
+            state = snowdrift.load_state(args.load_state)
+        if args.format.lower() == 'delta':
+            parser.error("--pipeline writes GRIB, PNG or Zarr output")
+        if args.format.lower() == 'png':
+            snowdrift.pipeline(files, save=args.out, init=state, workers=args.workers)
+        elif args.format.lower() == 'zarr':
+            snowdrift.pipeline(files, zarr=args.out, init=state, workers=args.workers)
+        else:
+            snowdrift.pipeline(files, args.out, init=state, workers=args.workers,
+                               packing=args.grib_packing, bitsPerValue=args.grib_bits)
+        return 0
+    if args.ensemble and (args.format.lower() not in ('grib', 'zarr', 'delta') or args.show):
+        parser.error("--ensemble requires GRIB, Zarr or delta output format")
+    if args.ensemble_stats and not args.ensemble:
+        parser.error("--ensemble-stats requires --ensemble")
+
+    # Sub-domain to load and run,
+    region = None
+    if args.bbox:
+        region = snowdrift.Region(bbox=[float(x) for x in args.bbox.split(',')])
+    elif args.points or args.roads:
+        region = snowdrift.Region(points=snowdrift.read_points(args.points) if args.points else None,
+                                  roads=snowdrift.read_roads(args.roads) if args.roads else None)
+    if region is not None:
+        # reuse grid indices of earlier runs (serve mode)
+        region = regions.setdefault(region.key(), region)
+    if args.points_out and region is None:
+        parser.error("--points-out requires --bbox, --points or --roads")
+    if args.points_out and args.points_out.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            parser.error("--points-out .parquet needs pyarrow")
+    if region is not None and region.bbox is None and args.out and args.format.lower() not in ('zarr', 'delta'):
+        parser.error("--points/--roads results can only be saved with --points-out, Zarr or delta format")
+
+    # Load input fc parameter data,
+    #  - pass input data config here
+    cache = None
+    if args.cache:
+        maxSize = snowdrift.parse_memory(args.cache_size) if args.cache_size else None
+        cache = snowdrift.FieldCache(args.cache, maxSize)
+    inputData, templateMsg = snowdrift.collectData(files, workers=args.workers, cache=cache, ensemble=args.ensemble, region=region)
+
+    # Warm start state from previous forecast cycle,
+    gridHash = snowdrift.grid_hash(templateMsg, region=region)
+    state = None
+    if args.load_state:
+        state = snowdrift.load_state(args.load_state, inputData['temp']['times'][0], gridHash)
+
+    # Run snowdrift calculation on dataset,
+    #  - ensembles, regions and active cell runs are untiled, over all members/cells at once
+    #  - ensemble statistics are accumulated as each step is computed
+    workers = None if args.ensemble or region is not None or args.active_only else args.workers
+    ensembleSteps = snowdrift.EnsembleSteps() if args.ensemble_stats else None
+    if args.step or args.max_dt:
+        times = inputData['temp']['times']
+        steps = snowdrift.step_times(times[0], times[-1], args.step) if args.step else None
+        data = snowdrift.run_resampled(inputData, steps, args.max_dt, engine=args.engine, max_memory=args.max_memory,
+                                       scratch=args.scratch, workers=workers, state=state, active_only=args.active_only,
+                                       on_step=ensembleSteps)
+    else:
+        data = snowdrift.snowdrift(inputData, engine=args.engine, max_memory=args.max_memory, scratch=args.scratch, workers=workers, state=state,
+                                   active_only=args.active_only, on_step=ensembleSteps)
+
+    # save,
+    if args.points_out:
+        snowdrift.save_points(data, args.points_out, region.selection(templateMsg))
+    if args.out and args.format.lower() in ('zarr', 'delta'):
+        if region is not None:
+            sel = region.selection(templateMsg)
+            lats, lons, names = sel.lats, sel.lons, sel.names
+        else:
+            lats, lons = templateMsg.latlons()
+            names = None
+        if args.format.lower() == 'zarr':
+            logging.info("writing snowdrift parameters to Zarr store %r"%args.out)
+            snowdrift.save_zarr(data, args.out, lats, lons, names, workers=args.workers)
+        else:
+            logging.info("writing snowdrift parameters to delta archive %r"%args.out)
+            snowdrift.save_delta(data, args.out, lats, lons)
+    elif args.out:
+        bitsPerValue = args.grib_bits
+        if region is not None:
+            # at the source precision, also if the cropped template is constant
+            if bitsPerValue is None:
+                bitsPerValue = templateMsg['bitsPerValue']
+            templateMsg = snowdrift.crop_template(templateMsg, region.selection(templateMsg))
+        filen = args.out
+        # save as images...
+        if args.format.lower() == 'png':
+            logging.info("writing PNG images to %r"%(filen+"*"))
+            snowdrift.plot_all(data, ['snowage', 'driftacc', 'mobility', 'drift'], save=filen, workers=args.workers)
+        elif args.format.lower() == 'grib':
+            logging.info("writing snowdrift parameters to GRIB %r"%(filen+"*"))
+            snowdrift.save_grib(data, filen, templateMsg, workers=args.workers,
+                                packing=args.grib_packing, bitsPerValue=bitsPerValue)
+        else:
+            logging.error("unknown output format %r"%args.format)
+            return 1
+
+    # Ensemble statistics,
+    if args.ensemble_stats:
+        stats = ensembleSteps.stats(data['drift']['times'])
+        snowdrift.save_ensemble_stats(stats, args.ensemble_stats, templateMsg, data['drift']['members'])
+
+    # Model state for next forecast cycle, after the outputs
+    if args.save_state:
+        snowdrift.save_state(args.save_state, data, args.state_hours, gridHash)
+
+    # Test plot the results at step
+    if args.show:
+        step = int(args.show)
+        snowdrift.plot(data, step, 'snowage')
+        snowdrift.plot(data, step, 'driftacc')
+        snowdrift.plot(data, step, 'mobility')
+        snowdrift.plot(data, step, 'drift')
+
+    return 0
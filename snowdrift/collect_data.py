@@ -3,6 +3,10 @@ import logging
 import numpy as np
 from datetime import datetime, timedelta
 from more_itertools import sort_together
+from .cache import FieldCache
+from . import stats
+from .profiling import profiled
+from .pools import process_pool
 
 # default data collection config...
 config = {
@@ -30,74 +34,175 @@ config = {
     }
 }
 
-def collectData(files, config=config):
+# keys of the GRIB index, in order of the config 'id' string
+INDEX_KEYS = ('typeOfLevel', 'level', 'indicatorOfParameter')
+
+# split config 'id' string into index key values,
+# e.g. 'heightAboveGround:0:184' -> ('heightAboveGround', 0, 184)
+def parse_id(id):
+    toLevel, level, ioPar = id.split(':')
+    return toLevel, int(level), int(ioPar)
+
+# Yields (par, msg) for the configured messages in a file.
+# Uses a GRIB index on INDEX_KEYS to jump straight to the
+# configured messages, the index only reads message headers,
+# only selected messages are later decoded.
+def select_messages(f, id2Par):
+    try:
+        idx = pygrib.index(f, *INDEX_KEYS)
+    except OSError as e:
+        logging.error("failed to open file %r"%f)
+        raise e
+
+    try:
+        for id, par in id2Par.items():
+            keys = dict(zip(INDEX_KEYS, parse_id(id)))
+            try:
+                msgs = idx.select(**keys)
+            except ValueError:
+                # no matching messages in this file
+                continue
+            for g in msgs:
+                yield par, g
+    finally:
+        idx.close()
+
+# step valid time of GRIB message g
+def valid_time(g):
+    t = g.validDate
+    ## WARNING: the valid time of step,
+    ##    can be differently implemented in some forecasts,
+    ##    this works with ecmwf, Harmonie and IGB data...
+    ##    TODO: It may be necessary to add some logic here
+    ##          for other fc model outputs like NCEP models
+    return t + timedelta(hours = g.step * g.stepUnits)
+
+# Decode the configured messages of a single file,
+# returns list of (par, unit, time, member, values) records in
+# file order, and the first temp message as template (or None).
+# member is the ensemble perturbationNumber (0 if not set).
+# With a region (region.py), only its grid cells are kept.
+def read_file(f, config=config, region=None):
     # reverse mapping of config dict for convenience,
     id2Par = {v['id']: k for k, v in config.items()}
 
+    records = []
+    templateMsg = None
+
+    logging.info("collecting from %r"%f)
+
+    # pick out configured messages
+    for par, g in select_messages(f, id2Par):
+        # check if input config overrides unit
+        unit = config[par].get('unit') or g['units']
+
+        # keep a template message for later use in writing results
+        if templateMsg is None and par == 'temp':
+            templateMsg = g
+
+        # pick out data...
+        vals = g.values.astype(np.float32)
+
+        # convert any masked array data...
+        if hasattr(vals, 'mask'):
+            vals = np.ma.getdata(vals)
+
+        # cut down to region cells,
+        if region is not None:
+            vals = region.extract(g, vals)
+
+        # convert units if necessary,
+        if unit == 'K':
+            vals -= 273.15
+            unit = u'°C'
+
+        # calculate step valid time...
+        t = valid_time(g)
+
+        # ensemble member,
+        member = g['perturbationNumber'] if g.has_key('perturbationNumber') else 0
+
+        records.append((par, unit, t, member, vals))
+
+    return records, templateMsg
+
+# read_file for worker processes, grib messages can't be
+# pickled so the template is returned as encoded bytes
+def _read_file_worker(f, config, template, region=None):
+    records, templateMsg = read_file(f, config, region)
+    if template and templateMsg is not None:
+        return records, templateMsg.tostring()
+    return records, None
+
+# decode files over a pool of worker processes,
+# yields read_file results in files order, with template
+# messages of the first file only (or all files if template)
+def read_files_parallel(files, config, workers, template=False, region=None):
+    with process_pool(workers) as pool:
+        futures = [pool.submit(_read_file_worker, f, config, template or i == 0, region)
+                   for i, f in enumerate(files)]
+        for fut in futures:
+            records, template = fut.result()
+            if template is not None:
+                template = pygrib.fromstring(template)
+            yield records, template
+
+# collect the configured parameters from grib files,
+# returns data dict and a template message (first temp
+# message of files[0]) for writing results
+#  - workers: decode files concurrently over N processes,
+#             output is the same as the serial path
+#  - cache: FieldCache (or cache directory), decoded fields are
+#             stored there and returned memory-mapped on later runs
+#  - ensemble: keep ensemble members (perturbationNumber) apart,
+#             values are (time, member, ny, nx) arrays and each
+#             param has a 'members' list of member numbers
+#  - region: Region (region.py), only its grid cells are decoded
+#             and kept, see region.selection(templateMsg)
+@profiled('load')
+def collectData(files, config=config, workers=None, cache=None, ensemble=False, region=None):
+    if cache is not None and not isinstance(cache, FieldCache):
+        cache = FieldCache(cache)
+
+    # cached files,
+    results = [None]*len(files)
+    if cache is not None:
+        results = [cache.get(f, config, region) for f in files]
+    missing = [f for f, r in zip(files, results) if r is None]
+
+    # decode the rest,
+    if workers and workers > 1 and len(missing) > 1:
+        logging.info("decoding %d files over %d workers"%(len(missing), workers))
+        decoded = read_files_parallel(missing, config, workers, template=cache is not None, region=region)
+    else:
+        decoded = (read_file(f, config, region) for f in missing)
+    decoded = iter(decoded)
+    for i, f in enumerate(files):
+        if results[i] is None:
+            results[i] = next(decoded)
+            if cache is not None:
+                cache.put(f, config, *results[i], region=region)
+
     # create data holder,
     data = {}
+    templateMsg = None
 
-    for f in files:
-        # open the files...
-        try:
-            G = pygrib.open(f)
-        except OSError as e:
-            logging.error("failed to open file %r"%f)
-            raise e
-
-        logging.info("collecting from %r"%f)
-
-        # scan for data
-        for g in G:
-            # read the msg identifiers
-            toLevel = g['typeOfLevel']
-            level = g['level']
-            ioPar = g['indicatorOfParameter']
-            unit = g['units']
-            # construct string unique identity
-            id = "%s:%d:%d"%(toLevel, level, ioPar)
-
-            # check against config,
-            if id in id2Par:
-                # collect this data,
-                par = id2Par[id]
-                if par not in data:
-                    logging.info(" - found %r"%par)
-                    # check if input config overrides unit
-                    if config[par].get('unit'):
-                        unit = config[par].get('unit')
-                        logging.info("   - overriding unit as %r"%unit)
-                    # create data entry for this par...
-                    data[par] = {'times': [], 'values':[], 'unit': unit}
-
-                # pick out data...
-                vals = g.values.astype(np.float32)
-
-                # convert any masked array data...
-                if hasattr(vals, 'mask'):
-                    vals = np.ma.getdata(vals)
-
-                # convert units if necessary,
-                if unit == 'K':
-                    vals -= 273.15
-                    data[par]['unit'] = u'°C'
-
-                # calculate step valid time...
-                t = g.validDate
-                ## WARNING: the valid time of step,
-                ##    can be differently implemented in some forecasts,
-                ##    this works with ecmwf, Harmonie and IGB data...
-                ##    TODO: It may be necessary to add some logic here
-                ##          for other fc model outputs like NCEP models
-                t += timedelta(hours = g.step * g.stepUnits)
-                
-                # append data
-                times = data[par]['times']
-                values = data[par]['values']
-                times.append(t)
-                values.append(vals)
-        # close file
-        G.close()
+    # merge file records, in files order
+    for i, (records, template) in enumerate(results):
+        if i == 0:
+            templateMsg = template
+        for par, unit, t, member, vals in records:
+            if par not in data:
+                logging.info(" - found %r"%par)
+                # create data entry for this par...
+                data[par] = {'times': [], 'values':[], 'unit': unit}
+                if ensemble:
+                    data[par]['members'] = []
+            # append data
+            data[par]['times'].append(t)
+            data[par]['values'].append(vals)
+            if ensemble:
+                data[par]['members'].append(member)
 
     # Sorting and consistency checks here...
 
@@ -105,6 +210,9 @@ def collectData(files, config=config):
     # data should be returned in correct order
     logging.info('time sorting loaded parameters')
     for par in data:
+        if ensemble:
+            stack_members(par, data[par])
+            continue
         times = data[par]['times']
         values = data[par]['values']
         res = sort_together((times, values))
@@ -117,42 +225,33 @@ def collectData(files, config=config):
     # consistency checks on input data,
     check_consistency(data)
 
-    # collect a template message for later use
-    # in writing results
-    templateMsg = get_template_msg(files[0])
+    if templateMsg is None:
+        raise IOError("could not find a template msg in %r"%files[0])
 
     return data, templateMsg
 
-# collect a single appropriate msg from grib forecast,
-# for later use as template in writing snow drift results 
-def get_template_msg(file):
-    logging.info("collecting template msg from %r"%file)
+# Stack the records of an ensemble data entry, by time and
+# member number, into a (time, member, ny, nx) array
+def stack_members(par, entry):
+    fields = {}
+    for t, m, vals in zip(entry['times'], entry['members'], entry['values']):
+        if (t, m) in fields:
+            raise IOError("more than one %r field of member %d at %s"%(par, m, t))
+        fields[(t, m)] = vals
+    times = sorted(set(entry['times']))
+    members = sorted(set(entry['members']))
+    if len(fields) != len(times)*len(members):
+        raise IOError("%r is missing steps of some ensemble members"%par)
+    logging.info(" - %r, %d members"%(par, len(members)))
 
-    try:
-        G = pygrib.open(file)
-    except OSError as e:
-        logging.error("failed to open file %r"%file)
-        raise e
-
-    # scan for appropriate msg
-    for g in G:
-        # read the msg identifiers
-        toLevel = g['typeOfLevel']
-        level = g['level']
-        ioPar = g['indicatorOfParameter']
-        unit = g['units']
-        # construct string unique identity
-        id = "%s:%d:%d"%(toLevel, level, ioPar)
-
-        # check against config, 
-        # use first temp msg as template
-        if id == config['temp']['id']:
-            G.close()
-            return g
-
-    # if here failed to find template msg
-    G.close()
-    raise IOError("could not find a template msg in %r"%file)
+    vals = entry['values'][0]
+    values = np.empty((len(times), len(members))+vals.shape, dtype=vals.dtype)
+    for i, t in enumerate(times):
+        for k, m in enumerate(members):
+            values[i, k] = fields[(t, m)]
+    entry['times'] = times
+    entry['members'] = members
+    entry['values'] = values
 
 def check_consistency(data):
     # Consistency checks, e.g. no. steps and time stamps
@@ -162,24 +261,26 @@ def check_consistency(data):
     allN = [len(ts) for ts in allTimes]
     # must all be same length...
     logging.info("checking loaded params length are consistent")
-    for i in range(1, len(allN)):
-        prev = allN[i-1]
-        curr = allN[i]
-        if prev != curr:
-            logging.error(" - FAIL")
-            raise IOError("inconsistent number of parameter steps found")
+    if len(set(allN)) > 1:
+        logging.error(" - FAIL")
+        raise IOError("inconsistent number of parameter steps found")
     logging.info(" - OK")
     # check all time steps are equivalent,
+    # as one (params, steps) array comparison
     logging.info("checking time steps across all loaded params")
-    for i in range(1, len(allTimes)):
-        for k in range(len(allTimes[0])):
-            if allTimes[i][k] != allTimes[i-1][k]:
-                logging.error(" - FAIL")
-                raise IOError("time steps dont match across all input data")
+    if allTimes:
+        times = np.array(allTimes, dtype='datetime64[us]')
+        if not (times == times[0]).all():
+            logging.error(" - FAIL")
+            raise IOError("time steps dont match across all input data")
     logging.info(" - OK")
 
 
+# Print a summary of the data, min/max from cached
+# field statistics (stats.py), nothing in quiet mode
 def summary(data):
+    if stats.QUIET:
+        return
     print("-----------------------------------")
     print("data summary:")
     print("-----------------------------------")
@@ -203,23 +304,6 @@ def summary(data):
 def minmax(data):
     mm = {}
     for k in data:
-        vs = data[k]['values']
-        # if empty...
-        if len(vs) == 0:
-            mm[k] = {'min': np.nan, 'max': np.nan}
-        if k not in mm:
-            mm[k] = {'min': vs[0].min(), 'max': vs[0].max()}
-        mi = mm[k]['min']
-        ma = mm[k]['max']
-        for v in vs:
-            tma = v.max()
-            tmi = v.min()
-            if tma > ma:
-                mm[k]['max'] = tma
-            if tmi < mi:
-                mm[k]['min'] = tmi
+        mi, ma, mean = stats.param_stats(data[k])
+        mm[k] = {'min': mi, 'max': ma, 'mean': mean}
     return mm
-
-
-
-
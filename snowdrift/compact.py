@@ -0,0 +1,191 @@
+import numpy as np
+from .fused import FusedKernel, drift_field
+from .profiling import profile
+
+# Compact drift engine.
+#
+# The fused engine's rules, with the drift state kept in
+# compact form over the recursion:
+#  - mobility as uint8 codes into MOBILITY_VALUES,
+#  - snowage as int16 hours (AGE_NAN for NaN ages),
+#  - drift not stored, only the previous step is kept for
+#    the drift accumulation, it is recomputed per step from
+#    wind, snow cover and mobility when read.
+# driftacc stays float. Fields are decoded to float per step,
+# when read through CompactField, e.g. at output time, and
+# are bit-identical to the fused engine. The step masks are
+# reused per-step buffers (as in FusedKernel), not stored.
+
+# mobility code values, NaN and -0.0 codes keep cold start
+# fields (temp*0.0) bit-identical
+MOBILITY_VALUES = (0.0, 0.3, 0.6, 1.0, np.nan, -0.0)
+MOBILITY_NAN = 4
+MOBILITY_NEGZERO = 5
+AGE_NAN = np.iinfo(np.int16).min
+
+# mobility values as codes, raises ValueError if not representable
+def encode_mobility(mi, out, dtype=np.float32):
+    values = np.asarray(MOBILITY_VALUES, dtype=dtype)
+    out[...] = 0
+    for code, value in enumerate(values[1:4], 1):
+        out[mi == value] = code
+    out[np.isnan(mi)] = MOBILITY_NAN
+    out[(mi == 0.0) & np.signbit(mi)] = MOBILITY_NEGZERO
+    if not np.array_equal(values[out], mi, equal_nan=True):
+        raise ValueError("mobility values not representable as compact codes")
+    return out
+
+# snowage hours as int16, raises ValueError if not whole hours
+def encode_age(age, out):
+    nan = np.isnan(age)
+    if np.abs(age[~nan]).max(initial=0) >= -AGE_NAN:
+        raise ValueError("snow ages not representable as int16 hours")
+    # NaN cells get the sentinel, not a NaN cast
+    out[...] = AGE_NAN
+    np.copyto(out, age, casting='unsafe', where=~nan)
+    if not np.array_equal(out[~nan], age[~nan]):
+        raise ValueError("snow ages not representable as int16 hours")
+    return out
+
+def decode_mobility(codes, dtype=np.float32, out=None):
+    return np.take(np.asarray(MOBILITY_VALUES, dtype=dtype), codes, out=out)
+
+def decode_age(age, dtype=np.float32):
+    out = age.astype(dtype)
+    out[age == AGE_NAN] = np.nan
+    return out
+
+# True if the recursion can run with int16 snow ages,
+# i.e. steps and warm start ages are whole hours
+def compact_age(dtHours, init=None):
+    if any(dt != int(dt) for dt in dtHours):
+        return False
+    if init is not None:
+        age = np.asarray(init['snowage'])
+        age = age[~np.isnan(age)]
+        return bool(np.all(age == np.round(age)))
+    return True
+
+class CompactKernel(FusedKernel):
+    def __init__(self, shape, dtype, snowCoverLimit, snowFallLimit, **thresholds):
+        FusedKernel.__init__(self, shape, snowCoverLimit, snowFallLimit, **thresholds)
+        self.dtype = dtype
+        self.values = np.asarray(MOBILITY_VALUES, dtype=dtype)
+        self.mi = np.empty(shape, dtype=dtype)   # decoded mobility
+        self.ageNaN = False
+
+    # first step, as FusedKernel.first, age and mi are
+    # compact, drift is the float drift of the step
+    def first(self, temp0, snowground, wind, age, dacc, mi, drift, init=None):
+        ageF = np.empty(self.shape, dtype=self.dtype)
+        FusedKernel.first(self, temp0, snowground, wind, ageF, dacc, self.mi, drift, init)
+        encode_mobility(self.mi, mi, self.dtype)
+        encode_age(ageF, age)
+        self.ageNaN = bool(np.isnan(ageF).any())
+
+    # step i > 0, dtHours whole hours
+    def step(self, dtHours, snowground, snowfall, temp, wind,
+             pWind, pAge, pDacc, pMi, pDrift,
+             age, dacc, mi, drift):
+        isc = np.greater(snowground, self.snowCoverLimit, out=self.isc)
+        nsc = np.logical_not(isc, out=self.nsc)
+        new = np.greater(snowfall, self.snowFallLimit, out=self.new)
+        m1 = self.m1
+        m2 = self.m2
+
+        # snow age,
+        np.add(pAge, int(dtHours), out=age)
+        if self.ageNaN:
+            np.equal(pAge, AGE_NAN, out=m1)
+            np.copyto(age, AGE_NAN, where=m1)
+        np.copyto(age, 0, where=new)
+        np.copyto(age, -1, where=nsc)
+
+        # drift accumulation, when previous wind > windLimit
+        np.copyto(dacc, pDacc)
+        np.greater(pWind, self.windLimit, out=m1)
+        np.add(pDacc, pDrift, out=dacc, where=m1)
+        np.copyto(dacc, 0.0, where=new)
+
+        # mobility index, codes 3: 1.0, 2: 0.6, 1: 0.3, 0: 0.0
+        np.copyto(mi, pMi)
+        np.copyto(mi, 3, where=new)
+        np.equal(mi, 3, out=m1)
+        np.greater_equal(age, self.ageLimit, out=m2)
+        np.logical_and(m1, m2, out=m1)
+        np.copyto(mi, 2, where=m1)
+        np.greater_equal(dacc, self.daccLow, out=m1)
+        np.copyto(mi, 2, where=m1)
+        np.greater(dacc, self.daccHigh, out=m1)
+        np.copyto(mi, 1, where=m1)
+        np.greater(temp, 0.0, out=m1)
+        np.copyto(mi, 0, where=m1)
+        np.copyto(mi, 0, where=nsc)
+
+        np.take(self.values, mi, out=self.mi)
+        self.drift(wind, self.mi, drift)
+
+# Per step indexable view of a compact field, decoding
+# each step to float when read
+class CompactField:
+    def __init__(self, n, decode):
+        self.n = n
+        self.decode = decode
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("step %d out of range"%i)
+        return self.decode(i)
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.decode(i)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray([self.decode(i) for i in range(self.n)], dtype=dtype)
+
+# Run the recursion in compact form, returns the output
+# fields as {param: values}, snowage and mobility as
+# CompactField, drift recomputed per step from mobility,
+# thresholds: further FusedKernel thresholds.
+def compact_recursion(snowground, snowfall, temp, wind, dtHours,
+                      snowCoverLimit, snowFallLimit, init=None, on_step=None, **thresholds):
+    n = len(dtHours)
+    temp0 = temp[0]
+    shape = temp0.shape
+    dtype = temp0.dtype
+    kernel = CompactKernel(shape, dtype, snowCoverLimit, snowFallLimit, **thresholds)
+
+    age = np.empty((n,)+shape, dtype=np.int16)
+    mi = np.empty((n,)+shape, dtype=np.uint8)
+    dacc = np.empty((n,)+shape, dtype=dtype)
+    # previous and current step drift
+    drift = np.empty((2,)+shape, dtype=dtype)
+
+    with profile('drift step', step=0):
+        kernel.first(temp0, snowground[0], wind[0], age[0], dacc[0], mi[0], drift[0], init)
+    if on_step is not None:
+        on_step(0, drift[0])
+    for i in range(1, n):
+        with profile('drift step', step=i):
+            kernel.step(dtHours[i], snowground[i], snowfall[i], temp[i], wind[i],
+                        wind[i-1], age[i-1], dacc[i-1], mi[i-1], drift[(i-1)%2],
+                        age[i], dacc[i], mi[i], drift[i%2])
+        if on_step is not None:
+            on_step(i, drift[i%2])
+
+    def decode_drift(i):
+        return drift_field(decode_mobility(mi[i], dtype), wind[i], snowground[i], snowCoverLimit,
+                           kernel.windLimit)
+
+    return {
+        'snowage': CompactField(n, lambda i: decode_age(age[i], dtype)),
+        'driftacc': dacc,
+        'mobility': CompactField(n, lambda i: decode_mobility(mi[i], dtype)),
+        'drift': CompactField(n, decode_drift),
+    }
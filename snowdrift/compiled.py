@@ -0,0 +1,189 @@
+import os
+import types
+import threading
+import numpy as np
+from .profiling import profile
+from .fused import DRIFT_WIND_LIMIT, MOBILITY_AGE_LIMIT, DRIFT_ACC_LIMITS
+
+# Compiled drift engine.
+#
+# The drift rules are a per-cell state machine, so instead of
+# ~20 full grid ufunc passes per step, drift_cells walks each
+# cell through all steps in one loop. Cells are processed in
+# blocks of BLOCK cells, step by step, so the previous step
+# state of a block is still in cache, and blocks run in
+# parallel. Compiled with Numba (optional dependency) when
+# installed, else the engine falls back to the fused NumPy
+# engine. Arithmetic is done in the field dtype one operation
+# at a time, and wind**3 is taken from NumPy (its float32 power
+# is not correctly rounded, a compiled pow differs in the last
+# bit), so results are bit-identical to the other engines.
+
+# cells per block
+BLOCK = 2048
+
+# constants, in the field dtype (as the NumPy engines cast
+# python float scalars), by index, followed by the windLimit,
+# ageLimit, daccLow and daccHigh thresholds
+CONSTANTS = (0.0, 1.0, -1.0, 0.6, 0.3, 1728.0)
+
+# compiled drift_cells, None if not compiled (yet)
+KERNEL = None
+
+# Numba threading layer, unless set by NUMBA_THREADING_LAYER.
+# The TBB layer hangs at exit in processes that also fork
+# (tiled --workers runs), workqueue is fork-safe but not
+# thread-safe, so kernel launches are serialized by LOCK.
+THREADING_LAYER = 'workqueue'
+LOCK = threading.Lock()
+
+def prange(*args):
+    return range(*args)
+
+# Run the recursion over cells, inputs and outputs are
+# (time, cells) arrays, init (3, cells) warm start snowage,
+# driftacc and mobility, used if warm. limits and c in the
+# field dtype. drift holds wind**3 on input.
+def drift_cells(snowground, snowfall, temp, wind, dt, limits, c, init, warm,
+                age, dacc, mi, drift, block):
+    n, cells = temp.shape
+    coverLimit = limits[0]
+    fallLimit = limits[1]
+    zero = c[0]
+    one = c[1]
+    minusOne = c[2]
+    mi06 = c[3]
+    mi03 = c[4]
+    scale = c[5]
+    windLimit = c[6]
+    ageLimit = c[7]
+    daccLow = c[8]
+    daccHigh = c[9]
+    nblocks = (cells + block - 1)//block
+    for b in prange(nblocks):
+        c0 = b*block
+        c1 = min(cells, c0 + block)
+
+        # first step, cold or warm start
+        for k in range(c0, c1):
+            isc = snowground[0, k] > coverLimit
+            z = temp[0, k]*zero
+            if warm:
+                a = z + init[0, k]
+                if a < zero and isc:
+                    a = zero
+                if not isc:
+                    a = minusOne
+                da = z + init[1, k]
+                m = z + init[2, k]
+                if not isc:
+                    m = zero
+            else:
+                a = z - one
+                if isc:
+                    a = zero
+                da = z
+                m = z
+            w = wind[0, k]
+            d = m*drift[0, k]
+            d = d/scale
+            if w < windLimit:
+                d = zero
+            if not isc:
+                d = minusOne
+            age[0, k] = a
+            dacc[0, k] = da
+            mi[0, k] = m
+            drift[0, k] = d
+
+        for i in range(1, n):
+            for k in range(c0, c1):
+                isc = snowground[i, k] > coverLimit
+                new = snowfall[i, k] > fallLimit
+
+                # snow age,
+                a = age[i-1, k] + dt[i]
+                if new:
+                    a = zero
+                if not isc:
+                    a = minusOne
+
+                # drift accumulation, when previous wind > 6.0
+                da = dacc[i-1, k]
+                if wind[i-1, k] > windLimit:
+                    da = da + drift[i-1, k]
+                if new:
+                    da = zero
+
+                # mobility index,
+                m = mi[i-1, k]
+                if new:
+                    m = one
+                if m == one and a >= ageLimit:
+                    m = mi06
+                if da >= daccLow:
+                    m = mi06
+                if da > daccHigh:
+                    m = mi03
+                if temp[i, k] > zero:
+                    m = zero
+                if not isc:
+                    m = zero
+
+                # drift,
+                w = wind[i, k]
+                d = m*drift[i, k]
+                d = d/scale
+                if w < windLimit:
+                    d = zero
+                if not isc:
+                    d = minusOne
+
+                age[i, k] = a
+                dacc[i, k] = da
+                mi[i, k] = m
+                drift[i, k] = d
+
+# drift_cells compiled with Numba, parallel over blocks,
+# None if Numba is not installed
+def get_kernel():
+    global KERNEL
+    if KERNEL is None:
+        try:
+            import numba
+        except ImportError:
+            return None
+        if 'NUMBA_THREADING_LAYER' not in os.environ:
+            numba.config.THREADING_LAYER = THREADING_LAYER
+        # compile with numba.prange in place of prange
+        fn = types.FunctionType(drift_cells.__code__, dict(drift_cells.__globals__, prange=numba.prange))
+        KERNEL = numba.njit(parallel=True, cache=True, nogil=True)(fn)
+    return KERNEL
+
+# Run the recursion with kernel (drift_cells or its compiled
+# form) on (time, ...) input fields, into the (time, ...)
+# output arrays, init is an optional warm start state,
+# scalar thresholds as for FusedKernel.
+def compiled_recursion(kernel, snowground, snowfall, temp, wind, dtHours,
+                       snowCoverLimit, snowFallLimit, snowage, driftacc, mobility, drift,
+                       init=None, block=BLOCK, windLimit=DRIFT_WIND_LIMIT, ageLimit=MOBILITY_AGE_LIMIT,
+                       daccLow=DRIFT_ACC_LIMITS[0], daccHigh=DRIFT_ACC_LIMITS[1]):
+    n = len(dtHours)
+    temp = np.ascontiguousarray(temp)
+    dtype = temp.dtype
+    cells = temp[0].size
+    flat = lambda v: np.ascontiguousarray(v, dtype=dtype).reshape(n, cells)
+    if init is not None:
+        state = np.stack([np.asarray(init[p], dtype=dtype).reshape(cells)
+                          for p in ('snowage', 'driftacc', 'mobility')])
+    else:
+        state = np.zeros((3, cells), dtype=dtype)
+    outputs = [v.reshape(n, cells) for v in (snowage, driftacc, mobility, drift)]
+    wind = flat(wind)
+    with profile('drift steps', steps=n), LOCK:
+        np.power(wind, 3.0, out=outputs[3])
+        kernel(flat(snowground), flat(snowfall), temp.reshape(n, cells), wind,
+               np.asarray(dtHours, dtype=dtype),
+               np.asarray((snowCoverLimit, snowFallLimit), dtype=dtype),
+               np.asarray(CONSTANTS + (windLimit, ageLimit, daccLow, daccHigh), dtype=dtype), state, init is not None,
+               *outputs, block)
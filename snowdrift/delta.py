@@ -0,0 +1,217 @@
+import json
+import logging
+import threading
+import numpy as np
+from .fused import OUTPUT_PARAMS, drift_field, get_dt_hours
+from .compact import CompactField
+from .profiling import profile, profiled
+
+# Keyframe + delta storage of the drift state.
+#
+# Mobility takes a few values, and snowage and driftacc change
+# in few cells from one step to the next, so a field is kept as
+# a full keyframe every KEYFRAME steps and, for the steps in
+# between, the flat indices and values of the cells that differ
+# from the previous step (all values, no indices, if most cells
+# differ). Snow ages are predicted as the previous
+# age + dt (where snow covered), so only resets are stored.
+# Changes are found by comparing bits, NaN and -0.0 included,
+# so decoded steps are bit-identical to the encoded fields.
+# Any step is decoded by replaying the deltas from its keyframe
+# (reading on from the last decoded step when reading forward).
+#  - the 'delta' engine runs the fused kernel over two steps of
+#    state, appending each step to DeltaFields, drift is not
+#    stored but recomputed per step from mobility when read,
+#  - save_delta writes fields as an archive (compressed .npz),
+#    read_delta loads only the keyframe and deltas of a step.
+
+# steps per keyframe
+KEYFRAME = 6
+
+# Per step indexable field, stored as keyframes and deltas,
+# dtHours: the step lengths if the values are snow ages.
+class DeltaField(CompactField):
+    def __init__(self, shape, dtype, keyframe=KEYFRAME, dtHours=None):
+        CompactField.__init__(self, 0, self.decode)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.keyframe = keyframe
+        self.dtHours = dtHours
+        self.keys = []      # keyframe arrays
+        self.deltas = []    # (index, values) per step, None at keyframes,
+                            # index None if values are the full step
+        self.tail = None    # last appended step
+        self.last = None    # (step, values) last decoded
+        self.lock = threading.Lock()
+
+    # values of step i predicted from step i-1 (into out)
+    def predict(self, prev, i, out):
+        if self.dtHours is None:
+            np.copyto(out, prev)
+        else:
+            np.add(prev, self.dtHours[i], out=out)
+            np.copyto(out, prev, where=prev == -1.0)
+        return out
+
+    # append the values of the next step
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype).reshape(self.shape)
+        i = self.n
+        if i%self.keyframe == 0:
+            self.keys.append(values.copy())
+            self.deltas.append(None)
+            self.tail = values.copy()
+        else:
+            pred = self.predict(self.tail, i, np.empty(self.shape, dtype=self.dtype))
+            bits = 'u%d'%self.dtype.itemsize
+            index = np.flatnonzero(pred.view(bits) != values.view(bits))
+            index = index.astype(np.int32 if values.size < 2**31 else np.int64)
+            if index.nbytes + index.size*self.dtype.itemsize < values.nbytes:
+                self.deltas.append((index, values.reshape(-1)[index]))
+            else:
+                self.deltas.append((None, values.copy()))
+            np.copyto(self.tail, values)
+        self.n += 1
+
+    def key(self, k):
+        return self.keys[k]
+
+    def delta(self, i):
+        return self.deltas[i]
+
+    def decode(self, i):
+        with self.lock:
+            k = i - i%self.keyframe
+            if self.last is not None and k <= self.last[0] <= i:
+                j, out = self.last
+            else:
+                j, out = k, self.key(k//self.keyframe).copy()
+            prev = np.empty(self.shape, dtype=self.dtype)
+            for j in range(j + 1, i + 1):
+                np.copyto(prev, out)
+                self.predict(prev, j, out)
+                index, values = self.delta(j)
+                if index is None:
+                    np.copyto(out, values)
+                else:
+                    out.reshape(-1)[index] = values
+            self.last = (i, out)
+            return out.copy()
+
+    # stored bytes
+    def nbytes(self):
+        size = sum(k.nbytes for k in self.keys)
+        for d in self.deltas:
+            if d is not None:
+                size += d[1].nbytes + (d[0].nbytes if d[0] is not None else 0)
+        return size
+
+# values as a DeltaField, values if already one
+def as_delta(values, keyframe=KEYFRAME, dtHours=None):
+    if isinstance(values, DeltaField) and values.keyframe == keyframe and values.dtHours == dtHours:
+        return values
+    v0 = np.asarray(values[0])
+    field = DeltaField(v0.shape, v0.dtype, keyframe, dtHours)
+    for v in values:
+        field.append(v)
+    return field
+
+# Run the recursion with a FusedKernel over two steps of
+# state, returns the output fields as {param: values},
+# snowage, driftacc and mobility as DeltaField, drift
+# recomputed per step from mobility.
+def delta_recursion(kernel, snowground, snowfall, temp, wind, dtHours,
+                    snowCoverLimit, init=None, keyframe=KEYFRAME, on_step=None):
+    n = len(dtHours)
+    shape = temp[0].shape
+    dtype = temp[0].dtype
+    state = [[np.empty(shape, dtype=dtype) for _ in range(4)] for _ in range(2)]
+    fields = [DeltaField(shape, dtype, keyframe, dtHours), DeltaField(shape, dtype, keyframe),
+              DeltaField(shape, dtype, keyframe)]
+
+    for i in range(n):
+        with profile('drift step', step=i):
+            age, dacc, mi, drift = state[i%2]
+            if i == 0:
+                kernel.first(temp[0], snowground[0], wind[0], age, dacc, mi, drift, init)
+            else:
+                pAge, pDacc, pMi, pDrift = state[(i-1)%2]
+                kernel.step(dtHours[i], snowground[i], snowfall[i], temp[i], wind[i],
+                            wind[i-1], pAge, pDacc, pMi, pDrift,
+                            age, dacc, mi, drift)
+            for field, values in zip(fields, (age, dacc, mi)):
+                field.append(values)
+        if on_step is not None:
+            on_step(i, drift)
+
+    size = sum(f.nbytes() for f in fields)
+    logging.info("delta state %.1f MB, %.1f%% of full fields"%(size/1e6, 100.0*size/(3*n*temp[0].nbytes)))
+    mobility = fields[2]
+    return {
+        'snowage': fields[0],
+        'driftacc': fields[1],
+        'mobility': mobility,
+        'drift': CompactField(n, lambda i: drift_field(mobility[i], wind[i], snowground[i], snowCoverLimit,
+                                                           kernel.windLimit)),
+    }
+
+# DeltaField of an archive param, loading the
+# keyframes and deltas as they are read
+class ArchiveField(DeltaField):
+    def __init__(self, archive, param, meta):
+        DeltaField.__init__(self, meta['shape'], meta['dtype'], meta['keyframe'],
+                            meta['dtHours'] if param == 'snowage' else None)
+        self.archive = archive
+        self.param = param
+        self.n = len(meta['times'])
+
+    def key(self, k):
+        return self.archive['%s.key.%d'%(self.param, k)]
+
+    def delta(self, i):
+        index = '%s.index.%d'%(self.param, i)
+        index = self.archive[index] if index in self.archive.files else None
+        return index, self.archive['%s.values.%d'%(self.param, i)]
+
+# Save the output params of data as a keyframe + delta archive
+# (compressed .npz, read with read_delta), lats/lons optional
+@profiled('delta write')
+def save_delta(data, path, lats=None, lons=None, keyframe=KEYFRAME):
+    logging.info("saving delta archive %s"%path)
+    times = list(data['snowage']['times'])
+    dtHours = get_dt_hours(times)
+    arrays = {'times': np.array(times, dtype='datetime64[s]')}
+    if lats is not None:
+        arrays['lats'] = np.asarray(lats)
+        arrays['lons'] = np.asarray(lons)
+    meta = {'keyframe': keyframe, 'dtHours': dtHours, 'units': {}}
+    size = 0
+    for p, unit in OUTPUT_PARAMS:
+        field = as_delta(data[p]['values'], keyframe, dtHours if p == 'snowage' else None)
+        for k, key in enumerate(field.keys):
+            arrays['%s.key.%d'%(p, k)] = key
+        for i, d in enumerate(field.deltas):
+            if d is not None:
+                if d[0] is not None:
+                    arrays['%s.index.%d'%(p, i)] = d[0]
+                arrays['%s.values.%d'%(p, i)] = d[1]
+        meta.update(shape=list(field.shape), dtype=field.dtype.str)
+        meta['units'][p] = data[p].get('unit', unit)
+        size += field.nbytes()
+    if 'members' in data['temp']:
+        arrays['members'] = np.asarray(data['temp']['members'])
+    arrays['meta'] = np.array(json.dumps(meta))
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    logging.info("delta archive %.1f MB before compression"%(size/1e6))
+
+# Read param from a delta archive, step i (all
+# steps if None), and the archive times
+def read_delta(path, param, i=None):
+    with np.load(path) as archive:
+        meta = json.loads(str(archive['meta']))
+        times = [t.item() for t in archive['times']]
+        meta['times'] = times
+        field = ArchiveField(archive, param, meta)
+        values = field[i] if i is not None else np.asarray(field)
+    return values, times
@@ -0,0 +1,142 @@
+import logging
+import pygrib
+import numpy as np
+from .save_grib import BUFFER_SIZE, LEVEL, set_step, set_packing
+
+# Ensemble statistics of drift model outputs.
+#
+# With collectData(..., ensemble=True) each step holds all
+# members as a (member, ny, nx) array and the drift model runs
+# over all members at once. Statistics are accumulated member
+# by member as each step is computed (EnsembleSteps, passed as
+# snowdrift(..., on_step=...)), so the outputs are not read
+# again and only the sums and counts of one step are held on
+# top of the per step results.
+
+# drift exceedance thresholds, drift plot scale categories
+DRIFT_THRESHOLDS = (0.09, 0.2, 0.5)
+
+# snow free cells of drift (and snowage) fields
+SNOW_FREE = -1.0
+
+# GRIB parameters of the ensemble statistics,
+# mean, then exceedance probabilities in threshold order
+MEAN_PARAMETER = 149
+PROBABILITY_PARAMETER = 150
+
+# Running mean and exceedance probabilities over members,
+# the mean is over the members where the cell is not missing
+# (snow free, None if no values are), missing where it is in
+# all members
+class EnsembleStats:
+    def __init__(self, shape, thresholds=DRIFT_THRESHOLDS, missing=SNOW_FREE):
+        self.thresholds = thresholds
+        self.missing = missing
+        self.n = 0
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.covered = np.zeros(shape, dtype=np.uint16)
+        self.count = np.zeros((len(thresholds),)+tuple(shape), dtype=np.uint16)
+        self.mask = np.empty(shape, dtype=bool)
+
+    # add one member's field
+    def add(self, v):
+        if self.missing is None:
+            self.mask[...] = True
+        else:
+            np.not_equal(v, self.missing, out=self.mask)
+        np.add(self.sum, v, out=self.sum, where=self.mask)
+        self.covered += self.mask
+        for k, threshold in enumerate(self.thresholds):
+            np.greater_equal(v, threshold, out=self.mask)
+            self.count[k] += self.mask
+        self.n += 1
+
+    def mean(self, dtype=np.float32):
+        out = np.full(self.sum.shape, np.nan if self.missing is None else self.missing, dtype=dtype)
+        np.divide(self.sum, self.covered, out=out, where=self.covered > 0, casting='unsafe')
+        return out
+
+    # fraction of members with values >= thresholds[k]
+    def probability(self, k, dtype=np.float32):
+        return (self.count[k]/self.n).astype(dtype)
+
+# Per step ensemble statistics, step i's (member, ...) field
+# added with add_step(i, values) (or called as on_step), steps
+# in order
+class EnsembleSteps:
+    def __init__(self, thresholds=DRIFT_THRESHOLDS, missing=SNOW_FREE):
+        self.thresholds = thresholds
+        self.missing = missing
+        self.means = []
+        self.probs = []
+
+    def add_step(self, i, values):
+        if i != len(self.means):
+            raise ValueError("ensemble step %d added after %d steps"%(i, len(self.means)))
+        acc = EnsembleStats(values.shape[1:], self.thresholds, self.missing)
+        for k in range(len(values)):
+            acc.add(values[k])
+        self.means.append(acc.mean(values.dtype))
+        self.probs.append([acc.probability(k, values.dtype) for k in range(len(self.thresholds))])
+
+    __call__ = add_step
+
+    # data entries '<param>-mean' and '<param>-prob-<threshold>'
+    # (in threshold order) of the steps at times
+    def stats(self, times, param='drift', unit=''):
+        times = list(times)
+        if len(times) != len(self.means):
+            raise ValueError("%d times for %d ensemble steps"%(len(times), len(self.means)))
+        stats = {'%s-mean'%param: {'times': times, 'values': np.asarray(self.means), 'unit': unit}}
+        for k, threshold in enumerate(self.thresholds):
+            stats['%s-prob-%g'%(param, threshold)] = {'times': list(times), 'unit': '',
+                                                      'values': np.asarray([p[k] for p in self.probs])}
+        return stats
+
+# Ensemble mean and exceedance probabilities of param, per
+# step, from the outputs of a run (see EnsembleSteps),
+# missing: value of snow free cells (None if none)
+def ensemble_stats(data, param='drift', thresholds=DRIFT_THRESHOLDS, missing=SNOW_FREE):
+    logging.info("calculating ensemble statistics of %r"%param)
+    entry = data[param]
+    steps = EnsembleSteps(thresholds, missing)
+    for i, values in enumerate(entry['values']):
+        steps.add_step(i, np.asarray(values))
+    return steps.stats(entry['times'], param, entry['unit'])
+
+# GRIB template of ensemble statistics, a copy of a member's
+# template_msg with the member number reset and, where the
+# keys exist (ECMWF local definition), the ensemble size and
+# MARS type of derived products set
+def derived_template(template_msg, members=None):
+    msg = pygrib.fromstring(template_msg.tostring())
+    if msg.has_key('perturbationNumber'):
+        msg['perturbationNumber'] = 0
+    if members is not None and msg.has_key('numberOfForecastsInEnsemble'):
+        msg['numberOfForecastsInEnsemble'] = len(members)
+    return msg
+
+# Save ensemble_stats results to a grib file, as save_grib,
+# mean as MEAN_PARAMETER, probabilities as PROBABILITY_PARAMETER,
+# PROBABILITY_PARAMETER+1, ..., members: the ensemble members,
+# at the packing and precision of template_msg
+def save_ensemble_stats(stats, filename, template_msg, members=None):
+    msg = derived_template(template_msg, members)
+    packing = msg['packingType']
+    bitsPerValue = msg['bitsPerValue']
+    names = list(stats)
+    times = stats[names[0]]['times']
+    with open(filename, 'wb', buffering=BUFFER_SIZE) as out:
+        for i, t in enumerate(times):
+            for k, name in enumerate(names):
+                logging.info("writing %s step %d"%(name, i))
+                if msg.has_key('marsType'):
+                    # ensemble mean, event probability
+                    msg['marsType'] = 'em' if k == 0 else 'ep'
+                msg.level = LEVEL
+                msg['indicatorOfParameter'] = MEAN_PARAMETER if k == 0 else PROBABILITY_PARAMETER + k - 1
+                set_step(msg, t)
+                # constant fields (no exceedance) drop the precision
+                set_packing(msg, packing, bitsPerValue)
+                msg['values'] = stats[name]['values'][i]
+                out.write(msg.tostring())
@@ -0,0 +1,189 @@
+import numpy as np
+from .profiling import profile
+
+# Fused drift engine.
+#
+# Same rules as the per-step functions in snowdrift.py
+# (calculate_snow_cover_age, calculate_drift_accumulation,
+#  calculate_mobility_index and calculate_drift), but each
+# output field is one preallocated (time, ny, nx) array and
+# every step is computed in a single pass with in-place ufuncs
+# and reused mask buffers. Results are bit-identical to the
+# per-step functions.
+
+# default model thresholds, drift accumulates when the previous
+# step wind exceeds DRIFT_WIND_LIMIT (m/s) and no drift below it,
+# mobility drops from 1.0 to 0.6 at snow age MOBILITY_AGE_LIMIT
+# (hours), and to 0.6/0.3 at drift accumulation DRIFT_ACC_LIMITS
+DRIFT_WIND_LIMIT = 6.0
+MOBILITY_AGE_LIMIT = 24
+DRIFT_ACC_LIMITS = (2.0, 6.0)
+
+# output parameters and their units
+OUTPUT_PARAMS = (
+    ('snowage', 'hours'),
+    ('driftacc', ''),
+    ('mobility', ''),
+    ('drift', ''),
+)
+
+# Holds the reusable mask buffers for one grid (or tile) shape,
+# and advances the drift state by one step.
+# The thresholds are scalars, or arrays broadcastable to the
+# state shape, e.g. (P, 1, 1) for P threshold sets on a leading
+# axis of the state fields (sweep.py), inputs are broadcast.
+class FusedKernel:
+    def __init__(self, shape, snowCoverLimit, snowFallLimit, windLimit=DRIFT_WIND_LIMIT,
+                 ageLimit=MOBILITY_AGE_LIMIT, daccLow=DRIFT_ACC_LIMITS[0], daccHigh=DRIFT_ACC_LIMITS[1]):
+        self.shape = tuple(shape)
+        self.snowCoverLimit = snowCoverLimit
+        self.snowFallLimit = snowFallLimit
+        self.windLimit = windLimit
+        self.ageLimit = ageLimit
+        self.daccLow = daccLow
+        self.daccHigh = daccHigh
+        self.isc = np.empty(shape, dtype=bool)   # snow covered
+        self.nsc = np.empty(shape, dtype=bool)   # not snow covered
+        self.new = np.empty(shape, dtype=bool)   # new snow
+        self.m1 = np.empty(shape, dtype=bool)    # scratch masks
+        self.m2 = np.empty(shape, dtype=bool)
+        self.wind3 = None                        # wind**3 of broadcast inputs
+
+    # first step, cold start from zeros,
+    # temp0 is the step 0 temperature, only used as
+    # template for the zeroed fields (as new_array does),
+    # or warm start from init state (see state.py)
+    def first(self, temp0, snowground, wind, age, dacc, mi, drift, init=None):
+        isc = np.greater(snowground, self.snowCoverLimit, out=self.isc)
+        nsc = np.logical_not(isc, out=self.nsc)
+
+        if init is None:
+            # age, -1 init and 0 where snow covered
+            np.multiply(temp0, 0.0, out=age)
+            np.subtract(age, 1.0, out=age)
+            np.copyto(age, 0.0, where=isc)
+
+            # drift accumulation and mobility, zeros
+            np.multiply(temp0, 0.0, out=dacc)
+            np.multiply(temp0, 0.0, out=mi)
+        else:
+            # age from state, 0 where newly snow covered
+            np.multiply(temp0, 0.0, out=age)
+            np.add(age, init['snowage'], out=age)
+            np.less(age, 0.0, out=self.m1)
+            np.logical_and(self.m1, isc, out=self.m1)
+            np.copyto(age, 0.0, where=self.m1)
+            np.copyto(age, -1.0, where=nsc)
+
+            np.multiply(temp0, 0.0, out=dacc)
+            np.add(dacc, init['driftacc'], out=dacc)
+            np.multiply(temp0, 0.0, out=mi)
+            np.add(mi, init['mobility'], out=mi)
+            np.copyto(mi, 0.0, where=nsc)
+
+        self.drift(wind, mi, drift)
+
+    # step i > 0, from the previous step state
+    def step(self, dtHours, snowground, snowfall, temp, wind,
+             pWind, pAge, pDacc, pMi, pDrift,
+             age, dacc, mi, drift):
+        isc = np.greater(snowground, self.snowCoverLimit, out=self.isc)
+        nsc = np.logical_not(isc, out=self.nsc)
+        new = np.greater(snowfall, self.snowFallLimit, out=self.new)
+        m1 = self.m1
+        m2 = self.m2
+
+        # snow age,
+        np.add(pAge, dtHours, out=age)
+        np.copyto(age, 0.0, where=new)
+        np.copyto(age, -1.0, where=nsc)
+
+        # drift accumulation, when previous wind > windLimit
+        np.copyto(dacc, pDacc)
+        np.greater(pWind, self.windLimit, out=m1)
+        np.add(pDacc, pDrift, out=dacc, where=m1)
+        np.copyto(dacc, 0.0, where=new)
+
+        # mobility index,
+        np.copyto(mi, pMi)
+        np.copyto(mi, 1.0, where=new)
+        np.equal(mi, 1.0, out=m1)
+        np.greater_equal(age, self.ageLimit, out=m2)
+        np.logical_and(m1, m2, out=m1)
+        np.copyto(mi, 0.6, where=m1)
+        np.greater_equal(dacc, self.daccLow, out=m1)
+        np.copyto(mi, 0.6, where=m1)
+        np.greater(dacc, self.daccHigh, out=m1)
+        np.copyto(mi, 0.3, where=m1)
+        np.greater(temp, 0.0, out=m1)
+        np.copyto(mi, 0.0, where=m1)
+        np.copyto(mi, 0.0, where=nsc)
+
+        self.drift(wind, mi, drift)
+
+    # drift value, expects isc/nsc masks of this step
+    def drift(self, wind, mi, d):
+        if np.shape(wind) == d.shape:
+            np.power(wind, 3.0, out=d)
+            np.multiply(mi, d, out=d)
+        else:
+            # broadcast inputs, wind**3 once
+            if self.wind3 is None or self.wind3.shape != np.shape(wind):
+                self.wind3 = np.empty(np.shape(wind), dtype=d.dtype)
+            np.power(wind, 3.0, out=self.wind3)
+            np.multiply(mi, self.wind3, out=d)
+        np.divide(d, 1728.0, out=d)
+        np.less(wind, self.windLimit, out=self.m1)
+        np.copyto(d, 0.0, where=self.m1)
+        np.copyto(d, -1.0, where=self.nsc)
+
+# drift of a step from its mobility and inputs,
+# as FusedKernel.drift (for engines that don't store drift)
+def drift_field(mi, wind, snowground, snowCoverLimit, windLimit=DRIFT_WIND_LIMIT):
+    d = np.power(wind, 3.0)
+    np.multiply(mi, d, out=d)
+    np.divide(d, 1728.0, out=d)
+    np.copyto(d, 0.0, where=wind < windLimit)
+    np.copyto(d, -1.0, where=~(snowground > snowCoverLimit))
+    return d
+
+# time step lengths in hours, dtHours[0] is unused (0.0)
+def get_dt_hours(times):
+    dt = [0.0]
+    for i in range(1, len(times)):
+        dt.append((times[i] - times[i-1]).total_seconds()/3600.0)
+    return dt
+
+# state params used to warm start step 0
+INIT_PARAMS = ('snowage', 'driftacc', 'mobility')
+
+# rows r0:r1 of an init state (or None)
+def slice_init(init, r0, r1):
+    if init is None:
+        return None
+    return {p: init[p][r0:r1] for p in INIT_PARAMS}
+
+# allocate output fields as (time, *shape) arrays
+def new_outputs(n, shape, dtype=np.float32):
+    return {p: np.empty((n,)+tuple(shape), dtype=dtype) for p, _ in OUTPUT_PARAMS}
+
+# Run the full time recursion with the given kernel.
+# Inputs are indexable per step (lists or stacked arrays),
+# outputs are preallocated (time, ...) arrays, init is an
+# optional warm start state for step 0, on_step(i, drift) is
+# called as each step is done.
+def fused_recursion(kernel, snowground, snowfall, temp, wind, dtHours,
+                    snowage, driftacc, mobility, drift, init=None, on_step=None):
+    n = len(dtHours)
+    with profile('drift step', step=0):
+        kernel.first(temp[0], snowground[0], wind[0],
+                     snowage[0], driftacc[0], mobility[0], drift[0], init)
+    if on_step is not None:
+        on_step(0, drift[0])
+    for i in range(1, n):
+        with profile('drift step', step=i):
+            kernel.step(dtHours[i], snowground[i], snowfall[i], temp[i], wind[i],
+                        wind[i-1], snowage[i-1], driftacc[i-1], mobility[i-1], drift[i-1],
+                        snowage[i], driftacc[i], mobility[i], drift[i])
+        if on_step is not None:
+            on_step(i, drift[i])
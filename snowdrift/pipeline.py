@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pygrib
+from .collect_data import config, valid_time, _read_file_worker
+from .save_grib import BUFFER_SIZE, write_step
+from .stream import DriftStream
+from .plot import write_png
+from .save_zarr import ZarrWriter
+from .profiling import profile
+from .pools import process_pool
+
+# Pipelined drift model run.
+#
+# Runs a DriftStream over forecast files (one step per file,
+# sorted by valid time) as three stages linked by bounded queues:
+#  - read:    decodes steps i+1.. in worker processes,
+#  - compute: advances the drift recursion to step i,
+#  - write:   encodes and writes the GRIB messages and/or
+#             PNG images of step i-1.
+# Stages overlap, so the run takes about as long as its
+# slowest stage rather than the sum of all three. Queues hold
+# at most queue_size steps, bounding memory as in the stream.
+#
+# Other sources and outputs can be plugged in, reader(f) runs
+# in a thread and returns read_file results for f, writer(stream,
+# i, t, state) is called per step in the write stage.
+
+# end of stage marker
+DONE = None
+
+# decode files, up to queue_size ahead of the compute stage
+async def read_stage(loop, pool, read, files, queue, queue_size):
+    pending = deque()
+    for i, f in enumerate(files):
+        pending.append((f, loop.run_in_executor(pool, read, f, i == 0)))
+        if len(pending) > queue_size:
+            f, fut = pending.popleft()
+            await queue.put((f,) + await fut)
+    while pending:
+        f, fut = pending.popleft()
+        await queue.put((f,) + await fut)
+    await queue.put(DONE)
+
+# files in valid time order, from the first message
+# header of each file (values are not decoded)
+def time_order(files):
+    def first_time(f):
+        with pygrib.open(f) as grbs:
+            return valid_time(grbs.message(1))
+    return sorted(files, key=first_time)
+
+# read_file results of f in a worker process, with
+# the template message as bytes if template
+def read_step(f, template, config=config):
+    return _read_file_worker(f, config, template)
+
+# advance the stream, passes a copy of each step's state on
+# (stream state arrays are overwritten two steps later)
+async def compute_stage(loop, pool, stream, queue, out):
+    while True:
+        item = await queue.get()
+        if item is DONE:
+            break
+        f, records, template = item
+        if isinstance(template, bytes):
+            template = pygrib.fromstring(template)
+        i, t, state = await loop.run_in_executor(pool, stream.push_records, f, records, template)
+        await out.put((i, t, {p: v.copy() for p, v in state.items()}))
+    await out.put(DONE)
+
+# write steps to the open GRIB file out and/or PNG images
+def write_outputs(stream, i, t, state, out, save):
+    if out is not None:
+        with profile('grib write', step=i):
+            write_step(out, stream.templateMsg, i, t, state, stream.bitsPerValue, packing=stream.packing)
+            out.flush()
+    if save is not None:
+        with profile('png write', step=i):
+            for p, v in state.items():
+                write_png(v, i, p, save)
+
+# write steps to a Zarr store at path, created at the
+# first step, on the grid of the stream's template
+class ZarrSteps:
+    def __init__(self, path):
+        self.path = path
+        self.store = None
+
+    def __call__(self, stream, i, t, state):
+        if self.store is None:
+            self.store = ZarrWriter(self.path, *stream.templateMsg.latlons())
+        self.store.write_step(i, t, state)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+async def write_stage(loop, pool, stream, queue, write):
+    while True:
+        item = await queue.get()
+        if item is DONE:
+            break
+        i, t, state = item
+        await loop.run_in_executor(pool, write, stream, i, t, state)
+
+async def run_pipeline(files, out=None, save=None, templateMsg=None, config=config,
+                       init=None, queue_size=2, workers=2, reader=None, writer=None,
+                       packing=None, bitsPerValue=None):
+    logging.info("running pipeline over %d files"%len(files))
+    loop = asyncio.get_running_loop()
+    stream = DriftStream(templateMsg=templateMsg, config=config, init=init,
+                         packing=packing, bitsPerValue=bitsPerValue)
+    decoded = asyncio.Queue(queue_size)
+    computed = asyncio.Queue(queue_size)
+    if reader is None:
+        files = time_order(files)
+        readers = process_pool(workers)
+        read = functools.partial(read_step, config=config)
+    else:
+        readers = ThreadPoolExecutor(workers)
+        read = lambda f, template: reader(f)
+    if writer is None:
+        writer = lambda stream, i, t, state: write_outputs(stream, i, t, state, out, save)
+    # one thread each, stages run in order internally
+    with readers, ThreadPoolExecutor(1) as computing, ThreadPoolExecutor(1) as writing:
+        await asyncio.gather(
+            read_stage(loop, readers, read, files, decoded, queue_size),
+            compute_stage(loop, computing, stream, decoded, computed),
+            write_stage(loop, writing, stream, computed, writer))
+    return stream
+
+# Run the drift model pipelined over files, writing GRIB
+# messages to filename and/or PNG images with prefix save,
+# or a Zarr store at zarr, returns the DriftStream
+def pipeline(files, filename=None, save=None, zarr=None, **kwargs):
+    if zarr is not None:
+        writer = ZarrSteps(zarr)
+        stream = asyncio.run(run_pipeline(files, writer=writer, **kwargs))
+        writer.close()
+        return stream
+    if filename is None:
+        return asyncio.run(run_pipeline(files, save=save, **kwargs))
+    logging.info("saving grib file %s"%filename)
+    with open(filename, 'wb', buffering=BUFFER_SIZE) as out:
+        return asyncio.run(run_pipeline(files, out=out, save=save, **kwargs))
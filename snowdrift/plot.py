@@ -1,6 +1,12 @@
+import os
+import logging
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from trollimage.image import Image as TImage
 from trollimage.colormap import rdbu, Colormap
-from PIL import ImageColor
+from PIL import ImageColor, Image as PILImage
+from .profiling import profiled
 
 # create trollimage scale def
 def parseScaleDef(sdef):
@@ -55,20 +61,87 @@ driftScale = (
     (0.5, '#d00'),
 )
 
+scales = {
+    'snowage': snowageScale,
+    'driftacc': driftaccScale,
+    'mobility': mobilityScale,
+    'drift': driftScale,
+}
+
+# colormaps of the fixed scales are built once
+@lru_cache(maxsize=None)
+def getScaleCM(param):
+    return Colormap(*parseScaleDef(scales[param]))
+
 def getCM(param, vals):
-    if param == 'snowage':
-        return Colormap(*parseScaleDef(snowageScale))
-    elif param == 'driftacc':
-        return Colormap(*parseScaleDef(driftaccScale))
-    elif param == 'mobility':
-        return Colormap(*parseScaleDef(mobilityScale))
-    elif param == 'drift':
-        return Colormap(*parseScaleDef(driftScale))
+    if param in scales:
+        return getScaleCM(param)
     else:
         cm = Colormap(*parseScaleDef(defaultScale))
         cm.set_range(vals.min(), vals.max())
         return cm
 
+# Lookup tables for palettizing with colormap cm,
+# the colormap values (bin edges) and uint8 RGB palette,
+# colors rounded to 8 bit as trollimage does
+def getPaletteLUT(cm):
+    values = np.asarray(cm.values, dtype=np.float64)
+    if len(values) > 256 or (np.diff(values) < 0).any():
+        raise ValueError("palette needs at most 256 increasing colormap values")
+    palette = np.round(np.clip(cm.colors[:, :3], 0, 1)*255).astype(np.uint8)
+    return values, palette
+
+@lru_cache(maxsize=None)
+def getScaleLUT(param):
+    return getPaletteLUT(getScaleCM(param))
+
+# uint8 palette indices of vals, same binning as trollimage
+# palettize, values below the first bin and nan clipped to the ends
+def palettizeLUT(vals, values):
+    idx = np.searchsorted(values, vals, side='right')
+    idx -= 1
+    np.clip(idx, 0, len(values) - 1, out=idx)
+    return idx.astype(np.uint8)
+
+# write step i of param as a palette PNG image
+def save_png(data, i, param, save):
+    return write_png(data[param]['values'][i], i, param, save)
+
+# write a field as palette PNG image of param at step i
+def write_png(vals, i, param, save):
+    vals = vals[::-1,:]
+    if param in scales:
+        values, palette = getScaleLUT(param)
+    else:
+        values, palette = getPaletteLUT(getCM(param, vals))
+
+    img = PILImage.fromarray(palettizeLUT(vals, values), mode='P')
+    img.putpalette(palette.tobytes())
+
+    filename = "%s_%s_%03d.png"%(save, param, i)
+    img.save(filename)
+    return filename
+
+# Batch PNG renderer, writes all steps of params
+# (the snowdrift parameters by default) as palette images,
+# over a pool of N worker threads, as save_<param>_<step>.png
+@profiled('png write')
+def plot_all(data, params=None, save=None, workers=None):
+    if not save:
+        raise ValueError("plot_all needs a filename prefix to save images as")
+    if params is None:
+        params = list(scales)
+    dirname = os.path.dirname(save)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    n = len(data[params[0]]['times'])
+    jobs = [(i, p) for i in range(n) for p in params]
+    with ThreadPoolExecutor(workers or 1) as pool:
+        for filename in pool.map(lambda job: save_png(data, job[0], job[1], save), jobs):
+            logging.debug("wrote %r"%filename)
+    return len(jobs)
+
 
 # Test plotter, plots and shows parameter at step i
 # If save is provided, save to file instead
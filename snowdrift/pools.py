@@ -0,0 +1,22 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Worker process pools.
+#
+# Decoding, tiled runs and GRIB encoding run over process pools,
+# also from threads (serve jobs, pipeline stages). Forking a
+# process while other threads hold locks (logging, I/O buffers)
+# can deadlock the children, so workers are started from a fork
+# server (spawned where there is none), with snowdrift preloaded.
+# Scripts starting pools need an `if __name__ == '__main__'` guard.
+
+def mp_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['snowdrift'])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+# ProcessPoolExecutor of workers processes, see mp_context
+def process_pool(workers, **kwargs):
+    return ProcessPoolExecutor(workers, mp_context=mp_context(), **kwargs)
@@ -0,0 +1,182 @@
+import sys
+import json
+import time
+import resource
+import functools
+import threading
+import contextlib
+
+# Pipeline instrumentation.
+#
+# Stages (load, deps, drift steps, step functions, GRIB and
+# PNG writes) are wrapped with profile() or @profiled. When
+# profiling is off these are a single global check, when on
+# (enable_profiling) each stage records wall time, CPU time,
+# bytes read/written and peak memory, and is passed to any
+# registered hooks, e.g. to forward metrics to monitoring.
+# The process peak RSS is reset as each stage starts (linux), and
+# folded into the peaks of all open stages first, so a stage's
+# peak_rss is its own, nested and concurrent stages included.
+
+# active profiler, None when profiling is off
+_profiler = None
+
+# peak resident set size of the process in bytes
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss*1024
+
+# reset peak RSS, where supported (linux)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# bytes read and written by the process, (None, None) if unknown
+def io_bytes():
+    try:
+        counters = {}
+        with open('/proc/self/io') as f:
+            for line in f:
+                k, v = line.split(':')
+                counters[k] = int(v)
+        return counters['rchar'], counters['wchar']
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+class Profiler:
+    def __init__(self):
+        self.records = []
+        self.hooks = []
+        # open stage names, per thread
+        self.local = threading.local()
+        # peak RSS of open stages, and of the whole run
+        self.peaks = {}
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    # register hook(record), called when each stage ends
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    # fold the peak RSS since the last reset into open stages
+    def fold_peak(self):
+        rss = peak_rss()
+        with self.lock:
+            for stage, peak in self.peaks.items():
+                self.peaks[stage] = max(peak, rss)
+            self.peak = max(self.peak, rss)
+
+    # open stage names of the calling thread, concurrent
+    # stages (pipeline, serve) nest in their own thread
+    def thread_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        stack = self.thread_stack()
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        self.fold_peak()
+        reset_peak_rss()
+        stage = object()
+        with self.lock:
+            self.peaks[stage] = 0
+        read0, written0 = io_bytes()
+        start = time.time()
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        try:
+            yield
+        finally:
+            c1 = time.process_time()
+            t1 = time.perf_counter()
+            read1, written1 = io_bytes()
+            self.fold_peak()
+            with self.lock:
+                peak = self.peaks.pop(stage)
+            stack.pop()
+            record = {
+                'name': name,
+                'parent': parent,
+                'start': start,
+                'wall': t1 - t0,
+                'cpu': c1 - c0,
+                'read_bytes': None if read0 is None else read1 - read0,
+                'written_bytes': None if written0 is None else written1 - written0,
+                'peak_rss': peak,
+            }
+            record.update(info)
+            self.records.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    # per stage name totals
+    def totals(self):
+        totals = {}
+        for r in self.records:
+            t = totals.setdefault(r['name'], {'count': 0, 'wall': 0.0, 'cpu': 0.0,
+                                              'read_bytes': 0, 'written_bytes': 0})
+            t['count'] += 1
+            t['wall'] += r['wall']
+            t['cpu'] += r['cpu']
+            t['read_bytes'] += r['read_bytes'] or 0
+            t['written_bytes'] += r['written_bytes'] or 0
+        return totals
+
+    def report(self):
+        return {
+            'peak_rss': max(self.peak, peak_rss()),
+            'totals': self.totals(),
+            'stages': self.records,
+        }
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+# turn profiling on, returns the active profiler
+def enable_profiling(profiler=None):
+    global _profiler
+    _profiler = profiler if profiler is not None else Profiler()
+    return _profiler
+
+def disable_profiling():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def get_profiler():
+    return _profiler
+
+_null = contextlib.nullcontext()
+
+# context manager timing a stage, no-op when profiling is off
+def profile(name, **info):
+    if _profiler is None:
+        return _null
+    return _profiler.stage(name, **info)
+
+# decorator timing each call of a function as a stage
+def profiled(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _profiler.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,220 @@
+import csv
+import hashlib
+import logging
+import pygrib
+import numpy as np
+
+# Sub-domain selection at load time.
+#
+# A Region is a lat/lon bounding box, a list of points or a list
+# of road polylines. For each grid geometry (GRIB grid section)
+# the grid indices of the region are computed once and cached,
+# and decoded fields are cut down to those cells straight away:
+#  - bbox: the smallest (ny, nx) index space crop holding it,
+#  - points/roads: the nearest grid cells, as a 1-D vector
+#    (roads are sampled at half the grid spacing).
+# The drift model then runs on the selected cells only, results
+# can be written as point time series (save_points).
+
+# bbox edge tolerance in degrees, grid coordinates computed from
+# the first point and increment are not exact (69.7 as 69.69999...)
+BBOX_TOLERANCE = 1e-6
+
+class Region:
+    # bbox: (lat0, lat1, lon0, lon1)
+    # points: [(name, lat, lon), ...]
+    # roads: [(name, [(lat, lon), ...]), ...]
+    def __init__(self, bbox=None, points=None, roads=None):
+        if (bbox is None) == (points is None and roads is None):
+            raise ValueError("region needs either a bbox or points/roads")
+        self.bbox = tuple(bbox) if bbox is not None else None
+        self.points = [tuple(p) for p in points or []]
+        self.roads = [(name, [tuple(p) for p in line]) for name, line in roads or []]
+        self.selections = {}
+
+    # identity of the region, for cache keys
+    def key(self):
+        s = repr((self.bbox, self.points, self.roads))
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    # Selection of a message's grid, computed once per grid
+    def selection(self, msg):
+        grid = grid_key(msg)
+        sel = self.selections.get(grid)
+        if sel is None:
+            lats, lons = msg.latlons()
+            if self.bbox is not None:
+                sel = select_bbox(lats, lons, self.bbox)
+            else:
+                sel = select_points(lats, lons, self.points, self.roads)
+            logging.info("region selects %d of %d grid cells"%(sel.size, lats.size))
+            self.selections[grid] = sel
+        return sel
+
+    # selected cells of a decoded message field
+    def extract(self, msg, vals):
+        return self.selection(msg).extract(vals)
+
+# identity of a message's grid geometry
+def grid_key(msg):
+    try:
+        return msg['md5GridSection']
+    except (KeyError, RuntimeError):
+        return (msg['gridType'], msg['Ni'], msg['Nj'],
+                msg['latitudeOfFirstGridPointInDegrees'], msg['longitudeOfFirstGridPointInDegrees'])
+
+# Selected grid cells, either a crop (slices) or a 1-D
+# vector of flat indices, with cell lat/lon and names
+class Selection:
+    def __init__(self, lats, lons, crop=None, index=None, names=None):
+        self.crop = crop
+        self.index = index
+        self.names = names
+        if crop is not None:
+            self.lats = lats[crop]
+            self.lons = lons[crop]
+        else:
+            self.lats = lats.ravel()[index]
+            self.lons = lons.ravel()[index]
+        self.shape = self.lats.shape
+        self.size = self.lats.size
+
+    # copy of the selected cells of a full grid field
+    def extract(self, vals):
+        if self.crop is not None:
+            return vals[self.crop].copy()
+        return vals.reshape(-1)[self.index]
+
+# signed longitude difference, in [-180, 180)
+def lon_diff(lons, lon):
+    return (lons - lon + 180.0) % 360.0 - 180.0
+
+# index space crop covering the cells inside bbox
+def select_bbox(lats, lons, bbox):
+    lat0, lat1, lon0, lon1 = bbox
+    tol = BBOX_TOLERANCE
+    dlon = lon_diff(lons, lon0 - tol)
+    inside = (lats >= lat0 - tol) & (lats <= lat1 + tol) & \
+             (dlon >= 0) & (dlon <= (lon1 - lon0) % 360.0 + 2*tol)
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    if len(rows) == 0:
+        raise ValueError("bbox %r is outside the forecast grid"%(bbox,))
+    crop = (slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1))
+    return Selection(lats, lons, crop=crop)
+
+# flat index of the grid cell nearest to lat/lon
+def nearest(lats, lons, lat, lon):
+    d = lon_diff(lons, lon)*np.cos(np.radians(lat))
+    d *= d
+    d += (lats - lat)**2
+    return int(np.argmin(d))
+
+# approximate grid spacing in degrees latitude
+def grid_spacing(lats, lons):
+    ny, nx = lats.shape
+    j, i = ny//2, nx//2
+    dx = np.hypot(lats[j, i+1] - lats[j, i], lon_diff(lons[j, i+1], lons[j, i])*np.cos(np.radians(lats[j, i])))
+    dy = np.hypot(lats[j+1, i] - lats[j, i], lon_diff(lons[j+1, i], lons[j, i])*np.cos(np.radians(lats[j, i])))
+    return min(dx, dy)
+
+# nearest cells of points, then of roads sampled at
+# half the grid spacing (consecutive duplicates dropped)
+def select_points(lats, lons, points, roads):
+    index = []
+    names = []
+    for name, lat, lon in points:
+        index.append(nearest(lats, lons, lat, lon))
+        names.append(name)
+
+    step = grid_spacing(lats, lons)/2.0
+    for name, line in roads:
+        cells = []
+        for (lat0, lon0), (lat1, lon1) in zip(line[:-1], line[1:]):
+            dist = np.hypot(lat1 - lat0, lon_diff(lon1, lon0)*np.cos(np.radians(lat0)))
+            n = max(1, int(np.ceil(dist/step)))
+            for f in np.linspace(0.0, 1.0, n + 1):
+                k = nearest(lats, lons, lat0 + f*(lat1 - lat0), lon0 + f*lon_diff(lon1, lon0))
+                if not cells or cells[-1] != k:
+                    cells.append(k)
+        if len(line) == 1:
+            cells.append(nearest(lats, lons, *line[0]))
+        index.extend(cells)
+        names.extend([name]*len(cells))
+    return Selection(lats, lons, index=np.asarray(index, dtype=np.intp), names=names)
+
+# read points from a CSV file of name,lat,lon rows
+def read_points(filename):
+    with open(filename, newline='') as f:
+        return [(row[0], float(row[1]), float(row[2]))
+                for row in csv.reader(f) if row and not row[0].startswith('#')]
+
+# read road polylines from a CSV file of name,lat,lon rows,
+# consecutive rows of the same name form a polyline
+def read_roads(filename):
+    roads = []
+    for name, lat, lon in read_points(filename):
+        if not roads or roads[-1][0] != name:
+            roads.append((name, []))
+        roads[-1][1].append((lat, lon))
+    return roads
+
+# Template message for writing cropped fields, a copy of
+# msg with its grid cut down to a bbox selection and its
+# values cropped (constant values would drop the precision)
+def crop_template(msg, sel):
+    if sel.crop is None:
+        raise ValueError("GRIB output needs a bbox region, not points")
+    msg = pygrib.fromstring(msg.tostring())
+    values = np.asarray(msg.values)[sel.crop]
+    ny, nx = sel.shape
+    msg['Ni'] = nx
+    msg['Nj'] = ny
+    msg['latitudeOfFirstGridPointInDegrees'] = float(sel.lats[0, 0])
+    msg['longitudeOfFirstGridPointInDegrees'] = float(sel.lons[0, 0])
+    if msg.has_key('latitudeOfLastGridPointInDegrees'):
+        msg['latitudeOfLastGridPointInDegrees'] = float(sel.lats[-1, -1])
+        msg['longitudeOfLastGridPointInDegrees'] = float(sel.lons[-1, -1])
+    msg['values'] = values
+    return msg
+
+# Write point time series of params to CSV, or Parquet
+# (needs pyarrow) if filename ends with .parquet. One row per
+# step, member (ensembles) and selected cell.
+def save_points(data, filename, sel, params=('snowage', 'driftacc', 'mobility', 'drift')):
+    logging.info("writing point time series to %r"%filename)
+    times = data[params[0]]['times']
+    members = data[params[0]].get('members')
+    cells = sel.size
+    names = sel.names if sel.names is not None else \
+        ["%d,%d"%(j, i) for j in range(sel.shape[0]) for i in range(sel.shape[1])]
+    lats = np.round(sel.lats.reshape(-1), 6)
+    lons = np.round(sel.lons.reshape(-1), 6)
+
+    columns = {'time': [], 'name': [], 'lat': [], 'lon': []}
+    if members is not None:
+        columns['member'] = []
+    for p in params:
+        columns[p] = []
+    for i, t in enumerate(times):
+        steps = {p: np.asarray(data[p]['values'][i]) for p in params}
+        for k, m in enumerate(members or [None]):
+            columns['time'].extend([t.isoformat()]*cells)
+            columns['name'].extend(names)
+            columns['lat'].extend(lats.tolist())
+            columns['lon'].extend(lons.tolist())
+            if m is not None:
+                columns['member'].extend([m]*cells)
+            for p in params:
+                v = steps[p] if m is None else steps[p][k]
+                columns[p].extend(v.reshape(-1).tolist())
+
+    if filename.endswith('.parquet'):
+        import pyarrow
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(pyarrow.table(columns), filename)
+    else:
+        with open(filename, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(list(columns))
+            w.writerows(zip(*columns.values()))
@@ -1,5 +1,10 @@
+import io
 import pygrib
 import logging
+import numpy as np
+from collections import deque
+from .profiling import profiled
+from .pools import process_pool
 
 TYPE_OF_LEVEL=105
 LEVEL=0
@@ -8,78 +13,136 @@ DRIFTACCUMULATION_PARAMETER=146
 MOBILITY_PARAMETER=147
 DRIFT_PARAMETER=148
 
+# snowdrift parameters written per step, in order
+PARAMETERS = (
+    ('drift', DRIFT_PARAMETER),
+    ('snowage', SNOWAGE_PARAMETER),
+    ('driftacc', DRIFTACCUMULATION_PARAMETER),
+    ('mobility', MOBILITY_PARAMETER),
+)
+
+# output file buffer size
+BUFFER_SIZE = 1 << 22
+
 # Saves snowdrift parameters to a new grib file,
 # appending each message.
 # Requires a template message from source forecast
 # in oreder to replace values and write in compatible
 # GRIB formatting to the source.
-def save_grib(data, filename, template_msg):
-    msg = template_msg
+#  - workers: encode messages over N processes, each with its
+#             own clone of the template, written in step order
+#  - packing: GRIB packingType, e.g. 'grid_simple' or 'grid_ccsds'
+#             (GRIB2 only), template packing if None
+#  - bitsPerValue: packing precision, template precision if None
+# Ensemble data is written per member, with perturbationNumber
+# set (the template should be an ensemble message).
+@profiled('grib write')
+def save_grib(data, filename, template_msg, workers=None, packing=None, bitsPerValue=None):
+    # clone, keys set per message are not left on the caller's template
+    msg = pygrib.fromstring(template_msg.tostring())
+    if bitsPerValue is None:
+        bitsPerValue = msg['bitsPerValue']
 
     # create file,
-    out = open(filename,'wb')
+    out = open(filename, 'wb', buffering=BUFFER_SIZE)
 
     # get handle on snowdrift parameter data
     times = data['temp']['times']
     n = len(times)
-    drift = data['drift']['values']
-    snowage = data['snowage']['values']
-    driftacc = data['driftacc']['values']
-    mobility = data['mobility']['values']
-
-    #for k in msg.keys():
-    #    print(k, msg[k])
+    members = data['temp'].get('members')
 
     # loop through snowdrift results,
     # and write GRIB msgs...
-    for i in range(n):
-        # drift
-        logging.info("writing drift step %d"%i)
-        msg.level = LEVEL
-        msg['indicatorOfParameter'] = DRIFT_PARAMETER       
-        # NOTE: Forecast time steps may need improvement
-        #       for other forecast sources like NCEP.
-        #       Keep an eye on this for later improvements if needed.
-        msg['startStep'] = i
-        msg['endStep'] = i
-        msg['values'] = drift[i]
-        out.write(msg.tostring())
+    if workers and workers > 1:
+        write_parallel(out, data, times, msg, workers, members, packing, bitsPerValue)
+    else:
+        for i in range(n):
+            write_step(out, msg, i, times[i], step_fields(data, i), bitsPerValue, members, packing)
 
-        # snowage
-        logging.info("writing snowage step %d"%i)
-        msg.level = LEVEL
-        msg['indicatorOfParameter'] = SNOWAGE_PARAMETER       
-        # NOTE: Forecast time steps may need improvement
-        #       for other forecast sources like NCEP.
-        #       Keep an eye on this for later improvements if needed.
-        msg['startStep'] = i
-        msg['endStep'] = i
-        msg['values'] = snowage[i]
-        out.write(msg.tostring())
+    out.close()
 
-        # driftacc
-        logging.info("writing driftacc step %d"%i)
-        msg.level = LEVEL
-        msg['indicatorOfParameter'] = DRIFTACCUMULATION_PARAMETER       
-        # NOTE: Forecast time steps may need improvement
-        #       for other forecast sources like NCEP.
-        #       Keep an eye on this for later improvements if needed.
-        msg['startStep'] = i
-        msg['endStep'] = i
-        msg['values'] = driftacc[i]
-        out.write(msg.tostring())
+# snowdrift parameter fields of step i
+def step_fields(data, i):
+    return {par: data[par]['values'][i] for par, _ in PARAMETERS}
+
+# yields (member, par, ioPar, values) of the messages of a
+# step, in write order, member is None if not an ensemble
+def step_messages(fields, members=None):
+    if members is None:
+        for par, ioPar in PARAMETERS:
+            yield None, par, ioPar, fields[par]
+    else:
+        for k, m in enumerate(members):
+            for par, ioPar in PARAMETERS:
+                yield m, par, ioPar, fields[par][k]
+
+# set the forecast step of valid time t, from the analysis time
+# of msg, in hours (or minutes if not whole hours)
+def set_step(msg, t):
+    minutes = (t - msg.analDate).total_seconds()/60.0
+    if minutes%60 == 0:
+        msg['stepUnits'] = 1
+        step = int(minutes//60)
+    else:
+        msg['stepUnits'] = 0
+        step = int(round(minutes))
+    msg['startStep'] = step
+    msg['endStep'] = step
+
+# set packing type and precision of a message
+def set_packing(msg, packing=None, bitsPerValue=None):
+    if packing is not None and msg['packingType'] != packing:
+        msg['packingType'] = packing
+    if bitsPerValue is not None:
+        msg['bitsPerValue'] = bitsPerValue
 
-        # mobility
-        logging.info("writing mobility step %d"%i)
+# per worker process template message clone, set by _init_writer
+_writer = {}
+
+def _init_writer(template):
+    _writer['msg'] = pygrib.fromstring(template)
+
+# worker task, encode the messages of a step
+def _encode_step(job):
+    i, t, fields, bitsPerValue, members, packing = job
+    buf = io.BytesIO()
+    write_step(buf, _writer['msg'], i, t, fields, bitsPerValue, members, packing)
+    return buf.getvalue()
+
+# Encode steps over a pool of worker processes, and write them
+# in step order. At most 2*workers steps are in flight at once.
+def write_parallel(out, data, times, template_msg, workers, members=None, packing=None, bitsPerValue=None):
+    logging.info("encoding GRIB messages over %d workers"%workers)
+    with process_pool(workers, initializer=_init_writer,
+                      initargs=(template_msg.tostring(),)) as pool:
+        pending = deque()
+        for i, t in enumerate(times):
+            fields = {par: np.asarray(v) for par, v in step_fields(data, i).items()}
+            pending.append(pool.submit(_encode_step, (i, t, fields, bitsPerValue, members, packing)))
+            if len(pending) >= 2*workers:
+                out.write(pending.popleft().result())
+        while pending:
+            out.write(pending.popleft().result())
+
+# Writes the snowdrift parameter messages of step i, valid
+# at t, to an open file, fields is a dict of param -> values,
+# members the ensemble member numbers of fields (or None).
+# packing and bitsPerValue (see save_grib) are set on each
+# message, eccodes drops the precision of the message to 0
+# bits after a constant field.
+def write_step(out, msg, i, t, fields, bitsPerValue=None, members=None, packing=None):
+    for m, par, ioPar, values in step_messages(fields, members):
+        if m is None:
+            logging.info("writing %s step %d"%(par, i))
+        else:
+            logging.info("writing %s step %d member %d"%(par, i, m))
+            msg['perturbationNumber'] = m
+        set_packing(msg, packing, bitsPerValue)
         msg.level = LEVEL
-        msg['indicatorOfParameter'] = MOBILITY_PARAMETER       
+        msg['indicatorOfParameter'] = ioPar
         # NOTE: Forecast time steps may need improvement
         #       for other forecast sources like NCEP.
         #       Keep an eye on this for later improvements if needed.
-        msg['startStep'] = i
-        msg['endStep'] = i
-        msg['values'] = mobility[i]
+        set_step(msg, t)
+        msg['values'] = values
         out.write(msg.tostring())
-
-
-    out.close()
\ No newline at end of file
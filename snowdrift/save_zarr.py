@@ -0,0 +1,150 @@
+import logging
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .save_grib import PARAMETERS
+from .profiling import profiled
+
+# Chunked array output, as a Zarr (format 2) store.
+#
+# Written with zarr (optional, imported when used), readable
+# with zarr or xarray.open_zarr (dimension names in
+# '_ARRAY_DIMENSIONS', CF time units, no fill value for the
+# coordinates). Drift parameters are chunked one step (and
+# member) per chunk, in CHUNKS sized spatial tiles, so
+#  - steps are written independently, in parallel or appended
+#    one at a time as the model runs (ZarrWriter.write_step),
+#  - readers fetch single steps or tiles (read_zarr) without
+#    decoding the rest of the store.
+
+# spatial chunk shape (y, x), or points for 1-D regions
+CHUNKS = (256, 256)
+POINT_CHUNKS = (4096,)
+
+TIME_UNITS = "seconds since %s"
+
+# zarr module, raises ImportError if not installed
+def get_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("Zarr output needs zarr (pip install zarr)")
+    return zarr
+
+# new format 2 group at path, replacing any store there
+def new_group(zarr, path):
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        return zarr.open_group(path, mode='w', zarr_format=2)
+    return zarr.open_group(path, mode='w')
+
+class ZarrWriter:
+    # path: store directory, created (replaced if present)
+    # lats, lons: cell coordinates, (ny, nx) or (npoints,)
+    # members: ensemble member numbers or None
+    # names: point names of 1-D regions
+    def __init__(self, path, lats, lons, members=None, names=None, chunks=None):
+        self.zarr = get_zarr()
+        self.path = path
+        self.shape = tuple(np.shape(lats))
+        self.members = list(members) if members is not None else None
+        if len(self.shape) == 2:
+            self.dims = ['y', 'x']
+            chunks = chunks or CHUNKS
+        else:
+            self.dims = ['point']
+            chunks = chunks or POINT_CHUNKS
+        self.chunks = tuple(min(c, s) for c, s in zip(chunks, self.shape))
+        self.t0 = None
+        self.arrays = {}
+        self.lock = threading.Lock()
+
+        self.group = new_group(self.zarr, path)
+        self.group.attrs['source'] = 'snowdrift'
+        self.create('latitude', lats, self.dims, {'units': 'degrees_north', 'standard_name': 'latitude'})
+        self.create('longitude', lons, self.dims, {'units': 'degrees_east', 'standard_name': 'longitude'})
+        if self.members is not None:
+            self.create('member', np.asarray(self.members, dtype=np.int32), ['member'], {})
+        if names is not None:
+            # fixed width strings
+            self.create('name', np.asarray(names, dtype='S'), self.dims, {})
+
+    # write a whole coordinate array as one chunk, no fill value
+    def create(self, name, values, dims, attrs):
+        values = np.ascontiguousarray(values)
+        self.meta(name, values.shape, values.shape, values.dtype, dims, attrs, None)
+        self.arrays[name][...] = values
+
+    def meta(self, name, shape, chunks, dtype, dims, attrs, fill_value):
+        if hasattr(self.group, 'create_array'):
+            a = self.group.create_array(name, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value)
+        else:
+            a = self.group.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value)
+        a.attrs.update(dict(attrs, _ARRAY_DIMENSIONS=list(dims)))
+        self.arrays[name] = a
+
+    # create the time and drift parameter arrays, for n steps
+    # (more can be appended), dtype of the drift fields
+    def create_params(self, t0, n, dtype):
+        self.t0 = t0
+        lead = ['time'] + (['member'] if self.members is not None else [])
+        nlead = (n, len(self.members)) if self.members is not None else (n,)
+        self.meta('time', (n,), (1,), np.int64, ['time'],
+                  {'units': TIME_UNITS%t0.strftime('%Y-%m-%d %H:%M:%S'),
+                   'calendar': 'proleptic_gregorian', 'standard_name': 'time'}, None)
+        for par, ioPar in PARAMETERS:
+            self.meta(par, nlead + self.shape, (1,)*len(nlead) + self.chunks, dtype, lead + self.dims,
+                      {'coordinates': 'latitude longitude', 'grib_parameter': ioPar}, np.nan)
+
+    # grow the time axis to n steps
+    def resize(self, n):
+        with self.lock:
+            for name in ['time'] + [par for par, _ in PARAMETERS]:
+                a = self.arrays[name]
+                if a.shape[0] < n:
+                    a.resize((n,) + a.shape[1:])
+
+    # write step i at time t, fields {param: values}, values
+    # (ny, nx) or (npoints,), with a leading member axis for
+    # ensembles. Steps can be written in any order, or in
+    # parallel if create_params sized the arrays up front.
+    def write_step(self, i, t, fields):
+        if self.t0 is None:
+            self.create_params(t, i + 1, np.asarray(fields['drift']).dtype)
+        self.resize(i + 1)
+        logging.info("writing zarr step %d"%i)
+        self.arrays['time'][i] = int((t - self.t0).total_seconds())
+        for par, _ in PARAMETERS:
+            self.arrays[par][i] = np.asarray(fields[par])
+
+    # consolidated metadata, for a single metadata read on open
+    def close(self):
+        self.zarr.consolidate_metadata(self.path)
+
+# Saves snowdrift parameters of data to a Zarr store at path,
+# steps written over N worker threads
+@profiled('zarr write')
+def save_zarr(data, path, lats, lons, names=None, workers=None, chunks=None):
+    logging.info("saving zarr store %s"%path)
+    times = data['temp']['times']
+    members = data['temp'].get('members')
+    n = len(times)
+    writer = ZarrWriter(path, lats, lons, members, names, chunks)
+    writer.create_params(times[0], n, np.asarray(data['drift']['values'][0]).dtype)
+    def write(i):
+        writer.write_step(i, times[i], {par: data[par]['values'][i] for par, _ in PARAMETERS})
+    if workers and workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(write, range(n)))
+    else:
+        for i in range(n):
+            write(i)
+    writer.close()
+    return writer
+
+# Read param from a Zarr store, only the chunks covering
+# step i (all steps if None) and the tile rows/cols
+# (slices, whole grid if None)
+def read_zarr(path, param, i=None, rows=None, cols=None):
+    a = get_zarr().open_group(path, mode='r')[param]
+    index = tuple({'time': i, 'y': rows, 'point': rows, 'x': cols}.get(d) for d in a.attrs['_ARRAY_DIMENSIONS'])
+    return a[tuple(slice(None) if k is None else k for k in index)]
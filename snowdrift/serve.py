@@ -0,0 +1,257 @@
+import os
+import glob
+import json
+import time
+import queue
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+from collections import deque
+from . import cli
+from .plot import scales, getScaleLUT
+
+# Resident service, `snowdrift serve`.
+#
+# Runs snowdrift command line jobs in-process, so imports,
+# colormaps and region grid indices (cli.regions) stay warm
+# between runs. Jobs are the program arguments, e.g.
+#   {"args": ["/data/fc.00", "/data/fc.01", "--out", "/data/sd.grb"]}
+# (use absolute paths), submitted over a local (unix) socket or as
+# .json files in a spool directory. Jobs run on a pool of worker
+# threads, the job queue is bounded so submitters wait (socket)
+# or job files are left unclaimed (spool) while it is full.
+#
+# --quiet and --profile are process wide settings, jobs setting
+# them are rejected, set --quiet on the service instead.
+SERVICE_OPTIONS = ('--quiet', '--profile')
+
+# raises ValueError if job args set a service option,
+# abbreviations (as argparse allows) included
+def check_args(args):
+    for a in args:
+        if a == '--':
+            break
+        name = a.split('=', 1)[0]
+        if len(name) > 2 and name.startswith('--') and any(o.startswith(name) for o in SERVICE_OPTIONS):
+            raise ValueError("%s is a service option, not a job option"%name)
+
+# Job, args and timings
+class Job:
+    def __init__(self, id, args):
+        self.id = id
+        self.args = list(args)
+        self.status = 'queued'
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def result(self):
+        return {
+            'id': self.id,
+            'args': self.args,
+            'status': self.status,
+            'error': self.error,
+            'wait': None if self.started is None else self.started - self.submitted,
+            'seconds': None if self.finished is None else self.finished - self.started,
+        }
+
+# percentiles of a list of values, as a dict
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q*len(values)))]
+    return {'mean': sum(values)/len(values), 'p50': pick(0.5), 'p95': pick(0.95), 'max': values[-1]}
+
+# Bounded job queue and worker thread pool,
+# runner(args) runs a job and returns its exit status
+class Service:
+    def __init__(self, workers=2, queue_size=8, runner=cli.main):
+        self.runner = runner
+        self.jobs = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.ids = 0
+        self.counts = {'submitted': 0, 'running': 0, 'done': 0, 'failed': 0}
+        # wait and run times of recent jobs
+        self.waits = deque(maxlen=1000)
+        self.runs = deque(maxlen=1000)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    # queue a job, blocks while the queue is full,
+    # raises ValueError for invalid args (check_args)
+    def submit(self, args, timeout=None):
+        check_args(args)
+        with self.lock:
+            self.ids += 1
+            job = Job(self.ids, args)
+        self.jobs.put(job, timeout=timeout)
+        with self.lock:
+            self.counts['submitted'] += 1
+        logging.info("job %d queued: %s"%(job.id, ' '.join(job.args)))
+        return job
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            job.started = time.time()
+            job.status = 'running'
+            with self.lock:
+                self.counts['running'] += 1
+            try:
+                status = self.runner(job.args)
+            except SystemExit as e:
+                status = e.code
+            except Exception as e:
+                logging.exception("job %d failed"%job.id)
+                status = 1
+                job.error = repr(e)
+            job.finished = time.time()
+            job.status = 'done' if not status else 'failed'
+            if status and job.error is None:
+                job.error = "exit status %r"%status
+            with self.lock:
+                self.counts['running'] -= 1
+                self.counts[job.status] += 1
+                self.waits.append(job.started - job.submitted)
+                self.runs.append(job.finished - job.started)
+            logging.info("job %d %s in %.1f s"%(job.id, job.status, job.finished - job.started))
+            job.done.set()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['queued'] = self.jobs.qsize()
+            stats['wait'] = percentiles(list(self.waits))
+            stats['run'] = percentiles(list(self.runs))
+        return stats
+
+    # stop workers, after the queued jobs
+    def shutdown(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+
+# Socket requests, one JSON object per line:
+#  {"args": [...]}                   run job, reply when done
+#  {"args": [...], "wait": false}    reply when queued
+#  {"stats": true}                   reply with service stats
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request.get('stats'):
+                    reply = self.server.service.stats()
+                else:
+                    job = self.server.service.submit(request['args'])
+                    if request.get('wait', True):
+                        job.done.wait()
+                    reply = job.result()
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'status': 'invalid', 'error': repr(e)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            self.wfile.flush()
+
+class SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+        self.service = service
+
+# send a request to a service socket, returns the reply
+def request(path, req):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(req).encode() + b'\n')
+        f = s.makefile('rb')
+        return json.loads(f.readline())
+
+# Claim and queue .json job files in a spool directory, job
+# files are renamed .running, then .done or .failed, and
+# the job result is written to <name>.result.json.
+def watch_spool(service, directory, interval=1.0, stop=None):
+    logging.info("watching spool directory %r"%directory)
+    while stop is None or not stop.is_set():
+        for f in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            if f.endswith('.result.json') or os.path.basename(f) == 'stats.json':
+                continue
+            base = f[:-len('.json')]
+            try:
+                os.rename(f, base + '.running')
+            except OSError:
+                continue  # claimed elsewhere
+            try:
+                with open(base + '.running') as fp:
+                    args = json.load(fp)['args']
+                check_args(args)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error("invalid job file %r: %r"%(f, e))
+                os.rename(base + '.running', base + '.failed')
+                continue
+            job = service.submit(args)
+            threading.Thread(target=finish_spool_job, args=(job, base), daemon=True).start()
+        time.sleep(interval)
+
+def finish_spool_job(job, base):
+    job.done.wait()
+    with open(base + '.result.json', 'w') as fp:
+        json.dump(job.result(), fp)
+    os.rename(base + '.running', base + ('.done' if job.status == 'done' else '.failed'))
+
+# log stats, and write them to filename, every interval seconds
+def report_stats(service, interval, filename=None):
+    while True:
+        time.sleep(interval)
+        stats = service.stats()
+        logging.info("service stats: %s"%json.dumps(stats))
+        if filename:
+            with open(filename, 'w') as fp:
+                json.dump(stats, fp, indent=2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='snowdrift serve')
+    parser.add_argument('--socket', metavar='PATH', help="accept jobs on unix socket PATH", default=None)
+    parser.add_argument('--spool', metavar='DIR', help="accept jobs as .json files in DIR", default=None)
+    parser.add_argument('--workers', metavar='N', type=int, help="run N jobs at once [2 (default)]", default=2)
+    parser.add_argument('--queue', metavar='N', type=int, help="max queued jobs [8 (default)]", default=8)
+    parser.add_argument('--stats-interval', metavar='SECONDS', type=float, help="log service stats every SECONDS [60 (default)]", default=60.0)
+    parser.add_argument('--quiet', action='store_true', help="don't print data summaries")
+    args = parser.parse_args(argv)
+    if not args.socket and not args.spool:
+        parser.error("requires --socket and/or --spool")
+
+    if args.quiet:
+        cli.snowdrift.set_quiet()
+    # warm colormaps
+    for param in scales:
+        getScaleLUT(param)
+
+    service = Service(args.workers, args.queue)
+    statsFile = os.path.join(args.spool, 'stats.json') if args.spool else None
+    threading.Thread(target=report_stats, args=(service, args.stats_interval, statsFile), daemon=True).start()
+
+    try:
+        if args.socket:
+            server = SocketServer(args.socket, service)
+            logging.info("serving jobs on %r"%args.socket)
+            if args.spool:
+                threading.Thread(target=watch_spool, args=(service, args.spool), daemon=True).start()
+            server.serve_forever()
+        else:
+            watch_spool(service, args.spool)
+    except KeyboardInterrupt:
+        logging.info("stopping, finishing queued jobs")
+        service.shutdown()
+    return 0
@@ -1,36 +1,280 @@
 import logging
+import numpy as np
 from .collect_data import summary, check_consistency
+from .fused import FusedKernel, fused_recursion, get_dt_hours, new_outputs, OUTPUT_PARAMS, DRIFT_WIND_LIMIT, MOBILITY_AGE_LIMIT, DRIFT_ACC_LIMITS
+from .tiles import TileRunner, run_parallel, INPUT_PARAMS, parse_memory, row_bytes, tile_rows, tile_bands, new_output, remove_output, resident_bytes
+from .profiling import profile, profiled
+from .compact import compact_recursion, compact_age
+from .compiled import compiled_recursion, get_kernel
+from .activity import run_active
+from .delta import delta_recursion
 
 # Default model thresholds
 SNOW_COVER_LIMIT=1.0
 SNOW_FALL_LIMIT=0.1
 
+# model thresholds by name (FusedKernel arguments), defaults
+THRESHOLDS = {
+    'snowCoverLimit': SNOW_COVER_LIMIT,
+    'snowFallLimit': SNOW_FALL_LIMIT,
+    'windLimit': DRIFT_WIND_LIMIT,
+    'ageLimit': MOBILITY_AGE_LIMIT,
+    'daccLow': DRIFT_ACC_LIMITS[0],
+    'daccHigh': DRIFT_ACC_LIMITS[1],
+}
+
+# untiled engines, see snowdrift()
+ENGINES = ('steps', 'fused', 'compact', 'delta', 'compiled')
+
 
 # the main snow drift algorithm on loaded data
-def snowdrift(data):
+#  - engine: 'steps' (default) runs the per-step functions below,
+#            'fused' runs the preallocated, in-place engine (fused.py),
+#            'compact' runs it with compact uint8/int16 state fields,
+#            decoded per step when read (compact.py),
+#            'delta' runs it keeping the state fields as keyframes
+#            and per-step changes, decoded per step when read (delta.py),
+#            'compiled' runs a per-cell loop compiled with Numba,
+#            or the fused engine without Numba (compiled.py),
+#            results are identical. Tiled runs (max_memory or
+#            workers) run the fused engine, other engines are
+#            overridden with a warning.
+#  - max_memory: run the fused engine in spatial tiles, sized to fit
+#            this memory budget (bytes or e.g. '2G'), full grid outputs
+#            are kept in temporary files (in scratch dir) if they don't fit.
+#  - workers: run the fused engine tiles over a pool of N processes,
+#            sharing inputs and outputs in shared memory.
+#  - state: warm start state for step 0, from a previous forecast
+#            cycle (see state.load_state), cold start if None.
+#  - active_only: run the engine on the cells that are snow
+#            covered at any step only (activity.py).
+#  - on_step: called as on_step(i, drift) with the drift field of
+#            each step as it is computed, e.g. to accumulate ensemble
+#            statistics (ensemble.EnsembleSteps) during the run.
+#            Compiled, tiled and active cell runs call it per step
+#            of the outputs after the run.
+#  - thresholds: model thresholds {name: value} (see THRESHOLDS),
+#            defaults for those not given, values are scalars or
+#            arrays broadcastable to the fields (scalars in tiled
+#            and active cell runs).
+# Ensemble data (collectData(..., ensemble=True)) runs all
+# members at once, and point data (1-D, see region.py) on the
+# selected cells only, in the untiled engines.
+def snowdrift(data, engine=None, max_memory=None, scratch=None, workers=None, state=None, active_only=False,
+              on_step=None, thresholds=None):
+    limits = model_thresholds(thresholds)
+    tiled = max_memory is not None or (workers or 1) > 1
+    if (tiled or active_only) and any(np.ndim(v) for v in limits.values()):
+        raise ValueError("tiled and active cell runs need scalar thresholds")
+
     # calculate dependent parameters,
     # for snowdrift forecast calculation...
     # this is in-place on the input data dict
     calculateDeps(data)
     
-    # do snow drift algorithm, in steps,
-    # because SA,DA,MI and SDV are interdependent calculations,
-    logging.info("snow drift algorithm")
-    for i in range(nsteps(data)):
-        logging.info("Drift calculation step %d"%i)
-        calculate_snow_cover_age(data, i)
-        calculate_drift_accumulation(data, i)
-        calculate_mobility_index(data, i)
-        calculate_drift(data, i)
-
+    if tiled:
+        if 'members' in data['temp'] or np.ndim(data['temp']['values'][0]) != 2:
+            raise ValueError("tiled runs need (ny, nx) fields, not ensemble or point data")
+        if active_only:
+            raise ValueError("active cell runs are untiled")
+        if engine not in (None, 'fused'):
+            if engine not in ENGINES:
+                raise ValueError("unknown snow drift engine %r"%engine)
+            logging.warning("tiled runs use the fused engine, not the %r engine"%engine)
+        run_tiled(data, max_memory, scratch, workers or 1, state, limits)
+        replay_steps(data, on_step)
+    elif active_only:
+        run_active(data, lambda sub, init: run_engine(sub, engine or 'steps', init, limits=limits),
+                   limits['snowCoverLimit'], limits['snowFallLimit'], state, limits['windLimit'])
+        replay_steps(data, on_step)
+    else:
+        run_engine(data, engine or 'steps', state, on_step, limits)
+    set_members(data)
 
     summary(data)
 
     # return results
     return data
 
+# thresholds {name: value} (or None), with the defaults
+# for those not given, see THRESHOLDS
+def model_thresholds(thresholds=None):
+    thresholds = dict(thresholds or {})
+    unknown = sorted(set(thresholds) - set(THRESHOLDS))
+    if unknown:
+        raise ValueError("unknown model thresholds: %s"%', '.join(unknown))
+    return dict(THRESHOLDS, **thresholds)
+
+# on_step(i, drift) for each step of the drift outputs
+def replay_steps(data, on_step):
+    if on_step is not None:
+        for i, drift in enumerate(data['drift']['values']):
+            on_step(i, drift)
+
+# run the drift model with an untiled engine, limits:
+# model_thresholds()
+def run_engine(data, engine, state=None, on_step=None, limits=THRESHOLDS):
+    if engine == 'fused':
+        run_fused(data, state, on_step, limits)
+    elif engine == 'compact':
+        run_compact(data, state, on_step, limits)
+    elif engine == 'delta':
+        run_delta(data, state, on_step, limits)
+    elif engine == 'compiled':
+        run_compiled(data, state, on_step, limits)
+    elif engine == 'steps':
+        # do snow drift algorithm, in steps,
+        # because SA,DA,MI and SDV are interdependent calculations,
+        logging.info("snow drift algorithm")
+        for i in range(nsteps(data)):
+            logging.info("Drift calculation step %d"%i)
+            with profile('drift step', step=i):
+                calculate_snow_cover_age(data, i, state, limits)
+                calculate_drift_accumulation(data, i, state, limits)
+                calculate_mobility_index(data, i, state, limits)
+                calculate_drift(data, i, limits)
+            if on_step is not None:
+                on_step(i, data['drift']['values'][i])
+    else:
+        raise ValueError("unknown snow drift engine %r"%engine)
+
+# Fused engine, each output param is a single preallocated
+# (time, ny, nx) array, still indexable per step.
+def run_fused(data, init=None, on_step=None, limits=THRESHOLDS):
+    logging.info("snow drift algorithm (fused engine)")
+    times = get_times(data)
+    temp0 = data['temp']['values'][0]
+
+    out = new_outputs(nsteps(data), temp0.shape, temp0.dtype)
+    kernel = FusedKernel(temp0.shape, **limits)
+    fused_recursion(kernel,
+        data['snowground']['values'], data['snowfall']['values'],
+        data['temp']['values'], data['wind']['values'],
+        get_dt_hours(times),
+        out['snowage'], out['driftacc'], out['mobility'], out['drift'], init, on_step)
+
+    for p, unit in OUTPUT_PARAMS:
+        data[p] = {'times': list(times), 'values': out[p], 'unit': unit}
+
+# Compact engine, snowage and mobility stored as int16/uint8
+# and drift recomputed when read, decoded per step on access.
+# Needs whole hour steps, else runs the fused engine.
+def run_compact(data, init=None, on_step=None, limits=THRESHOLDS):
+    times = get_times(data)
+    dtHours = get_dt_hours(times)
+    if not compact_age(dtHours, init):
+        logging.info("steps are not whole hours, no compact snow age")
+        return run_fused(data, init, on_step, limits)
+
+    logging.info("snow drift algorithm (compact engine)")
+    out = compact_recursion(
+        data['snowground']['values'], data['snowfall']['values'],
+        data['temp']['values'], data['wind']['values'], dtHours,
+        init=init, on_step=on_step, **limits)
+
+    for p, unit in OUTPUT_PARAMS:
+        data[p] = {'times': list(times), 'values': out[p], 'unit': unit}
+
+# Delta engine, the fused kernel over two steps of state,
+# snowage, driftacc and mobility stored as keyframes and
+# deltas, drift recomputed when read.
+def run_delta(data, init=None, on_step=None, limits=THRESHOLDS):
+    logging.info("snow drift algorithm (delta engine)")
+    times = get_times(data)
+    temp0 = data['temp']['values'][0]
+    kernel = FusedKernel(temp0.shape, **limits)
+    out = delta_recursion(kernel,
+        data['snowground']['values'], data['snowfall']['values'],
+        data['temp']['values'], data['wind']['values'],
+        get_dt_hours(times), limits['snowCoverLimit'], init, on_step=on_step)
+
+    for p, unit in OUTPUT_PARAMS:
+        data[p] = {'times': list(times), 'values': out[p], 'unit': unit}
+
+# Compiled engine, the recursion per cell in one compiled
+# loop, into the fused engine's output arrays. Runs the fused
+# engine if Numba is not installed, or for array thresholds.
+def run_compiled(data, init=None, on_step=None, limits=THRESHOLDS):
+    if any(np.ndim(v) for v in limits.values()):
+        logging.info("array thresholds, running the fused engine")
+        return run_fused(data, init, on_step, limits)
+    kernel = get_kernel()
+    if kernel is None:
+        logging.warning("numba is not installed, running the fused engine")
+        return run_fused(data, init, on_step, limits)
+
+    logging.info("snow drift algorithm (compiled engine)")
+    times = get_times(data)
+    temp0 = data['temp']['values'][0]
+    out = new_outputs(nsteps(data), temp0.shape, temp0.dtype)
+    compiled_recursion(kernel,
+        data['snowground']['values'], data['snowfall']['values'],
+        data['temp']['values'], data['wind']['values'],
+        get_dt_hours(times), snowage=out['snowage'], driftacc=out['driftacc'],
+        mobility=out['mobility'], drift=out['drift'], init=init, **limits)
+
+    for p, unit in OUTPUT_PARAMS:
+        data[p] = {'times': list(times), 'values': out[p], 'unit': unit}
+    # the kernel runs all steps of a cell at once, steps are done together
+    replay_steps(data, on_step)
+
+# Fused engine run in spatial tiles (bands of rows),
+# tile size picked from the max_memory budget (less the input
+# fields held in memory, split between workers), or a few
+# tiles per worker if no budget given, limits: scalar
+# model_thresholds().
+def run_tiled(data, max_memory=None, scratch=None, workers=1, init=None, limits=THRESHOLDS):
+    times = get_times(data)
+    n = nsteps(data)
+    temp0 = data['temp']['values'][0]
+    ny, nx = temp0.shape
+    dtype = temp0.dtype
+
+    # full grid outputs in memory if they fit next to one row
+    # tile per worker (tiles sized to the rest), else on disk
+    outBytes = len(OUTPUT_PARAMS)*n*ny*nx*dtype.itemsize
+    ondisk = False
+    if max_memory is not None:
+        # loaded inputs stay resident next to the tiles and outputs
+        inBytes = sum(resident_bytes(entry['values']) for entry in data.values())
+        max_memory = parse_memory(max_memory) - inBytes
+        if max_memory <= 0:
+            logging.warning("loaded inputs (%d bytes) exceed the memory budget"%inBytes)
+            max_memory = 0
+        ondisk = outBytes + workers*row_bytes(n, nx, dtype.itemsize) > max_memory
+        if not ondisk:
+            max_memory -= outBytes
+        rows = tile_rows(n, ny, nx, max_memory//workers, dtype.itemsize)
+    else:
+        rows = max(1, -(-ny//(4*workers)))
+    bands = tile_bands(ny, rows)
+    logging.info("snow drift algorithm (tiled, %d tiles of %d rows, %d workers)"%(len(bands), rows, workers))
+    if ondisk:
+        logging.info(" - outputs backed by temporary files")
+    out = {p: new_output((n, ny, nx), dtype, ondisk, scratch, shared=workers > 1) for p, _ in OUTPUT_PARAMS}
+
+    inputs = {p: data[p]['values'] for p in INPUT_PARAMS}
+    dtHours = get_dt_hours(times)
+    if workers > 1:
+        try:
+            with profile('drift tiles', workers=workers):
+                run_parallel(inputs, dtHours, out, bands, workers, init=init, **limits)
+        finally:
+            for v in out.values():
+                remove_output(v)
+    else:
+        runner = TileRunner(n, rows, nx, dtype, **limits)
+        for k, (r0, r1) in enumerate(bands):
+            logging.info("Drift calculation tile %d/%d, rows %d-%d"%(k+1, len(bands), r0, r1))
+            with profile('drift tile', rows=[r0, r1]):
+                runner.run(inputs, dtHours, out, r0, r1, init)
+
+    for p, unit in OUTPUT_PARAMS:
+        data[p] = {'times': list(times), 'values': out[p], 'unit': unit}
+
 # tries to generate extra params from loaded data,
 # that are required by snowdrift algorithm...
+@profiled('deps')
 def calculateDeps(data):
     logging.info("calculating dependent parameters")
 
@@ -38,6 +282,7 @@ def calculateDeps(data):
     calculate_snowfall(data)
     # wind from wind u/v if not provided,
     calculate_wind(data)
+    set_members(data)
  
     # print post deps data summary
     summary(data)
@@ -45,7 +290,8 @@ def calculateDeps(data):
     check_consistency(data)
 
 # The drift value calculated here
-def calculate_drift(data, i):
+@profiled('calculate_drift')
+def calculate_drift(data, i, limits=THRESHOLDS):
     logging.info(" - calculating snow mobility %d"%i)
 
     if i == 0:
@@ -60,12 +306,12 @@ def calculate_drift(data, i):
 
     d = mi*(wind**3.0)/1728.0
 
-    # set to zero if wind < 6.0
-    d[wind<6.0] = 0.0
+    # set to zero if wind < windLimit
+    d[wind<limits['windLimit']] = 0.0
 
     # set snow free areas to -1
     # mainly just for better plotting
-    isc = is_snow_covered(data, i)
+    isc = is_snow_covered(data, i, limits)
     d[~isc] = -1
 
     # append
@@ -74,7 +320,8 @@ def calculate_drift(data, i):
 
 # Mobility index/factor is 1 after new snowfall, but
 # decreases...
-def calculate_mobility_index(data, i):
+@profiled('calculate_mobility_index')
+def calculate_mobility_index(data, i, init=None, limits=THRESHOLDS):
     logging.info(" - calculating snow mobility %d"%i)
 
     # input
@@ -87,30 +334,34 @@ def calculate_mobility_index(data, i):
     mobilitytimes = data['mobility']['times']
 
     if i == 0:
-        # TODO: get previous FC mobility
-        # if no prev run data, initialize mobility index (with zeros)
-        mi = new_array(data)
+        if init is not None:
+            # previous FC mobility, nulled where no snow cover
+            mi = new_array(data) + init['mobility']
+            mi[~is_snow_covered(data, 0, limits)] = 0.0
+        else:
+            # if no prev run data, initialize mobility index (with zeros)
+            mi = new_array(data)
         mobility.append(mi)
         mobilitytimes.append(times[0])
     else:
         mi = mobility[i-1].copy() # make copy of prev step
 
         # if new snow, reset mobility to 1.0
-        new = is_new_snow(data, i)
+        new = is_new_snow(data, i, limits)
         mi[new] = 1.0
 
         # apply snow cover age reduction...
         age = data['snowage']['values'][i]
-        mi[ (mi == 1.0)&(age >= 24) ] = 0.6
+        mi[ (mi == 1.0)&(age >= limits['ageLimit']) ] = 0.6
 
         # apply drift accumulation reduction,
         dacc = data['driftacc']['values'][i]
-        mi[ dacc >= 2.0 ] = 0.6   # [2.0 6.0] range
-        mi[ dacc > 6.0 ] = 0.3    # > 6.0 range
+        mi[ dacc >= limits['daccLow'] ] = 0.6   # [daccLow daccHigh] range
+        mi[ dacc > limits['daccHigh'] ] = 0.3   # > daccHigh range
 
         # melting and snow cover nulling,
         melting = is_melting_temp(data, i)
-        isc = is_snow_covered(data, i)
+        isc = is_snow_covered(data, i, limits)
         mi[melting] = 0.0
         mi[~isc] = 0.0
 
@@ -119,9 +370,10 @@ def calculate_mobility_index(data, i):
         mobilitytimes.append(times[i])
 
 # Drift accumulation keeps track of quantity of accumulated drifting
-# DA increases by SDValue when wind[i-1] >= 6 m/s.
+# DA increases by SDValue when wind[i-1] > windLimit (m/s).
 # reset accumulation to 0 when new snow
-def calculate_drift_accumulation(data, i):
+@profiled('calculate_drift_accumulation')
+def calculate_drift_accumulation(data, i, init=None, limits=THRESHOLDS):
     logging.info(" - calculating drift accumulation %d"%i)
 
     # input
@@ -136,9 +388,10 @@ def calculate_drift_accumulation(data, i):
 
     if i == 0:
         # here we set the first step,
-        # zero by default...
-        # TODO: should be loaded from prev forecast
+        # from prev forecast state, or zero by default...
         dacc = new_array(data)
+        if init is not None:
+            dacc += init['driftacc']
         driftacc.append(dacc)
         driftacctimes.append(times[0])
     else:
@@ -146,12 +399,12 @@ def calculate_drift_accumulation(data, i):
         pWind = data['wind']['values'][i-1]
         pDrift = data['drift']['values'][i-1]
         pDacc = data['driftacc']['values'][i-1]
-        # accumulate drift with wind > 6.0
+        # accumulate drift with wind > windLimit
         dacc = pDacc.copy() # copy from previous
-        windy = pWind > 6.0
+        windy = pWind > limits['windLimit']
         dacc[windy] = pDacc[windy] + pDrift[windy]
         # reset accumulation when new snow,
-        new = is_new_snow(data, i)
+        new = is_new_snow(data, i, limits)
         dacc[new] = 0.0
         # append result,
         driftacc.append(dacc)
@@ -165,7 +418,8 @@ def calculate_drift_accumulation(data, i):
 # NOTE: snow cover age, does not keep track of meltin
 #       this is done in mobility index,
 #       i.e. melting, will turn off mobility of the top layer
-def calculate_snow_cover_age(data, i):
+@profiled('calculate_snow_cover_age')
+def calculate_snow_cover_age(data, i, init=None, limits=THRESHOLDS):
     logging.info(" - calculating snow age %d"%i)
 
     times = get_times(data)
@@ -179,11 +433,15 @@ def calculate_snow_cover_age(data, i):
 
     if i == 0:
         # here we set the first age step,
-        # TODO: should be loaded from prev forecast
-        # now just start from zero...
-        isc = is_snow_covered(data, 0)
-        age = new_array(data) - 1.0 # init -1
-        age[isc] = 0
+        # from prev forecast state, or just start from zero...
+        isc = is_snow_covered(data, 0, limits)
+        if init is not None:
+            age = new_array(data) + init['snowage']
+            age[isc & (age < 0)] = 0
+            age[~isc] = -1.0
+        else:
+            age = new_array(data) - 1.0 # init -1
+            age[isc] = 0
         snowage.append(age)
         snowagetimes.append(times[0])
     else:
@@ -191,8 +449,8 @@ def calculate_snow_cover_age(data, i):
         age = new_array(data) - 1.0 # init -1
 
         # booleans...
-        isc = is_snow_covered(data, i)
-        new = is_new_snow(data, i)
+        isc = is_snow_covered(data, i, limits)
+        new = is_new_snow(data, i, limits)
 
         # age up snow from previous step,
         dtHours = (times[i] - times[i-1]).total_seconds()/3600.0
@@ -210,63 +468,84 @@ def calculate_snow_cover_age(data, i):
 
 
 
-# calculate snow fall (hourly rate), if not provided
+# calculate snow fall (hourly rate), if not provided,
+# as a stacked (time, ny, nx) array
 def calculate_snowfall(data):
     if ('snowfall' not in data) and ('snowac' in data):
         logging.info(" - calculating snow fall rate")
         unit = data['snowac']['unit'] + "/h"
-        data['snowfall'] = {'times':[], 'values':[], 'unit':unit}
         snowac = data['snowac']['values']
         times = data['snowac']['times']
         n = len(times)
-        snowfall = data['snowfall']['values']
-        snowfalltimes = data['snowfall']['times']
+        snowfall = np.empty((n,)+snowac[0].shape, dtype=snowac[0].dtype)
 
         # first snow step...
-        snowfall.append( new_array(data) ) # zeroed first step
-        snowfalltimes.append( times[0] )
-        # rest are diff...
+        np.multiply(data['temp']['values'][0], 0.0, out=snowfall[0]) # zeroed first step
+        # rest are diff over time, hourly snowfall
         for i in range(1, n):
-            # hourly snowfall, so get time step...
-            dtHours = (times[i] - times[i-1]).total_seconds()/3600.0
-            dSnow = (snowac[i] -  snowac[i-1])/dtHours
-            snowfall.append(dSnow)
-            snowfalltimes.append(times[i])
+            np.subtract(snowac[i], snowac[i-1], out=snowfall[i])
+        dtHours = np.array(get_dt_hours(times), dtype=snowfall.dtype)
+        dtHours = dtHours.reshape((n,)+(1,)*(snowfall.ndim-1))
+        np.divide(snowfall[1:], dtHours[1:], out=snowfall[1:])
+        data['snowfall'] = {'times':list(times), 'values':snowfall, 'unit':unit}
 
 
 # calculate wind from u/v if necessary,
+# as a stacked (time, ny, nx) array
 def calculate_wind(data):
-    if 'wind' not in data and (('wind-u' in data) and ('wind-v' in data)):
+    if 'wind' in data:
+        return
+    if ('wind-u' in data) and ('wind-v' in data):
         logging.info(" - calculating wind speed from u/v")
         unit = data['wind-u']['unit']
-        data['wind'] = {'times':[], 'values':[], 'unit':unit}
         windu = data['wind-u']['values']
         windv = data['wind-v']['values']
         times = data['wind-u']['times']
-        wind = data['wind']['values']
-        windtimes = data['wind']['times']
         n = len(times)
-        for i in range(n):
-            u = windu[i]
-            v = windv[i]
-            t = times[i]
-            spd = (u**2 + v**2)**0.5
-            wind.append(spd)
-            windtimes.append(t)
+        shape = np.shape(windu[0])
+        dtype = np.result_type(windu[0], windv[0])
+        scratch = np.empty(shape, dtype=dtype)
+        if isinstance(windu, list) and isinstance(windv, list):
+            # per step arrays, each u/v step is released once its
+            # speed is computed, so u/v and wind are not all held
+            wind = []
+            for i in range(n):
+                wind.append(wind_speed(windu[i], windv[i], out=np.empty(shape, dtype=dtype), scratch=scratch))
+                windu[i] = windv[i] = None
+        else:
+            wind = np.empty((n,)+shape, dtype=dtype)
+            for i in range(n):
+                wind_speed(windu[i], windv[i], out=wind[i], scratch=scratch)
+        data['wind'] = {'times':list(times), 'values':wind, 'unit':unit}
         # can delete u/v wind after wind calculation
         del data['wind-u']
         del data['wind-v']
     else:
         raise ValueError("require 'wind' or 'wind-u/v' parameters for snow drift calculation")
 
+# wind speed from u/v, in place in out (same result as
+# (u**2 + v**2)**0.5), scratch is a temporary of out's shape
+def wind_speed(u, v, out=None, scratch=None):
+    out = np.multiply(u, u, out=out)
+    scratch = np.multiply(v, v, out=scratch)
+    out += scratch
+    return np.sqrt(out, out=out)
+
+
+# ensemble member numbers of the input data on all params
+def set_members(data):
+    members = data['temp'].get('members')
+    if members is not None:
+        for p in data:
+            data[p].setdefault('members', list(members))
 
 # calculate boolean if new snowfall in this step,
-def is_new_snow(data, i):
-    return data['snowfall']['values'][i] > SNOW_FALL_LIMIT
+def is_new_snow(data, i, limits=THRESHOLDS):
+    return data['snowfall']['values'][i] > limits['snowFallLimit']
 
 # calculate boolean if ground snow covered,
-def is_snow_covered(data, i):
-    return data['snowground']['values'][i] > SNOW_COVER_LIMIT
+def is_snow_covered(data, i, limits=THRESHOLDS):
+    return data['snowground']['values'][i] > limits['snowCoverLimit']
 
 # calculate boolean for top snow is melting
 def is_melting_temp(data, i):
@@ -0,0 +1,102 @@
+import json
+import struct
+import hashlib
+import logging
+import numpy as np
+from datetime import datetime, timedelta
+
+# Model state checkpoints, for warm starting a forecast cycle
+# from the previous cycle instead of cold starting from zeros.
+#
+# File layout: MAGIC, header length (uint32), JSON header
+# (valid time, grid hash, shape, dtype), then the raw
+# snowage, driftacc and mobility fields. The fields start at
+# a 64 byte aligned offset and are memory-mapped on load.
+
+MAGIC = b'SNOWDRIFT-STATE\n'
+STATE_PARAMS = ('snowage', 'driftacc', 'mobility')
+ALIGN = 64
+
+# identity of the forecast grid, from the GRIB grid section
+# of the template message if available, else the grid shape,
+# and of the region (region.py) of the grid if any
+def grid_hash(templateMsg=None, shape=None, region=None):
+    gridHash = None
+    if templateMsg is not None:
+        try:
+            gridHash = templateMsg['md5GridSection']
+        except (KeyError, RuntimeError):
+            shape = templateMsg.values.shape
+    if gridHash is None:
+        gridHash = hashlib.md5(("shape:%r"%(tuple(shape),)).encode()).hexdigest()
+    if region is not None:
+        gridHash = hashlib.md5(("%s:%s"%(gridHash, region.key())).encode()).hexdigest()
+    return gridHash
+
+# Write state at the step valid at times[0] + hours,
+# e.g. the next cycle's analysis time. If there is no such
+# step, warns and returns False (nothing written).
+def save_state(filename, data, hours, gridHash=None):
+    times = list(data['snowage']['times'])
+    t = times[0] + timedelta(hours=hours)
+    if t not in times:
+        logging.warning("no step valid at %s (+%s h) to save state from, state not saved"%(t, hours))
+        return False
+    i = times.index(t)
+
+    fields = [np.asarray(data[p]['values'][i]) for p in STATE_PARAMS]
+    shape = fields[0].shape
+    dtype = fields[0].dtype
+    if gridHash is None:
+        gridHash = grid_hash(shape=shape)
+
+    header = json.dumps({
+        'time': t.isoformat(),
+        'grid': gridHash,
+        'shape': list(shape),
+        'dtype': dtype.str,
+        'params': list(STATE_PARAMS),
+    }).encode()
+    # pad header so fields start at an aligned offset
+    offset = len(MAGIC) + 4 + len(header)
+    header += b' '*(-offset % ALIGN)
+
+    logging.info("saving model state valid at %s to %r"%(t, filename))
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for v in fields:
+            f.write(np.ascontiguousarray(v, dtype=dtype).tobytes())
+    return True
+
+# read a state file header, returns (header dict, data offset)
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError("%r is not a snowdrift state file"%filename)
+        n = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(n).decode())
+    header['time'] = datetime.fromisoformat(header['time'])
+    return header, len(MAGIC) + 4 + n
+
+# Memory-map a state file, returns dict with 'time', 'grid'
+# and the state fields. If validTime or gridHash are given and
+# don't match the state, warns and returns None (cold start).
+def load_state(filename, validTime=None, gridHash=None):
+    header, offset = read_header(filename)
+    if validTime is not None and header['time'] != validTime:
+        logging.warning("state in %r is valid at %s, not %s, cold starting"%(filename, header['time'], validTime))
+        return None
+    if gridHash is not None and header['grid'] != gridHash:
+        logging.warning("state in %r is on a different grid, cold starting"%filename)
+        return None
+
+    shape = (len(header['params']),) + tuple(header['shape'])
+    fields = np.memmap(filename, dtype=np.dtype(header['dtype']), mode='r',
+                       offset=offset, shape=shape)
+    logging.info("loaded model state valid at %s from %r"%(header['time'], filename))
+    state = {'time': header['time'], 'grid': header['grid']}
+    for k, p in enumerate(header['params']):
+        state[p] = fields[k]
+    return state
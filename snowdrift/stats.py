@@ -0,0 +1,41 @@
+import numpy as np
+
+# Field statistics for data summaries.
+#
+# min/max/mean are computed per step, on demand, and cached in
+# the parameter entry ('stats', one (min, max, mean) per
+# step), so each step is read once however many summaries are
+# printed: later calls only compute the steps added since.
+# Steps are assumed not to change once produced.
+# In quiet mode (set_quiet) summaries are skipped altogether.
+
+QUIET = False
+
+# skip data summaries (and their statistics)
+def set_quiet(quiet=True):
+    global QUIET
+    QUIET = quiet
+
+# (min, max, mean) of a single step
+def step_stats(v):
+    return (float(np.min(v)), float(np.max(v)), float(np.mean(v, dtype=np.float64)))
+
+# per step stats of a data entry, computing uncached steps
+# (recomputed if the entry's values were replaced)
+def field_stats(entry):
+    values = entry['values']
+    cache = entry.get('stats')
+    if cache is None or cache['values'] is not values:
+        cache = entry['stats'] = {'values': values, 'steps': []}
+    stats = cache['steps']
+    for i in range(len(stats), len(values)):
+        stats.append(step_stats(values[i]))
+    return stats
+
+# (min, max, mean) over all steps of a data entry
+def param_stats(entry):
+    stats = field_stats(entry)
+    if len(stats) == 0:
+        return np.nan, np.nan, np.nan
+    mins, maxs, means = zip(*stats)
+    return np.min(mins), np.max(maxs), np.mean(means)
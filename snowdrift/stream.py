@@ -0,0 +1,180 @@
+import os
+import glob
+import time
+import logging
+import numpy as np
+from .collect_data import config, read_file
+from .save_grib import write_step
+from .snowdrift import SNOW_COVER_LIMIT, SNOW_FALL_LIMIT, wind_speed
+from .fused import FusedKernel, OUTPUT_PARAMS
+from .profiling import profile
+from .state import grid_hash
+
+# Streaming drift model.
+#
+# The drift recursion only needs the state of step i-1 to
+# produce step i, so forecast steps can be pushed one at a time
+# as the NWP model writes them. Each push advances snowage,
+# driftacc, mobility and drift by one step and (optionally)
+# writes the step's GRIB messages straight away, only O(1)
+# steps are held in memory.
+
+class DriftStream:
+    # out: open binary file to write GRIB messages to (or None)
+    # templateMsg: GRIB template, taken from the first file if None
+    # init: warm start state for the first step (see state.py)
+    # packing, bitsPerValue: GRIB packing of the output (see save_grib)
+    def __init__(self, out=None, templateMsg=None, config=config,
+                 snowCoverLimit=SNOW_COVER_LIMIT, snowFallLimit=SNOW_FALL_LIMIT, init=None,
+                 packing=None, bitsPerValue=None):
+        self.out = out
+        self.init = init
+        self.templateMsg = None
+        self.packing = packing
+        self.bitsPerValue = bitsPerValue
+        self.set_template(templateMsg)
+        self.config = config
+        self.limits = (snowCoverLimit, snowFallLimit)
+        self.kernel = None
+        self.nsteps = 0
+        self.times = []
+        # current and previous step state
+        self.state = None
+        self.prev = None
+        self.prevWind = None
+        self.prevSnowac = None
+
+    # set the GRIB template, written messages keep its
+    # precision unless bitsPerValue is given
+    def set_template(self, templateMsg):
+        self.templateMsg = templateMsg
+        if templateMsg is not None and self.bitsPerValue is None:
+            self.bitsPerValue = templateMsg['bitsPerValue']
+
+    # decode a forecast file holding a single step and push it
+    def push_file(self, f):
+        with profile('load', file=f):
+            records, templateMsg = read_file(f, self.config)
+        return self.push_records(f, records, templateMsg)
+
+    # push the read_file results of a single step file f
+    # (a template msg is only needed for GRIB output)
+    def push_records(self, f, records, templateMsg=None):
+        if self.templateMsg is None:
+            if templateMsg is None and self.out is not None:
+                raise IOError("could not find a template msg in %r"%f)
+            self.set_template(templateMsg)
+
+        fields = {}
+        times = set()
+        for par, unit, t, member, vals in records:
+            if par in fields:
+                raise ValueError("more than one %r step in %r"%(par, f))
+            fields[par] = vals
+            times.add(t)
+        if len(times) != 1:
+            raise ValueError("expected a single time step in %r"%f)
+        return self.push(times.pop(), fields)
+
+    # push a decoded step, fields holds 'snowground', 'temp'
+    # and 'snowfall' or 'snowac', 'wind' or 'wind-u'/'wind-v'.
+    # Returns (step, time, state), state arrays are reused
+    # and overwritten two steps later.
+    def push(self, t, fields):
+        i = self.nsteps
+        if i > 0 and t <= self.times[-1]:
+            raise ValueError("steps must be pushed in time order, got %s after %s"%(t, self.times[-1]))
+
+        temp = fields['temp']
+        snowground = fields['snowground']
+
+        # dependent parameters, as calculateDeps does
+        if 'wind' in fields:
+            wind = fields['wind']
+        elif 'wind-u' in fields and 'wind-v' in fields:
+            u = fields['wind-u']
+            v = fields['wind-v']
+            wind = wind_speed(u, v)
+        else:
+            raise ValueError("require 'wind' or 'wind-u/v' parameters for snow drift calculation")
+
+        if i == 0:
+            dtHours = 0.0
+            if self.init is not None and self.init.get('time', t) != t:
+                logging.warning("state is valid at %s, not %s, cold starting"%(self.init['time'], t))
+                self.init = None
+            if self.init is not None and 'grid' in self.init and \
+                    self.init['grid'] != grid_hash(self.templateMsg, shape=temp.shape):
+                logging.warning("state is on a different grid, cold starting")
+                self.init = None
+            self.kernel = FusedKernel(temp.shape, *self.limits)
+            self.state = {p: np.empty(temp.shape, dtype=temp.dtype) for p, _ in OUTPUT_PARAMS}
+            self.prev = {p: np.empty(temp.shape, dtype=temp.dtype) for p, _ in OUTPUT_PARAMS}
+        else:
+            dtHours = (t - self.times[-1]).total_seconds()/3600.0
+
+        if 'snowfall' in fields:
+            snowfall = fields['snowfall']
+        elif 'snowac' in fields:
+            snowac = fields['snowac']
+            if i == 0:
+                snowfall = temp*0.0  # zeroed first step
+            else:
+                snowfall = (snowac - self.prevSnowac)/dtHours
+            self.prevSnowac = snowac
+        else:
+            raise ValueError("require 'snowfall' or 'snowac' parameters for snow drift calculation")
+
+        # advance the drift state one step
+        logging.info("Drift calculation step %d (%s)"%(i, t))
+        self.prev, self.state = self.state, self.prev
+        s = self.state
+        with profile('drift step', step=i):
+            if i == 0:
+                self.kernel.first(temp, snowground, wind,
+                                  s['snowage'], s['driftacc'], s['mobility'], s['drift'], self.init)
+            else:
+                p = self.prev
+                self.kernel.step(dtHours, snowground, snowfall, temp, wind,
+                                 self.prevWind, p['snowage'], p['driftacc'], p['mobility'], p['drift'],
+                                 s['snowage'], s['driftacc'], s['mobility'], s['drift'])
+        self.prevWind = wind
+        self.times.append(t)
+        self.nsteps += 1
+
+        # emit the step
+        if self.out is not None:
+            with profile('grib write', step=i):
+                write_step(self.out, self.templateMsg, i, t, s, self.bitsPerValue, packing=self.packing)
+                self.out.flush()
+
+        return i, t, s
+
+# Watch a directory and push forecast files as they arrive,
+# in file name order. A file is pushed once its size is unchanged
+# between two polls. Stops after nsteps steps, or when no new
+# file has arrived for timeout seconds.
+def follow(directory, stream, pattern='*', interval=2.0, timeout=600.0, nsteps=None):
+    logging.info("following %r for forecast files %r"%(directory, pattern))
+    done = set()
+    sizes = {}
+    last = time.time()
+    while True:
+        for f in sorted(glob.glob(os.path.join(directory, pattern))):
+            if f in done or not os.path.isfile(f):
+                continue
+            size = os.path.getsize(f)
+            if size == 0 or sizes.get(f) != size:
+                # new or still being written
+                sizes[f] = size
+                break
+            stream.push_file(f)
+            done.add(f)
+            last = time.time()
+            if nsteps and stream.nsteps >= nsteps:
+                return stream
+        else:
+            if time.time() - last > timeout:
+                logging.info("no new forecast files for %.0f s, stopping"%timeout)
+                return stream
+        time.sleep(interval)
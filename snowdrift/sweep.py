@@ -0,0 +1,121 @@
+import logging
+import itertools
+import numpy as np
+from .snowdrift import THRESHOLDS, model_thresholds, calculateDeps, get_times
+from .fused import FusedKernel, get_dt_hours
+from .ensemble import DRIFT_THRESHOLDS
+from .profiling import profile
+
+# Parameter sweeps, for calibrating the model thresholds.
+#
+# Runs the drift model for many threshold sets over the same
+# loaded inputs at once: a FusedKernel on state fields with a
+# leading parameter axis and (P, 1, 1) threshold arrays, so
+# each step is the fused engine's ufunc pass over all sets.
+# Drift is scored against observations as the steps are
+# computed, only two steps of state are held per set, in
+# batches of sets to bound memory.
+
+# parameter sets of all combinations of the given
+# threshold values, e.g. param_grid(windLimit=[5, 6, 7])
+def param_grid(**values):
+    model_thresholds(values)
+    names = list(values)
+    return [dict(zip(names, v)) for v in itertools.product(*[values[name] for name in names])]
+
+# Running drift scores of P sets against observations,
+# over cells with finite observations: bias and rmse of drift,
+# and the drift >= event contingency table
+class Scores:
+    def __init__(self, n, event):
+        self.event = event
+        self.count = 0
+        self.sum = np.zeros(n)
+        self.sum2 = np.zeros(n)
+        self.hits = np.zeros(n, dtype=np.int64)
+        self.misses = np.zeros(n, dtype=np.int64)
+        self.falseAlarms = np.zeros(n, dtype=np.int64)
+
+    # drift (P, ...) and observed (...) drift of a step
+    def add(self, drift, obs):
+        valid = np.isfinite(obs)
+        o = obs[valid].astype(np.float64)
+        d = drift[:, valid].astype(np.float64)
+        diff = d - o
+        self.count += o.size
+        self.sum += diff.sum(axis=1)
+        self.sum2 += (diff*diff).sum(axis=1)
+        observed = o >= self.event
+        forecast = d >= self.event
+        self.hits += (forecast & observed).sum(axis=1)
+        self.misses += (~forecast & observed).sum(axis=1)
+        self.falseAlarms += (forecast & ~observed).sum(axis=1)
+
+    # score dicts, one per set
+    def results(self):
+        scores = []
+        for k in range(len(self.sum)):
+            hits, misses, falseAlarms = int(self.hits[k]), int(self.misses[k]), int(self.falseAlarms[k])
+            ratio = lambda a, b: a/b if b else float('nan')
+            scores.append({
+                'count': self.count,
+                'bias': ratio(self.sum[k], self.count),
+                'rmse': ratio(self.sum2[k], self.count)**0.5,
+                'hits': hits,
+                'misses': misses,
+                'false_alarms': falseAlarms,
+                'pod': ratio(hits, hits + misses),
+                'far': ratio(falseAlarms, hits + falseAlarms),
+                'csi': ratio(hits, hits + misses + falseAlarms),
+            })
+        return scores
+
+# Run the drift model for each threshold set in params (dicts
+# of THRESHOLDS names, missing names at their defaults) on
+# loaded data, scored against obs, observed drift as a data
+# entry {'times', 'values'} (NaN where not observed), at the
+# model steps of its times. Sets run batch at a time (all at
+# once if None). Returns [(params, scores)] in params order.
+def sweep(data, params, obs, event=DRIFT_THRESHOLDS[1], batch=None, init=None):
+    calculateDeps(data)
+    times = get_times(data)
+    n = len(times)
+    dtHours = get_dt_hours(times)
+    temp = data['temp']['values']
+    snowground = data['snowground']['values']
+    snowfall = data['snowfall']['values']
+    wind = data['wind']['values']
+    shape = temp[0].shape
+    dtype = temp[0].dtype
+
+    observed = {t: v for t, v in zip(obs['times'], obs['values'])}
+    if not any(t in observed for t in times):
+        raise ValueError("no observations at the model steps")
+
+    batch = batch or len(params)
+    results = []
+    for b0 in range(0, len(params), batch):
+        sets = params[b0:b0+batch]
+        logging.info("parameter sweep, sets %d-%d of %d"%(b0 + 1, b0 + len(sets), len(params)))
+        # thresholds in the field dtype, as scalars are cast
+        axes = (len(sets),) + (1,)*len(shape)
+        kernel = FusedKernel((len(sets),) + shape, **{
+            name: np.asarray([p.get(name, default) for p in sets], dtype=dtype).reshape(axes)
+            for name, default in THRESHOLDS.items()})
+        # previous and current step state
+        state = [[np.empty(kernel.shape, dtype=dtype) for _ in range(4)] for _ in range(2)]
+        scores = Scores(len(sets), event)
+        for i in range(n):
+            with profile('sweep step', step=i, sets=len(sets)):
+                age, dacc, mi, drift = state[i%2]
+                if i == 0:
+                    kernel.first(temp[0], snowground[0], wind[0], age, dacc, mi, drift, init)
+                else:
+                    pAge, pDacc, pMi, pDrift = state[(i-1)%2]
+                    kernel.step(dtHours[i], snowground[i], snowfall[i], temp[i], wind[i],
+                                wind[i-1], pAge, pDacc, pMi, pDrift,
+                                age, dacc, mi, drift)
+                if times[i] in observed:
+                    scores.add(drift, np.asarray(observed[times[i]]))
+        results.extend(zip([dict(THRESHOLDS, **p) for p in sets], scores.results()))
+    return results
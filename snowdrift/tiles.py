@@ -0,0 +1,234 @@
+import os
+import logging
+import tempfile
+import numpy as np
+from collections import deque
+from multiprocessing import shared_memory
+from .fused import FusedKernel, fused_recursion, slice_init, OUTPUT_PARAMS, INIT_PARAMS
+from .pools import process_pool
+
+# Tiled execution of the drift model.
+#
+# All drift rules are cell-local in space and only recursive
+# in time, so the grid can be split into tiles (bands of rows)
+# and the full time recursion run per tile. The tile size is
+# picked from a memory budget, and the full grid outputs are
+# backed by temporary files when they don't fit in the budget.
+
+INPUT_PARAMS = ('snowground', 'snowfall', 'temp', 'wind')
+
+# in memory file system for shared outputs
+SHM_DIR = '/dev/shm'
+
+UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+# parse memory size string, e.g. '2G', '512M', '1.5g' or '1000000'
+def parse_memory(size):
+    if isinstance(size, (int, float)):
+        return int(size)
+    s = size.strip().upper()
+    if s.endswith('B'):
+        s = s[:-1]
+    try:
+        if s and s[-1] in UNITS:
+            return int(float(s[:-1])*UNITS[s[-1]])
+        return int(s)
+    except ValueError:
+        raise ValueError("invalid memory size %r"%size)
+
+# bytes of tile working memory per grid row,
+# tile copies of inputs and outputs for all steps, plus masks
+def row_bytes(nsteps, nx, itemsize=4):
+    fields = len(INPUT_PARAMS) + len(OUTPUT_PARAMS)
+    return nsteps*nx*itemsize*fields + 5*nx
+
+# number of grid rows per tile that fit in max_memory bytes
+def tile_rows(nsteps, ny, nx, max_memory, itemsize=4):
+    rows = max_memory//row_bytes(nsteps, nx, itemsize)
+    if rows < 1:
+        logging.warning("memory budget %d bytes is below one grid row, using 1 row tiles"%max_memory)
+        rows = 1
+    return int(min(rows, ny))
+
+# split ny rows into (start, stop) tile bands
+def tile_bands(ny, rows):
+    return [(r0, min(r0 + rows, ny)) for r0 in range(0, ny, rows)]
+
+# bytes of field values held in memory (not file backed),
+# values are sequences of steps or stacked arrays
+def resident_bytes(values):
+    if isinstance(values, np.ndarray):
+        values = [values]
+    return sum(v.nbytes for v in values if isinstance(v, np.ndarray) and not isinstance(v, np.memmap))
+
+# allocate a full grid output array, in memory or
+# backed by an anonymous temporary file in scratch dir
+# (the file is closed, the mapping keeps it until released).
+# shared: a named temporary file, for worker processes to
+# map (run_parallel), in SHM_DIR unless ondisk, remove it
+# with remove_output once the workers are done
+def new_output(shape, dtype, ondisk=False, scratch=None, shared=False):
+    if shared:
+        folder = SHM_DIR if not ondisk and os.path.isdir(SHM_DIR) else scratch
+        with tempfile.NamedTemporaryFile(dir=folder, prefix='snowdrift-', delete=False) as f:
+            return np.memmap(f.name, dtype=dtype, mode='w+', shape=shape)
+    if ondisk:
+        with tempfile.TemporaryFile(dir=scratch, prefix='snowdrift-') as f:
+            return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+    return np.empty(shape, dtype=dtype)
+
+# remove the file of a shared output, the array stays
+# valid (mapped) until released
+def remove_output(out):
+    if getattr(out, 'filename', None):
+        os.remove(out.filename)
+
+# Holds tile sized working buffers, reused for all tiles,
+# thresholds: further (scalar) FusedKernel thresholds.
+class TileRunner:
+    def __init__(self, nsteps, rows, nx, dtype, snowCoverLimit, snowFallLimit, **thresholds):
+        shape = (nsteps, rows, nx)
+        self.limits = dict(thresholds, snowCoverLimit=snowCoverLimit, snowFallLimit=snowFallLimit)
+        self.inputs = {p: np.empty(shape, dtype=dtype) for p in INPUT_PARAMS}
+        self.outputs = {p: np.empty(shape, dtype=dtype) for p, _ in OUTPUT_PARAMS}
+        self.kernel = FusedKernel(shape[1:], **self.limits)
+
+    # run the full recursion on rows r0:r1 of the input fields
+    # (sequences of (ny, nx) steps), and write into rows r0:r1
+    # of the full grid outputs
+    def run(self, inputs, dtHours, outputs, r0, r1, init=None):
+        rows = r1 - r0
+        kernel = self.kernel
+        if kernel.shape[0] != rows:
+            kernel = FusedKernel((rows,) + kernel.shape[1:], **self.limits)
+
+        # contiguous tile copies of the inputs,
+        tin = {}
+        for p in INPUT_PARAMS:
+            buf = self.inputs[p][:, :rows]
+            for i, v in enumerate(inputs[p]):
+                buf[i] = v[r0:r1]
+            tin[p] = buf
+        tout = {p: self.outputs[p][:, :rows] for p, _ in OUTPUT_PARAMS}
+
+        fused_recursion(kernel,
+            tin['snowground'], tin['snowfall'], tin['temp'], tin['wind'],
+            dtHours,
+            tout['snowage'], tout['driftacc'], tout['mobility'], tout['drift'],
+            slice_init(init, r0, r1))
+
+        for p, _ in OUTPUT_PARAMS:
+            outputs[p][:, r0:r1] = tout[p]
+
+
+# Parallel tile execution.
+#
+# Workers write their tiles directly into the full grid outputs,
+# file backed arrays they map by name (new_output(shared=True),
+# in /dev/shm when kept in memory). Input tiles are copied into
+# a shared memory block per tile band, at most 2*workers bands
+# at a time, so no field data is pickled between processes and
+# the outputs are not copied.
+
+# per worker process state, set by _attach
+_shared = {}
+
+# allocate a shared memory block, and its (n, rows, nx)
+# input and (3, rows, nx) warm start views
+def new_band(n, rows, nx, dtype, init=False):
+    dtype = np.dtype(dtype)
+    planes = len(INPUT_PARAMS)*n + (len(INIT_PARAMS) if init else 0)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, planes*rows*nx*dtype.itemsize))
+    return shm, band_arrays(shm, n, rows, nx, dtype, init)
+
+def band_arrays(shm, n, rows, nx, dtype, init=False):
+    a = np.ndarray((len(INPUT_PARAMS)*n + (len(INIT_PARAMS) if init else 0), rows, nx), dtype=dtype, buffer=shm.buf)
+    arrays = {p: a[k*n:(k + 1)*n] for k, p in enumerate(INPUT_PARAMS)}
+    if init:
+        arrays['init'] = a[len(INPUT_PARAMS)*n:]
+    return arrays
+
+# worker initializer, map the outputs
+def _attach(specs, dtHours, limits):
+    _shared['outputs'] = {p: np.memmap(name, dtype=dtype, mode='r+', shape=shape)
+                          for p, (name, shape, dtype) in specs.items()}
+    _shared['dtHours'] = dtHours
+    _shared['limits'] = limits
+
+# worker task, run the recursion on the input band block
+# name, into rows r0:r1 of the outputs
+def _run_band(job):
+    name, r0, r1, init = job
+    out = _shared['outputs']
+    n, _, nx = out['drift'].shape
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        a = band_arrays(shm, n, r1 - r0, nx, out['drift'].dtype, init)
+        kernel = FusedKernel((r1 - r0, nx), **_shared['limits'])
+        fused_recursion(kernel,
+            a['snowground'], a['snowfall'], a['temp'], a['wind'],
+            _shared['dtHours'],
+            out['snowage'][:, r0:r1], out['driftacc'][:, r0:r1],
+            out['mobility'][:, r0:r1], out['drift'][:, r0:r1],
+            dict(zip(INIT_PARAMS, a['init'])) if init else None)
+    finally:
+        # release views before closing the block
+        a = kernel = None
+        shm.close()
+    return r0, r1
+
+# Run tiles over a pool of worker processes, inputs are
+# sequences of (ny, nx) steps, outputs shared arrays from
+# new_output(shared=True), written in place by the workers.
+def run_parallel(inputs, dtHours, outputs, bands, workers, snowCoverLimit, snowFallLimit,
+                 init=None, **thresholds):
+    n, ny, nx = outputs['drift'].shape
+    dtype = outputs['drift'].dtype
+    specs = {p: (outputs[p].filename, (n, ny, nx), dtype.str) for p, _ in OUTPUT_PARAMS}
+    limits = dict(thresholds, snowCoverLimit=snowCoverLimit, snowFallLimit=snowFallLimit)
+    pending = deque()
+
+    # wait for the oldest band, and release its block
+    def finish():
+        future, shm = pending.popleft()
+        try:
+            r0, r1 = future.result()
+            logging.info(" - done tile rows %d-%d"%(r0, r1))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    with process_pool(workers, initializer=_attach,
+                      initargs=(specs, list(dtHours), limits)) as pool:
+        try:
+            for r0, r1 in bands:
+                shm, a = new_band(n, r1 - r0, nx, dtype, init is not None)
+                try:
+                    for p in INPUT_PARAMS:
+                        for i, v in enumerate(inputs[p]):
+                            a[p][i] = v[r0:r1]
+                    if init is not None:
+                        for k, p in enumerate(INIT_PARAMS):
+                            a['init'][k] = init[p][r0:r1]
+                    a = None
+                    pending.append((pool.submit(_run_band, (shm.name, r0, r1, init is not None)), shm))
+                except BaseException:
+                    a = None
+                    shm.close()
+                    shm.unlink()
+                    raise
+                if len(pending) >= 2*workers:
+                    finish()
+            while pending:
+                finish()
+        finally:
+            # release the blocks of failed runs
+            while pending:
+                future, shm = pending.popleft()
+                future.cancel()
+                try:
+                    future.exception()
+                except BaseException:
+                    pass
+                shm.close()
+                shm.unlink()
@@ -0,0 +1,137 @@
+import logging
+import numpy as np
+from datetime import timedelta
+from .fused import get_dt_hours
+from .snowdrift import snowdrift
+
+# Time axis resampling and sub-stepping.
+#
+# The drift recursion adds one step of drift accumulation per
+# step, i.e. it assumes the hourly steps of the first forecast
+# hours. Inputs are resampled onto the model steps here:
+#  - instantaneous fields (temp, wind, snow cover) are linearly
+#    interpolated between the bracketing input steps,
+#  - snowfall is carried as accumulated snow, interpolated
+#    linearly (a constant rate over each input interval), so the
+#    de-accumulated snowfall of any steps adds up to the input.
+# Input steps on the target axis are copied unchanged, so runs
+# on the input steps are identical to runs without resampling.
+# run_resampled sub-steps coarse intervals (e.g. 3 h or 6 h
+# steps late in the forecast) to at most max_dt hours and only
+# keeps the steps asked for.
+
+# regular steps of hours from start to stop (inclusive)
+def step_times(start, stop, hours):
+    times = []
+    t = start
+    while t <= stop:
+        times.append(t)
+        t = start + timedelta(hours=hours*len(times))
+    return times
+
+# times with each interval longer than max_dt hours
+# split into equal sub-steps
+def substep_times(times, max_dt):
+    out = [times[0]]
+    for t0, t1, dt in zip(times[:-1], times[1:], get_dt_hours(times)[1:]):
+        k = int(np.ceil(dt/max_dt - 1e-9))
+        out.extend(t0 + (t1 - t0)*j/k for j in range(1, k + 1))
+    return out
+
+# For each target time, the input step index k and weight
+# w of the step k+1 (0.0 for input steps)
+def interpolation(times, targets):
+    hours = np.array([(t - times[0]).total_seconds()/3600.0 for t in times])
+    weights = []
+    for t in targets:
+        h = (t - times[0]).total_seconds()/3600.0
+        if h < 0.0 or h > hours[-1]:
+            raise ValueError("%s is outside the input time range %s - %s"%(t, times[0], times[-1]))
+        k = min(int(np.searchsorted(hours, h, side='right')) - 1, len(times) - 1)
+        w = 0.0 if h == hours[k] else (h - hours[k])/(hours[k+1] - hours[k])
+        weights.append((k, w))
+    return weights
+
+# values of a param at the targets, as a stacked array
+def interpolate(values, weights):
+    v0 = np.asarray(values[0])
+    out = np.empty((len(weights),)+v0.shape, dtype=v0.dtype)
+    for i, (k, w) in enumerate(weights):
+        if w == 0.0:
+            out[i] = values[k]
+        else:
+            # v[k] + w*(v[k+1] - v[k]), in the field dtype
+            np.subtract(values[k+1], values[k], out=out[i])
+            np.multiply(out[i], v0.dtype.type(w), out=out[i])
+            np.add(out[i], values[k], out=out[i])
+    return out
+
+# snowfall rates as accumulated snow, from zero at the first step
+def accumulate(entry):
+    values = entry['values']
+    dtHours = get_dt_hours(entry['times'])
+    acc = np.empty((len(values),)+np.shape(values[0]), dtype=np.asarray(values[0]).dtype)
+    np.multiply(values[0], 0.0, out=acc[0])
+    for i in range(1, len(values)):
+        np.multiply(values[i], dtHours[i], out=acc[i])
+        np.add(acc[i], acc[i-1], out=acc[i])
+    unit = entry['unit'][:-2] if entry['unit'].endswith('/h') else entry['unit']
+    return dict(entry, values=acc, unit=unit)
+
+# data resampled to times, snowfall rates are resampled
+# as accumulated snow (snowac) and de-accumulated again by
+# calculateDeps. Dependent parameters are not resampled.
+def resample(data, times):
+    inputTimes = data['temp']['times']
+    weights = interpolation(inputTimes, times)
+    logging.info("resampling %d input steps to %d steps"%(len(inputTimes), len(times)))
+    out = {}
+    for p, entry in data.items():
+        if p == 'snowfall':
+            if 'snowac' in data:
+                continue
+            p, entry = 'snowac', accumulate(entry)
+        elif p == 'wind' and 'wind-u' in data:
+            continue
+        out[p] = dict(entry, times=list(times), values=interpolate(entry['values'], weights))
+    return out
+
+# data with only the steps at times (a subset of its steps)
+def select_steps(data, times):
+    for p, entry in data.items():
+        index = {t: i for i, t in enumerate(entry['times'])}
+        try:
+            steps = [index[t] for t in times]
+        except KeyError as e:
+            raise ValueError("no %s step at %s"%(p, e.args[0]))
+        values = entry['values']
+        if isinstance(values, np.ndarray):
+            values = values[steps]
+        else:
+            values = np.asarray([np.asarray(values[i]) for i in steps])
+        data[p] = dict(entry, times=list(times), values=values)
+    return data
+
+# Run the drift model (snowdrift(), with its kwargs) on data
+# resampled to times (the input steps if None), sub-stepped to
+# at most max_dt hours per step, keeping only the steps at
+# output times (times if None), on_step (see snowdrift) is
+# called for the output steps only, with their output index.
+def run_resampled(data, times=None, max_dt=None, output=None, **kwargs):
+    times = list(times if times is not None else data['temp']['times'])
+    output = list(output if output is not None else times)
+    model = substep_times(times, max_dt) if max_dt else times
+    logging.info("drift model on %d steps, %d output steps"%(len(model), len(output)))
+    on_step = kwargs.get('on_step')
+    if on_step is not None and output != model:
+        keep = {model.index(t): k for k, t in enumerate(output)}
+        def on_output_step(i, drift):
+            if i in keep:
+                on_step(keep[i], drift)
+        kwargs['on_step'] = on_output_step
+    if model != data['temp']['times']:
+        data = resample(data, model)
+    data = snowdrift(data, **kwargs)
+    if output != model:
+        data = select_steps(data, output)
+    return data
@@ -0,0 +1,702 @@
+import unittest
+import copy
+import numpy as np
+from datetime import timedelta
+import snowdrift
+from snowdrift import benchmark
+
+# Offline tests on synthetic input data, in the same
+# {'times', 'values', 'unit'} form as collectData returns.
+def synthetic_data(ny=40, nx=50, n=24, seed=0):
+    return benchmark.synthetic_data(ny, nx, n, seed)
+
+OUTPUTS = ['snowage', 'driftacc', 'mobility', 'drift']
+
+class Test(unittest.TestCase):
+    def assertIdentical(self, data1, data2):
+        for p in OUTPUTS:
+            self.assertEqual(list(data1[p]['times']), list(data2[p]['times']))
+            v1 = np.asarray([np.asarray(v) for v in data1[p]['values']])
+            v2 = np.asarray([np.asarray(v) for v in data2[p]['values']])
+            self.assertEqual(v1.shape, v2.shape)
+            # bit-identical, including nan and signed zeros
+            self.assertTrue((v1.view(np.uint32) == v2.view(np.uint32)).all(), p)
+
+    def test_fused_engine(self):
+        # fused engine should reproduce the per-step functions
+        data = synthetic_data()
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        res = snowdrift.snowdrift(copy.deepcopy(data), engine='fused')
+        self.assertIdentical(ref, res)
+        # still indexable per step
+        self.assertEqual(res['drift']['values'][3].shape, (40, 50))
+        self.assertEqual(res['drift']['values'].dtype, np.float32)
+
+    def test_compact_engine(self):
+        # compact state, decoded per step, should reproduce the
+        # per-step functions, also with NaN cold start fields
+        data = synthetic_data()
+        data['temp']['values'][0][:3, :3] = np.nan
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        res = snowdrift.snowdrift(copy.deepcopy(data), engine='compact')
+        self.assertIdentical(ref, res)
+        self.assertEqual(res['mobility']['values'][-1].dtype, np.float32)
+
+        # not whole hour steps, fused engine
+        for p in data:
+            data[p]['times'][5:] = [t + timedelta(minutes=30) for t in data[p]['times'][5:]]
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        res = snowdrift.snowdrift(copy.deepcopy(data), engine='compact')
+        self.assertIdentical(ref, res)
+
+    def test_compiled_engine(self):
+        # per-cell kernel, run uncompiled on a small grid, and the
+        # compiled engine (fused engine without numba) should
+        # reproduce the per-step functions, cold and warm started
+        from snowdrift.compiled import compiled_recursion, drift_cells
+        from snowdrift.fused import new_outputs, get_dt_hours
+        data = synthetic_data(ny=6, nx=7, n=12)
+        data['temp']['values'][0][:2, :2] = np.nan
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        init = {p: ref[p]['values'][5] for p in ('snowage', 'driftacc', 'mobility')}
+        warm = snowdrift.snowdrift(copy.deepcopy(data), state=init)
+        for res, state in ((ref, None), (warm, init)):
+            out = new_outputs(12, (6, 7))
+            compiled_recursion(drift_cells, res['snowground']['values'], res['snowfall']['values'],
+                               res['temp']['values'], res['wind']['values'], get_dt_hours(res['temp']['times']),
+                               1.0, 0.1,  # default limits
+                               out['snowage'], out['driftacc'], out['mobility'], out['drift'], state, block=5)
+            self.assertIdentical(res, {p: {'times': res[p]['times'], 'values': out[p]} for p in OUTPUTS})
+        data = synthetic_data()
+        self.assertIdentical(snowdrift.snowdrift(copy.deepcopy(data)),
+                             snowdrift.snowdrift(copy.deepcopy(data), engine='compiled'))
+
+    def test_sweep(self):
+        # each threshold set should score as its own run
+        data = synthetic_data(n=12)
+        params = snowdrift.param_grid(snowCoverLimit=[1.0, 2.0], windLimit=[5.0, 6.0])
+        self.assertEqual(len(params), 4)
+        out = snowdrift.snowdrift(copy.deepcopy(data), thresholds={'snowCoverLimit': 2.0})
+        obs = {'times': data['temp']['times'][::2], 'values': np.array(out['drift']['values'][::2])}
+        obs['values'][:, :5] = np.nan  # not observed
+        res = snowdrift.sweep(data, params, obs, batch=3)
+        self.assertEqual([p for p, _ in res][3]['windLimit'], 6.0)
+        scores = [s for _, s in res]
+        self.assertEqual(scores[0]['count'], 6*35*50)
+        self.assertEqual(scores[3]['rmse'], 0.0)
+        self.assertEqual(scores[3]['csi'], 1.0)
+        self.assertTrue(all(s['rmse'] > 0.0 for s in scores[:3]))
+
+    def test_thresholds(self):
+        # all engines run the given thresholds, array thresholds
+        # broadcast, the defaults change nothing
+        data = synthetic_data(n=12)
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        self.assertIdentical(ref, snowdrift.snowdrift(copy.deepcopy(data), thresholds=snowdrift.THRESHOLDS))
+        thresholds = {'windLimit': 5.0, 'ageLimit': 6, 'daccLow': 1.0}
+        res = snowdrift.snowdrift(copy.deepcopy(data), thresholds=thresholds)
+        self.assertFalse(np.array_equal(res['mobility']['values'], ref['mobility']['values']))
+        for kwargs in ({'engine': 'fused'}, {'engine': 'compact'}, {'engine': 'delta'}, {'engine': 'compiled'},
+                       {'max_memory': '1M'}, {'active_only': True}):
+            self.assertIdentical(res, snowdrift.snowdrift(copy.deepcopy(data), thresholds=thresholds, **kwargs))
+        windLimit = np.full((40, 50), 6.0, dtype=np.float32)
+        windLimit[:20] = 5.0
+        low = snowdrift.snowdrift(copy.deepcopy(data), thresholds={'windLimit': 5.0})
+        for engine in ('steps', 'compiled'):
+            res = snowdrift.snowdrift(copy.deepcopy(data), engine=engine, thresholds={'windLimit': windLimit})
+            for p in OUTPUTS:
+                self.assertTrue(np.array_equal(np.asarray(res[p]['values'])[:, :20], np.asarray(low[p]['values'])[:, :20]))
+                self.assertTrue(np.array_equal(np.asarray(res[p]['values'])[:, 20:], np.asarray(ref[p]['values'])[:, 20:]))
+        with self.assertRaises(ValueError):
+            snowdrift.snowdrift(copy.deepcopy(data), thresholds={'windLimit': windLimit}, max_memory='1M')
+        with self.assertRaises(ValueError):
+            snowdrift.snowdrift(copy.deepcopy(data), thresholds={'wind': 5.0})
+
+    def test_wind_release(self):
+        # wind speed is computed step by step, releasing u/v,
+        # so peak memory stays far below u + v + wind
+        import tracemalloc
+        from snowdrift.snowdrift import calculate_wind
+        data = synthetic_data(n=24)
+        tracemalloc.start()
+        try:
+            data = {p: dict(data[p], values=[v.copy() for v in data[p]['values']]) for p in ('wind-u', 'wind-v')}
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            calculate_wind(data)
+            peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 4*40*50*4)
+        self.assertEqual(len(data['wind']['values']), 24)
+        self.assertNotIn('wind-u', data)
+
+    def test_time_axis(self):
+        # resampling onto the input steps changes nothing, 3 hourly
+        # inputs sub-stepped hourly keep snowfall totals and output
+        # the input steps
+        data = synthetic_data(n=13)
+        times = data['temp']['times']
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        self.assertIdentical(ref, snowdrift.snowdrift(snowdrift.resample(copy.deepcopy(data), times), engine='fused'))
+        coarse = copy.deepcopy(data)
+        for p in coarse:
+            coarse[p]['times'] = times[::3]
+            coarse[p]['values'] = coarse[p]['values'][::3]
+        self.assertEqual(snowdrift.substep_times(times[::3], 1.0), times)
+        fine = snowdrift.resample(copy.deepcopy(coarse), times)
+        snowdrift.calculateDeps(fine)
+        total = np.sum(np.asarray(fine['snowfall']['values'], dtype=np.float64), axis=0)
+        self.assertTrue(np.allclose(total, coarse['snowac']['values'][-1] - coarse['snowac']['values'][0], atol=1e-5))
+        res = snowdrift.run_resampled(copy.deepcopy(coarse), max_dt=1.0, engine='fused')
+        self.assertEqual(res['drift']['times'], times[::3])
+        self.assertEqual(np.asarray(res['drift']['values']).shape, (5, 40, 50))
+        self.assertRaises(ValueError, snowdrift.resample, coarse, [times[0] - timedelta(hours=1)])
+
+    def test_active_cells(self):
+        # runs on the snow covered cells only should be identical
+        # to full grid runs, cold and warm started
+        data = synthetic_data(n=12)
+        for v in data['snowground']['values']:
+            v[:, :30] = -1.0
+        data['temp']['values'][0][:2, :2] = np.nan
+        ref = snowdrift.snowdrift(copy.deepcopy(data), engine='fused')
+        init = {p: ref[p]['values'][5] for p in ('snowage', 'driftacc', 'mobility')}
+        for engine in ('steps', 'fused', 'compact'):
+            for state in (None, init):
+                self.assertIdentical(snowdrift.snowdrift(copy.deepcopy(data), engine=engine, state=state),
+                                     snowdrift.snowdrift(copy.deepcopy(data), engine=engine, state=state, active_only=True))
+
+    def test_ensemble(self):
+        # members run at once should match separate runs,
+        # in all untiled engines
+        members = [synthetic_data(n=6, seed=k) for k in range(3)]
+        data = copy.deepcopy(members[0])
+        for p in data:
+            data[p]['values'] = np.stack([m[p]['values'] for m in members], axis=1)
+            data[p]['members'] = [0, 1, 2]
+        refs = [snowdrift.snowdrift(copy.deepcopy(m)) for m in members]
+        stats = []
+        for engine in ['steps', 'fused', 'compact', 'delta', 'compiled']:
+            steps = snowdrift.EnsembleSteps()
+            res = snowdrift.snowdrift(copy.deepcopy(data), engine=engine, on_step=steps)
+            self.assertEqual(res['drift']['members'], [0, 1, 2])
+            for k, ref in enumerate(refs):
+                member = {p: {'times': res[p]['times'], 'values': [v[k] for v in res[p]['values']]} for p in OUTPUTS}
+                self.assertIdentical(ref, member)
+            stats.append(steps.stats(res['drift']['times']))
+        with self.assertRaises(ValueError):
+            snowdrift.snowdrift(copy.deepcopy(data), max_memory='1M')
+
+        # accumulated during the runs as from the outputs, the
+        # mean over snow covered members only
+        stats.append(snowdrift.ensemble_stats(res))
+        drift = np.asarray([r['drift']['values'] for r in refs])
+        covered = (drift != -1.0).sum(axis=0)
+        mean = np.where(covered > 0, np.where(drift != -1.0, drift, 0.0).sum(axis=0)/np.maximum(covered, 1), -1.0)
+        self.assertTrue((covered < 3).any() and (covered > 0).any())
+        for s in stats:
+            self.assertEqual(list(s), ['drift-mean', 'drift-prob-0.09', 'drift-prob-0.2', 'drift-prob-0.5'])
+            self.assertTrue(np.allclose(s['drift-mean']['values'], mean, atol=1e-6))
+            self.assertTrue((s['drift-prob-0.2']['values'] == (drift >= 0.2).mean(axis=0).astype(np.float32)).all())
+
+        # written as derived products, not as the last member
+        import os, tempfile, pygrib
+        from snowdrift.collect_data import read_file
+        with tempfile.TemporaryDirectory() as tmp:
+            _, template = read_file(benchmark.synthetic_grib(members[0], tmp)[0])
+            template['perturbationNumber'] = 2
+            filename = os.path.join(tmp, 'stats.grb')
+            snowdrift.save_ensemble_stats(stats[0], filename, template, [0, 1, 2])
+            with pygrib.open(filename) as grbs:
+                msgs = list(grbs)
+        self.assertEqual(len(msgs), 6*4)
+        self.assertEqual(template['perturbationNumber'], 2)
+        self.assertEqual({m['perturbationNumber'] for m in msgs}, {0})
+        self.assertEqual({m['numberOfForecastsInEnsemble'] for m in msgs}, {3})
+        self.assertEqual([m['marsType'] for m in msgs[:4]], ['em', 'ep', 'ep', 'ep'])
+        self.assertEqual([m['endStep'] for m in msgs[::4]], list(range(6)))
+        self.assertEqual([m['indicatorOfParameter'] for m in msgs[:4]], [149, 150, 151, 152])
+        self.assertEqual({m['bitsPerValue'] for m in msgs if m.values.min() < m.values.max()}, {template['bitsPerValue']})
+
+    def test_region(self):
+        # drift on selected cells only should match the
+        # full grid results at those cells
+        import os, csv, tempfile
+        from snowdrift import region
+        from snowdrift.collect_data import read_file
+        lats, lons = np.meshgrid(np.linspace(66.0, 64.05, 40), np.linspace(-25.0, -20.1, 50), indexing='ij')
+        data = synthetic_data()
+        ref = snowdrift.snowdrift(copy.deepcopy(data), engine='fused')
+
+        points = region.select_points(lats, lons, [('a', 65.5, -24.0)],
+                                      [('r', [(65.0, -24.0), (65.0, -23.0), (65.5, -22.0)])])
+        self.assertEqual(points.names[0], 'a')
+        self.assertEqual(len(set(points.index[1:])), len(points.index) - 1)
+        bbox = region.select_bbox(lats, lons, (65.0, 65.5, -24.0, -23.0))
+        self.assertEqual(bbox.shape, (11, 11))
+        for sel in (points, bbox):
+            sub = copy.deepcopy(data)
+            for p in sub:
+                sub[p]['values'] = [sel.extract(v) for v in sub[p]['values']]
+            res = snowdrift.snowdrift(sub, engine='compact')
+            self.assertIdentical({p: {'times': ref[p]['times'], 'values': [sel.extract(v) for v in ref[p]['values']]}
+                                  for p in OUTPUTS}, res)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'points.csv')
+            region.save_points(res, filename, bbox)
+            with open(filename) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(len(rows), 24*11*11)
+            self.assertEqual(float(rows[-1]['drift']), float(res['drift']['values'][-1][-1, -1]))
+
+            # edges on grid rows and columns are inside, the template
+            # is cropped as a copy
+            for j in range(40):
+                sel = region.select_bbox(lats, lons, (round(lats[j, 0], 6), 66.0, round(lons[0, j], 6), -20.0))
+                self.assertEqual(sel.crop, (slice(0, j + 1), slice(j, 50)))
+            _, template = read_file(benchmark.synthetic_grib(synthetic_data(n=1), tmp)[0])
+            msg = region.crop_template(template, bbox)
+            self.assertEqual((msg['Nj'], msg['Ni'], template['Nj'], template['Ni']), (11, 11, 40, 50))
+            self.assertEqual(msg.values.shape, (11, 11))
+            self.assertEqual((msg['bitsPerValue'], msg['packingType']), (template['bitsPerValue'], template['packingType']))
+
+    def test_tiled_engine(self):
+        # tiled runs, in memory and with outputs on disk,
+        # should reproduce the per-step functions
+        data = synthetic_data()
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        # fits in memory (next to the loaded inputs), several tiles
+        res = snowdrift.snowdrift(copy.deepcopy(data), max_memory='2M')
+        self.assertIdentical(ref, res)
+        self.assertNotIsInstance(res['drift']['values'], np.memmap)
+        # outputs on disk, one row tiles
+        res = snowdrift.snowdrift(copy.deepcopy(data), max_memory=1000)
+        self.assertIdentical(ref, res)
+        self.assertIsInstance(res['drift']['values'], np.memmap)
+
+    def test_parse_memory(self):
+        from snowdrift.tiles import parse_memory
+        self.assertEqual(parse_memory('2G'), 2*1024**3)
+        self.assertEqual(parse_memory('512m'), 512*1024**2)
+        self.assertEqual(parse_memory('1.5KB'), 1536)
+        self.assertEqual(parse_memory('1000'), 1000)
+        self.assertRaises(ValueError, parse_memory, 'lots')
+
+    def test_parallel_engine(self):
+        # tiles over a process pool should match the serial path
+        data = synthetic_data()
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        res = snowdrift.snowdrift(copy.deepcopy(data), workers=3)
+        self.assertIdentical(ref, res)
+
+    def test_stream(self):
+        # pushing steps one at a time should reproduce the batch run
+        data = synthetic_data(n=6)
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        stream = snowdrift.DriftStream()
+        for i, t in enumerate(data['temp']['times']):
+            fields = {p: data[p]['values'][i] for p in data}
+            step, st, state = stream.push(t, fields)
+            self.assertEqual((step, st), (i, t))
+            for p in OUTPUTS:
+                v = ref[p]['values'][i]
+                self.assertTrue((state[p].view(np.uint32) == v.view(np.uint32)).all(), p)
+        # steps must arrive in time order
+        self.assertRaises(ValueError, stream.push, t, fields)
+
+    def test_pipeline(self):
+        # pipelined stages should reproduce the batch run, in order
+        data = synthetic_data(n=8)
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        times = data['temp']['times']
+        def reader(i):
+            return [(p, data[p]['unit'], times[i], 0, data[p]['values'][i]) for p in data], None
+        steps = []
+        def writer(stream, i, t, state):
+            steps.append((i, t, state))
+        stream = snowdrift.pipeline(list(range(len(times))), reader=reader, writer=writer, queue_size=1)
+        self.assertEqual(stream.nsteps, len(times))
+        self.assertEqual([(i, t) for i, t, _ in steps], list(enumerate(times)))
+        res = {p: {'times': times, 'values': [s[p] for _, _, s in steps]} for p in OUTPUTS}
+        self.assertIdentical(ref, res)
+
+    def test_pipeline_order(self):
+        # GRIB files are run in valid time order, as given or not
+        import os, tempfile
+        try:
+            import eccodes
+        except ImportError:
+            self.skipTest("eccodes is not installed")
+        with tempfile.TemporaryDirectory() as tmp:
+            files = benchmark.synthetic_grib(synthetic_data(n=4), tmp)
+            out = [os.path.join(tmp, 'a.grb'), os.path.join(tmp, 'b.grb')]
+            snowdrift.pipeline(files, out[0], workers=1)
+            snowdrift.pipeline(files[::-1], out[1], workers=1)
+            with open(out[0], 'rb') as a, open(out[1], 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_zarr(self):
+        # chunked store should round trip, whole and per step/tile,
+        # written in parallel or appended step by step
+        import os, tempfile
+        try:
+            import zarr
+        except ImportError:
+            self.skipTest("zarr is not installed")
+        data = synthetic_data(n=6)
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        lats, lons = np.meshgrid(np.linspace(65.0, 70.0, 40), np.linspace(10.0, 20.0, 50), indexing='ij')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sd.zarr')
+            snowdrift.save_zarr(ref, path, lats, lons, workers=2, chunks=(16, 16))
+            for p in OUTPUTS:
+                v = np.asarray(ref[p]['values'])
+                self.assertTrue((snowdrift.read_zarr(path, p).view(np.uint32) == v.view(np.uint32)).all(), p)
+                tile = snowdrift.read_zarr(path, p, 4, slice(10, 35), slice(30, None))
+                self.assertTrue((tile.view(np.uint32) == v[4, 10:35, 30:].view(np.uint32)).all(), p)
+            self.assertEqual(snowdrift.read_zarr(path, 'time')[-1], 5*3600)
+            # time 0 is not missing
+            group = zarr.open_group(path, mode='r')
+            self.assertEqual([group[a].fill_value for a in ('time', 'latitude')], [None, None])
+            self.assertTrue(np.isnan(group['drift'].fill_value))
+
+            path = os.path.join(tmp, 'points.zarr')
+            store = snowdrift.ZarrWriter(path, lats[0], lons[0], names=['p%d'%k for k in range(50)], chunks=(16,))
+            for i, t in enumerate(ref['drift']['times']):
+                store.write_step(i, t, {p: ref[p]['values'][i][0] for p in OUTPUTS})
+            store.close()
+            drift = snowdrift.read_zarr(path, 'drift', rows=slice(20, 40))
+            self.assertTrue(np.array_equal(drift, np.asarray(ref['drift']['values'])[:, 0, 20:40], equal_nan=True))
+
+    def test_delta_storage(self):
+        # delta engine and archive should decode any step,
+        # in any order, as the fused engine computes it
+        import os, tempfile
+        data = synthetic_data(n=14)
+        data['temp']['values'][0][:2, :2] = np.nan
+        ref = snowdrift.snowdrift(copy.deepcopy(data), engine='fused')
+        res = snowdrift.snowdrift(copy.deepcopy(data), engine='delta')
+        self.assertIdentical(ref, res)
+        for p in OUTPUTS:
+            v = np.asarray(ref[p]['values'])
+            for i in (9, 3, 13, 12, 0, 7):
+                self.assertTrue((np.asarray(res[p]['values'][i]).view(np.uint32) == v[i].view(np.uint32)).all(), p)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sd.npz')
+            snowdrift.save_delta(res, path)
+            for p in OUTPUTS:
+                v = np.asarray(ref[p]['values'])
+                values, times = snowdrift.read_delta(path, p)
+                self.assertEqual(times, ref[p]['times'])
+                self.assertTrue((values.view(np.uint32) == v.view(np.uint32)).all(), p)
+                step, _ = snowdrift.read_delta(path, p, 10)
+                self.assertTrue((step.view(np.uint32) == v[10].view(np.uint32)).all(), p)
+
+    def test_warm_start(self):
+        # state saved at +3h should seed a run starting at +3h,
+        # the same in all engines
+        import os, tempfile
+        data = synthetic_data(n=12)
+        ref = snowdrift.snowdrift(copy.deepcopy(data))
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'state')
+            snowdrift.save_state(filename, ref, 3)
+            t3 = data['temp']['times'][3]
+            self.assertIsNone(snowdrift.load_state(filename, data['temp']['times'][0]))
+            state = snowdrift.load_state(filename, t3, snowdrift.grid_hash(shape=(40, 50)))
+            self.assertEqual(state['time'], t3)
+            self.assertTrue((state['mobility'] == ref['mobility']['values'][3]).all())
+
+            # next cycle, starting at +3h
+            cycle = synthetic_data(n=6, seed=1)
+            for p in cycle:
+                cycle[p]['times'] = [t + (t3 - cycle[p]['times'][0]) for t in cycle[p]['times']]
+            res = snowdrift.snowdrift(copy.deepcopy(cycle), state=state)
+            cold = snowdrift.snowdrift(copy.deepcopy(cycle))
+            self.assertFalse((res['mobility']['values'][0] == cold['mobility']['values'][0]).all())
+            self.assertIdentical(res, snowdrift.snowdrift(copy.deepcopy(cycle), engine='fused', state=state))
+            self.assertIdentical(res, snowdrift.snowdrift(copy.deepcopy(cycle), engine='compact', state=state))
+            self.assertIdentical(res, snowdrift.snowdrift(copy.deepcopy(cycle), max_memory='100K', state=state))
+            self.assertIdentical(res, snowdrift.snowdrift(copy.deepcopy(cycle), workers=2, state=state))
+
+            # streamed steps check the grid too, no step to save from
+            stream = snowdrift.DriftStream(init=state)
+            _, _, s = stream.push(t3, {p: cycle[p]['values'][0][:, :49] for p in ('temp', 'snowground', 'snowac', 'wind-u', 'wind-v')})
+            self.assertIsNone(stream.init)
+            self.assertFalse(snowdrift.save_state(os.path.join(tmp, 'none'), ref, 30))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'none')))
+            del state
+
+    def test_read_grib(self):
+        # configured messages decoded serially, over workers and
+        # from the cache should be identical, and match the inputs
+        import os, tempfile
+        from snowdrift.collect_data import config, read_file, select_messages
+        data = synthetic_data(ny=20, nx=30, n=4)
+        with tempfile.TemporaryDirectory() as tmp:
+            files = benchmark.synthetic_grib(data, tmp)
+            id2Par = {v['id']: k for k, v in config.items()}
+            self.assertEqual(sorted(p for p, g in select_messages(files[0], id2Par)), sorted(config))
+            records, template = read_file(files[0])
+            self.assertEqual(template['indicatorOfParameter'], 11)
+            self.assertEqual([r[2] for r in records], [data['temp']['times'][0]]*len(config))
+
+            ref, _ = snowdrift.collectData(files)
+            for p in ('snowground', 'temp', 'wind-u', 'wind-v'):
+                self.assertEqual(list(ref[p]['times']), data[p]['times'])
+                self.assertTrue(np.allclose(ref[p]['values'], data[p]['values'], atol=1e-3), p)
+            cache = os.path.join(tmp, 'cache')
+            for kwargs in ({'workers': 2}, {'cache': cache}, {'cache': cache, 'workers': 2}):
+                res, template = snowdrift.collectData(files, **kwargs)
+                self.assertEqual(template['indicatorOfParameter'], 11)
+                for p in ref:
+                    self.assertEqual(res[p]['times'], ref[p]['times'])
+                    self.assertTrue((np.asarray(res[p]['values']) == np.asarray(ref[p]['values'])).all(), p)
+            # cache hit
+            self.assertIsInstance(res['temp']['values'][0], np.memmap)
+
+    def test_save_grib(self):
+        # the configured precision holds for every message, also
+        # after constant fields (0 bits), the same from workers
+        # and the stream
+        import os, tempfile, pygrib
+        from snowdrift.save_grib import PARAMETERS
+        data = synthetic_data(ny=20, nx=30, n=4)
+        with tempfile.TemporaryDirectory() as tmp:
+            files = benchmark.synthetic_grib(data, tmp)
+            inputs, template = snowdrift.collectData(files)
+            res = snowdrift.snowdrift(inputs)
+            out = [os.path.join(tmp, 'out%d.grb'%k) for k in range(4)]
+            snowdrift.save_grib(res, out[0], template, packing='grid_simple', bitsPerValue=12)
+            snowdrift.save_grib(res, out[1], template, workers=2, packing='grid_simple', bitsPerValue=12)
+            with open(out[2], 'wb') as f:
+                stream = snowdrift.DriftStream(f, packing='grid_simple', bitsPerValue=12)
+                for fn in files:
+                    stream.push_file(fn)
+            for fn in out[1:3]:
+                with open(out[0], 'rb') as f1, open(fn, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+            snowdrift.save_grib(res, out[3], template)
+
+            for fn, bits in ((out[0], 12), (out[3], 16)):
+                with pygrib.open(fn) as grbs:
+                    msgs = list(grbs)
+                self.assertEqual(len(msgs), 4*len(OUTPUTS))
+                constant = 0
+                for k, msg in enumerate(msgs):
+                    i, p = divmod(k, len(PARAMETERS))
+                    values = np.asarray(res[PARAMETERS[p][0]]['values'][i])
+                    if values.min() == values.max():
+                        constant += 1
+                        self.assertEqual(msg['bitsPerValue'], 0)
+                    else:
+                        self.assertEqual(msg['bitsPerValue'], bits)
+                    self.assertEqual(msg['packingType'], 'grid_simple')
+                    self.assertEqual((msg['startStep'], msg['endStep']), (i, i))
+                    scale = (values.max() - values.min())/2**bits
+                    self.assertTrue(np.allclose(msg.values, values, atol=scale))
+                self.assertGreater(constant, 0)
+
+            # forecast steps in hours from the analysis time
+            sub = {p: {'times': res[p]['times'][1::2], 'values': res[p]['values'][1::2]} for p in res}
+            snowdrift.save_grib(sub, out[3], template)
+            with pygrib.open(out[3]) as grbs:
+                self.assertEqual([msg['endStep'] for msg in grbs], [1]*4 + [3]*4)
+
+    def test_png(self):
+        # one palette image per param and step, with the same
+        # pixels as the trollimage plot() images
+        import os, tempfile
+        from PIL import Image
+        res = snowdrift.snowdrift(synthetic_data(n=3))
+        self.assertRaises(ValueError, snowdrift.plot_all, res)
+        with tempfile.TemporaryDirectory() as tmp:
+            save = os.path.join(tmp, 'png', 'sd')
+            self.assertEqual(snowdrift.plot_all(res, save=save, workers=2), 12)
+            self.assertEqual(len(os.listdir(os.path.join(tmp, 'png'))), 12)
+            ref = os.path.join(tmp, 'ref')
+            for p in OUTPUTS:
+                snowdrift.plot(res, 2, p, save=ref)
+                img = Image.open('%s_%s_002.png'%(save, p))
+                self.assertEqual((img.mode, img.size), ('P', (50, 40)))
+                rgb = np.asarray(img.convert('RGB'))
+                self.assertTrue((rgb == np.asarray(Image.open('%s_%s_002.png'%(ref, p)).convert('RGB'))).all(), p)
+
+    def test_field_cache(self):
+        # cached fields come back memory-mapped and equal,
+        # and least recently used files are evicted first
+        import os, time, tempfile
+        from snowdrift.cache import FieldCache
+        from snowdrift.collect_data import config
+        data = synthetic_data(n=2)
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for k in range(3):
+                f = os.path.join(tmp, 'fc.%02d'%k)
+                open(f, 'wb').write(b'GRIB%d'%k)
+                files.append(f)
+            records = [(p, data[p]['unit'], data[p]['times'][0], 0, data[p]['values'][0]) for p in data]
+            cache = FieldCache(os.path.join(tmp, 'cache'))
+            self.assertIsNone(cache.get(files[0], config))
+            for f in files:
+                cache.put(f, config, records, None)
+                time.sleep(0.01)
+            cached, template = cache.get(files[0], config)
+            self.assertIsNone(template)
+            for (p, unit, t, m, vals), (cp, cunit, ct, cm, cvals) in zip(records, cached):
+                self.assertEqual((p, unit, t, m), (cp, cunit, ct, cm))
+                self.assertIsInstance(cvals, np.memmap)
+                self.assertTrue((vals == cvals).all())
+
+            # files[0] is most recently used, evict down to one entry
+            os.utime(files[1])  # changed file, no longer cached
+            self.assertIsNone(cache.get(files[1], config))
+            cache.max_size = 2*40*50*4*len(records)
+            cache.evict()
+            self.assertIsNotNone(cache.get(files[0], config))
+            self.assertIsNone(cache.get(files[2], config))
+
+    def test_serve(self):
+        # jobs run on the pool, queue is bounded, socket requests
+        import os, queue, tempfile, threading
+        from snowdrift import serve
+        release = threading.Event()
+        def runner(args):
+            release.wait()
+            return int(args[0])
+        service = serve.Service(workers=1, queue_size=1, runner=runner)
+        jobs = [service.submit(['0'])]
+        jobs.append(service.submit(['3']))  # queued while first runs
+        with self.assertRaises(queue.Full):
+            service.submit(['0'], timeout=0.2)
+        # process wide options are rejected per job
+        for args in (['--quiet'], ['0', '--prof=p.json'], ['--out', 'o', '--qu']):
+            self.assertRaises(ValueError, service.submit, args)
+        release.set()
+        for job in jobs:
+            job.done.wait()
+        self.assertEqual([j.status for j in jobs], ['done', 'failed'])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sock')
+            server = serve.SocketServer(path, service)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.assertEqual(serve.request(path, {'args': ['0']})['status'], 'done')
+            self.assertEqual(serve.request(path, {'args': ['0', '--quiet']})['status'], 'invalid')
+            stats = serve.request(path, {'stats': True})
+            server.shutdown()
+            server.server_close()
+        self.assertEqual((stats['done'], stats['failed'], stats['queued']), (2, 1, 0))
+
+        # spool jobs are claimed, the stats file is not
+        import json, time
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('stats', 'nightly_stats'):
+                with open(os.path.join(tmp, name + '.json'), 'w') as fp:
+                    json.dump({'args': ['0']}, fp)
+            stop = threading.Event()
+            watcher = threading.Thread(target=serve.watch_spool, args=(service, tmp, 0.05, stop))
+            watcher.start()
+            done = os.path.join(tmp, 'nightly_stats.done')
+            for _ in range(100):
+                if os.path.exists(done):
+                    break
+                time.sleep(0.05)
+            stop.set()
+            watcher.join()
+            self.assertTrue(os.path.exists(done))
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'stats.json')))
+        service.shutdown()
+
+    def test_benchmark(self):
+        # all stages timed, report is JSON serializable
+        import json
+        case = benchmark.run_case(20, 30, 4, png=False)
+        stages = case['stages']
+        for name in ['calculateDeps', 'calculate_drift', "snowdrift(engine='steps')", "snowdrift(engine='fused')"]:
+            self.assertIn(name, stages)
+            self.assertGreater(stages[name]['seconds'], 0)
+        json.dumps(case)
+
+    def test_benchmark_script(self):
+        # the script runs, worker pools included
+        import os, sys, json, subprocess
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+        res = subprocess.run([sys.executable, os.path.join(root, 'bin', 'snowdrift-benchmark'), '--sizes', '20x30',
+                              '--steps', '3', '--workers', '2', '--no-png'],
+                             env=env, capture_output=True, text=True)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertIn("snowdrift(workers=2)", json.dumps(json.loads(res.stdout)))
+
+    def test_profiling(self):
+        # stages recorded and passed to hooks only while enabled
+        import json
+        seen = []
+        profiler = snowdrift.enable_profiling()
+        profiler.add_hook(seen.append)
+        try:
+            snowdrift.snowdrift(synthetic_data(n=4), engine='fused')
+        finally:
+            snowdrift.disable_profiling()
+        totals = profiler.totals()
+        self.assertEqual(totals['deps']['count'], 1)
+        self.assertEqual(totals['drift step']['count'], 4)
+        self.assertEqual(len(seen), len(profiler.records))
+        json.dumps(profiler.report())
+
+        snowdrift.snowdrift(synthetic_data(n=4), engine='fused')
+        self.assertEqual(len(profiler.records), len(seen))
+
+        # per stage peaks, an enclosing stage keeps its nested peak
+        import sys
+        from snowdrift.profiling import profile
+        if sys.platform.startswith('linux'):
+            profiler = snowdrift.enable_profiling()
+            try:
+                with profile('outer'):
+                    with profile('big'):
+                        np.ones(2**25).sum()
+                    with profile('small'):
+                        pass
+            finally:
+                snowdrift.disable_profiling()
+            peaks = {r['name']: r['peak_rss'] for r in profiler.records}
+            self.assertGreater(peaks['big'] - peaks['small'], 2**27)
+            self.assertEqual(peaks['outer'], peaks['big'])
+            self.assertEqual(profiler.report()['peak_rss'], peaks['big'])
+
+        # concurrent stages nest in their own thread
+        import threading
+        barrier = threading.Barrier(2)
+        def run(name):
+            with profile(name):
+                barrier.wait()
+                with profile(name + '.inner'):
+                    barrier.wait()
+                barrier.wait()
+        profiler = snowdrift.enable_profiling()
+        try:
+            threads = [threading.Thread(target=run, args=(name,)) for name in ('a', 'b')]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            snowdrift.disable_profiling()
+        parents = {r['name']: r['parent'] for r in profiler.records}
+        self.assertEqual(parents, {'a': None, 'b': None, 'a.inner': 'a', 'b.inner': 'b'})
+
+    def test_stats(self):
+        # cached per step, only new steps computed, replaced values recomputed
+        from snowdrift import stats
+        entry = {'times': [0, 1], 'values': [np.array([1.0, 5.0]), np.array([-2.0, 2.0])], 'unit': ''}
+        self.assertEqual(stats.param_stats(entry), (-2.0, 5.0, 1.5))
+        cached = entry['stats']['steps']
+        entry['values'].append(np.array([7.0, 9.0]))
+        self.assertEqual(stats.param_stats(entry)[1], 9.0)
+        self.assertIs(entry['stats']['steps'], cached)
+        entry['values'] = [np.array([0.0, 1.0])]
+        self.assertEqual(stats.param_stats(entry), (0.0, 1.0, 0.5))